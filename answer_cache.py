@@ -0,0 +1,112 @@
+import threading
+import time
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Semantic cache of generated answers.
+    A new query reuses a stored answer when the cosine similarity between its embedding and a
+    previously answered query is >= threshold. Memory is bounded by max_entries (least recently
+    used entries are evicted). Entries belong to an index version (search.py passes the namespace
+    and the manifest written by setup_pinecone.py); a lookup with a new version drops the whole
+    cache, so answers built from a previous index are not served after re-indexing.
+    """
+
+    def __init__(self, threshold=0.95, max_entries=512, ttl=None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = None
+        self._lock = threading.Lock()
+        self._vectors = None  # (max_entries, dim) float32, rows are unit vectors
+        self._answers = [None] * max_entries
+        self._queries = [None] * max_entries
+        self._created = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+        self._used = np.zeros(max_entries, dtype=bool)
+        self.hits = 0
+        self.misses = 0
+
+    def _clear(self):
+        self._vectors = None
+        self._answers = [None] * self.max_entries
+        self._queries = [None] * self.max_entries
+        self._used[:] = False
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._clear()
+            self.version = version
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    @staticmethod
+    def _normalize(vector):
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, vector, version=None):
+        # returns (answer, similarity) or None
+        if vector is None:
+            return None
+        with self._lock:
+            self._check_version(version)
+            if self._vectors is None or not self._used.any():
+                self.misses += 1
+                return None
+
+            now = time.time()
+            if self.ttl is not None:
+                self._used &= (now - self._created) <= self.ttl
+
+            query = self._normalize(vector)
+            if query.shape[0] != self._vectors.shape[1]:
+                self.misses += 1
+                return None
+            sims = self._vectors @ query
+            sims[~self._used] = -np.inf
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self._last_used[best] = now
+            self.hits += 1
+            return self._answers[best], float(sims[best])
+
+    def add(self, vector, query, answer, version=None):
+        if vector is None or not answer:
+            return
+        with self._lock:
+            if version != self.version:
+                # generated from an index that has been replaced since the lookup
+                return
+            vec = self._normalize(vector)
+            if self._vectors is None or self._vectors.shape[1] != vec.shape[0]:
+                self._clear()
+                self._vectors = np.zeros((self.max_entries, vec.shape[0]), dtype=np.float32)
+
+            free = np.flatnonzero(~self._used)
+            # evict the least recently used entry when full
+            slot = int(free[0]) if free.size else int(np.argmin(self._last_used))
+            now = time.time()
+            self._vectors[slot] = vec
+            self._answers[slot] = answer
+            self._queries[slot] = query
+            self._created[slot] = now
+            self._last_used[slot] = now
+            self._used[slot] = True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": int(self._used.sum()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,161 @@
+"""
+HTTP API around the RAG pipeline, answers streamed as server-sent events.
+
+    POST /chat  {"query": "...", "chat_history": [{"role": "user" | "assistant", "content": "..."}], "stream": true,
+                 "budget": <seconds to the first token, optional>}
+
+Streaming responses are a sequence of
+
+    data: {"content": "<chunk>"}
+    event: done   data: {"trace_id", "duration", "stages": {stage: seconds}, "fallbacks": [skipped stage]}
+    event: error  data: {"error", "stage"}      (when generation fails mid-stream)
+
+Failures before the first chunk return HTTP 502 with {"error", "stage"}, or HTTP 503 with a
+Retry-After header when the request was shed by admission control (scheduler.py). With "stream": false
+the answer comes back as {"answer", "trace_id", "stages", "fallbacks"}.
+
+Clients and models are created once per worker process at startup (search.warm_up) and shared
+by every request; requests run on the worker's event loop through arag_pipeline. Run with
+`python api.py` (API_WORKERS processes) or `uvicorn api:app --workers N`.
+Requests are rate limited per client address (RATE_LIMIT, slowapi); set RATE_LIMIT_STORAGE to
+e.g. redis://host:6379 so the limit is shared by all workers instead of counted per worker.
+"""
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from langchain_core.messages import AIMessage, HumanMessage
+from pydantic import BaseModel, Field
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+
+import scheduler
+import tracing
+from backends import aclose_http_client, http_pool_stats
+from search import arag_pipeline, warm_up
+
+load_dotenv()
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', '8000'))
+API_WORKERS = int(os.getenv('API_WORKERS', str(os.cpu_count() or 1)))
+RATE_LIMIT = os.getenv('RATE_LIMIT', '30/minute')
+RATE_LIMIT_STORAGE = os.getenv('RATE_LIMIT_STORAGE', 'memory://')
+# seconds a shed client is told to wait before retrying
+RETRY_AFTER = os.getenv('RETRY_AFTER', '1')
+# same cut as web_chatbot.py (5 bot, 5 human)
+MAX_TURNS = 10
+
+
+class Message(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str
+
+
+class ChatRequest(BaseModel):
+    query: str = Field(min_length=1)
+    chat_history: List[Message] = []
+    stream: bool = True
+    # seconds until the answer starts, REQUEST_BUDGET when not given
+    budget: Optional[float] = Field(default=None, gt=0)
+
+
+def to_messages(chat_history):
+    messages = [HumanMessage(m.content) if m.role == "user" else AIMessage(m.content) for m in chat_history]
+    return messages[-MAX_TURNS:]
+
+
+def sse(data, event=None):
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@asynccontextmanager
+async def lifespan(app):
+    warm_up()
+    yield
+    await aclose_http_client()
+
+
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE)
+app = FastAPI(title="Chatbot CSE UPI", lifespan=lifespan)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+
+class PipelineStreamingResponse(StreamingResponse):
+    # closes the pipeline stream after sending, also when sending fails before the body starts
+    # (client gone), so its admission and llm slots are always freed
+    def __init__(self, content, pipeline_stream, **kwargs):
+        super().__init__(content, **kwargs)
+        self.pipeline_stream = pipeline_stream
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.pipeline_stream.aclose()
+
+
+async def events(stream, trace):
+    try:
+        async for chunk in stream:
+            content = getattr(chunk, "content", "") or ""
+            if content:
+                yield sse({"content": content})
+    except Exception as e:
+        print(f"Error generation: {e}")
+        yield sse({"error": f"{type(e).__name__}: {e}", "stage": trace.error_stage() or "generation"}, "error")
+        return
+    finally:
+        # also runs when the client disconnects, which finishes the trace
+        await stream.aclose()
+    yield sse({"trace_id": trace.id, "duration": trace.duration, "stages": trace.stage_durations(),
+               "fallbacks": trace.fallbacks()}, "done")
+
+
+@app.post("/chat")
+@limiter.limit(RATE_LIMIT)
+async def chat(request: Request, body: ChatRequest):
+    trace = tracing.Trace("rag_pipeline", client=get_remote_address(request))
+    try:
+        response = await arag_pipeline(body.query, to_messages(body.chat_history), streaming=body.stream, trace=trace,
+                                       budget=body.budget)
+    except scheduler.Overloaded as e:
+        print(f"Request ditolak: {e}")
+        trace.finish()
+        return JSONResponse({"error": str(e), "stage": trace.error_stage()}, status_code=503,
+                            headers={"Retry-After": RETRY_AFTER})
+    except Exception as e:
+        print(f"Error pipeline: {e}")
+        trace.finish()
+        return JSONResponse({"error": f"{type(e).__name__}: {e}", "stage": trace.error_stage()}, status_code=502)
+    if not body.stream:
+        return {"answer": response, "trace_id": trace.id, "stages": trace.stage_durations(), "fallbacks": trace.fallbacks()}
+    return PipelineStreamingResponse(
+        events(response, trace),
+        response,
+        media_type="text/event-stream",
+        # no buffering in nginx and similar proxies
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+async def stats():
+    # per-stage latency (seconds), admission / upstream counters and connection reuse of this worker process
+    return {"stages": tracing.stats(), "scheduler": scheduler.stats(), "http_pools": http_pool_stats()}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("api:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
@@ -0,0 +1,105 @@
+"""
+Client of the streaming chat API (api.py), used by the Streamlit app and the bench.
+stream_chat() has the call shape of search.RAG_pipeline and yields message chunks, so callers
+can switch between the in-process pipeline and the API.
+"""
+import json
+import os
+
+import requests
+from langchain_core.messages import AIMessageChunk
+from requests.adapters import HTTPAdapter
+
+API_URL = os.getenv('API_URL')
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', '120'))
+# keep-alive connections kept per API host, at least the bench concurrency
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '64'))
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=API_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_maxsize=API_POOL_SIZE))
+
+
+class ApiError(Exception):
+    def __init__(self, message, stage=None):
+        super().__init__(message)
+        self.stage = stage
+
+
+def history_payload(chat_history):
+    # LangChain messages (or role/content dicts) -> [{"role", "content"}]
+    payload = []
+    for m in chat_history:
+        if isinstance(m, dict):
+            payload.append({"role": m["role"], "content": m["content"]})
+        else:
+            payload.append({"role": "user" if m.type == "human" else "assistant", "content": m.content})
+    return payload
+
+
+def iter_events(response):
+    # (event, data) pairs of a server-sent event stream
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+
+def record_error(trace, stage, error):
+    # failed stage reported by the server, as a failed span of the local trace
+    if trace is not None and stage:
+        trace.add_span(stage, trace.start, 0.0, {"error": error})
+
+
+def stream_chat(query, chat_history, streaming=True, trace=None, api_url=None):
+    """
+    Answer chunks from POST {api_url}/chat, the whole answer text with streaming=False. The
+    request is sent before this returns, so a rejected request raises ApiError here like a
+    pipeline failure does for RAG_pipeline.
+    Stage timings reported by the server are added to trace when one is given.
+    """
+    url = (api_url or API_URL).rstrip("/") + "/chat"
+    payload = {"query": query, "chat_history": history_payload(chat_history), "stream": streaming}
+    response = session.post(url, json=payload, stream=streaming, timeout=API_TIMEOUT)
+    if response.status_code != 200:
+        try:
+            body = response.json()
+        except ValueError:
+            body = {"error": response.text}
+        response.close()
+        record_error(trace, body.get("stage"), body.get("error"))
+        raise ApiError(f"{response.status_code} - {body.get('error')}", body.get("stage"))
+    if not streaming:
+        body = response.json()
+        record_done(trace, body)
+        return body["answer"]
+    return chunks(response, trace)
+
+
+def record_done(trace, data):
+    # server trace id, skipped stages and stage timings of a finished answer
+    if trace is None:
+        return
+    trace.set(server_trace_id=data.get("trace_id"))
+    for stage in data.get("fallbacks", []):
+        trace.event(f"{stage}_skipped", reason="server")
+    for name, seconds in data.get("stages", {}).items():
+        trace.add_span(name, trace.start, seconds)
+
+
+def chunks(response, trace):
+    with response:
+        for event, data in iter_events(response):
+            if event == "error":
+                record_error(trace, data.get("stage"), data.get("error"))
+                raise ApiError(data.get("error"), data.get("stage"))
+            if event == "done":
+                record_done(trace, data)
+                return
+            yield AIMessageChunk(content=data.get("content", ""))
@@ -0,0 +1,380 @@
+"""
+Upstream services used by the RAG pipeline, behind small duck-typed interfaces:
+
+- embedder:     embed(text, dim_size) -> list of floats, embed_batch(texts, dim_size) -> list of those
+- index_dense / index_sparse:
+                query(namespace, vector | sparse_vector, top_k, include_metadata, include_values, filter)
+                -> {"matches": [{"id", "score", "metadata"}]}, upsert(vectors, namespace), delete(ids, namespace)
+                (the Pinecone Index handle already has this shape)
+- reranker:     rerank(query, docs, top_n) -> [{"index", "relevance_score"}]
+- llm:          chat_model(streaming) -> LangChain chat model (ainvoke / astream for async callers)
+
+Async callers use acall(backend, "embed" | "query" | "rerank", ...): a backend's aembed / aquery /
+arerank coroutine when it has one, otherwise the blocking method on a worker thread. Pinecone
+queries go through PineconeAsyncio (aindex_dense / aindex_sparse).
+
+The live SiliconFlow calls go through post() / apost(): one keep-alive requests.Session per
+process (HTTP_POOL_SIZE connections per host) and one httpx.AsyncClient per event loop (HTTP/2
+when h2 is installed), so a query reuses open connections instead of a TCP + TLS handshake per
+call. Connection errors and 429 / 5xx are retried with jittered backoff within the request budget.
+http_pool_stats() shows how many connections were opened for how many requests.
+
+RAG_BACKEND=live (default) talks to Pinecone / SiliconFlow / OpenAI,
+RAG_BACKEND=fake uses the in-process stand-ins from fake_backends.py,
+RAG_BACKEND=record / replay records upstream responses to disk and replays them (replay_backends.py).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import deadline
+import resources
+from ingestion import RETRYABLE_STATUS, awith_retries, is_retryable, with_retries
+
+EMBED_MODEL = "Qwen/Qwen3-Embedding-8B"
+RERANK_MODEL = "Qwen/Qwen3-Reranker-8B"
+LLM_MODEL = "gpt-4.1-mini"
+# connection pool of the shared async HTTP client
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', '60'))
+ASYNC_HTTP2 = os.getenv('ASYNC_HTTP2', '1') != '0'
+# keep-alive connections per host of the shared session, at least the number of threads
+# calling SiliconFlow at once (RETRIEVAL_WORKERS, EMBED_WORKERS)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '64'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+HTTP_RETRY_DELAY = 0.2
+# SiliconFlow calls, cut to the remaining request budget (deadline.py) inside the pipeline
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '4'))
+
+_async_clients = weakref.WeakKeyDictionary()
+# requests / connections opened / handshake seconds of the async clients
+_async_pool_stats = Counter()
+_async_stats_lock = threading.Lock()
+
+
+def create_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+resources.register("http_session", create_http_session)
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def async_http_client():
+    # pooled keep-alive client of the running event loop (clients can't be shared across loops)
+    import httpx
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS),
+            timeout=ASYNC_HTTP_TIMEOUT,
+            http2=ASYNC_HTTP2 and http2_available()
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def aclose_http_client():
+    # shutdown of an event loop: its httpx client and the async Pinecone clients of the backends
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+    if resources.is_loaded("backends"):
+        backends = resources.get("backends")
+        for index in (backends.aindex_dense, backends.aindex_sparse):
+            if hasattr(index, "aclose"):
+                await index.aclose()
+
+
+def retryable_within(reserve):
+    # retry only while the request budget (minus reserve) has room for another attempt
+    def retryable(error):
+        remaining = deadline.left(reserve)
+        return is_retryable(error) and (remaining is None or remaining > deadline.MIN_STAGE_TIMEOUT)
+    return retryable
+
+
+def post(url, headers, data, reserve=0.0, max_retries=HTTP_MAX_RETRIES):
+    """
+    POST data (serialized JSON) on the shared keep-alive session. Retryable failures are retried
+    with jittered backoff, the last 429 / 5xx is raised as HTTPError. reserve: seconds of the
+    request budget the call must leave free (optional stages).
+    """
+    session = resources.get("http_session")
+
+    def send():
+        response = session.post(url, headers=headers, data=data, timeout=deadline.timeout(HTTP_TIMEOUT, reserve))
+        if response.status_code in RETRYABLE_STATUS:
+            response.raise_for_status()
+        return response
+
+    return with_retries(send, max_retries=max_retries, base_delay=HTTP_RETRY_DELAY, max_delay=2.0,
+                        retryable=retryable_within(reserve))
+
+
+def connection_trace():
+    # httpcore trace hook of one request: counts new connections and their TCP + TLS handshake time
+    started = {}
+
+    async def trace(event, info):
+        if event == "connection.connect_tcp.started":
+            started["at"] = time.perf_counter()
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete") and "at" in started:
+            with _async_stats_lock:
+                if event == "connection.connect_tcp.complete":
+                    _async_pool_stats["connections_opened"] += 1
+                _async_pool_stats["handshake_s"] += time.perf_counter() - started["at"]
+            started["at"] = time.perf_counter()
+    return trace
+
+
+async def apost(url, headers, content, reserve=0.0, max_retries=HTTP_MAX_RETRIES):
+    # post() on the client of the event loop, transport errors raised as requests exceptions
+    import httpx
+
+    async def send():
+        with _async_stats_lock:
+            _async_pool_stats["requests"] += 1
+        try:
+            response = await async_http_client().post(
+                url, headers=headers, content=content,
+                timeout=deadline.timeout(ASYNC_HTTP_TIMEOUT, reserve),
+                extensions={"trace": connection_trace()}
+            )
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(f"{type(e).__name__}: {e}") from e
+        except httpx.HTTPError as e:
+            raise requests.ConnectionError(f"{type(e).__name__}: {e}") from e
+        if response.status_code in RETRYABLE_STATUS:
+            raise requests.HTTPError(f"{response.status_code} - {response.text}", response=response)
+        return response
+
+    return await awith_retries(send, max_retries=max_retries, base_delay=HTTP_RETRY_DELAY, max_delay=2.0,
+                               retryable=retryable_within(reserve))
+
+
+def http_pool_stats():
+    """
+    Connection reuse of the shared clients: requests sent and connections opened (each one a
+    TCP + TLS handshake) per host, idle keep-alive connections. connections_opened staying flat
+    while requests grow means handshakes are off the hot path.
+    """
+    stats = {}
+    if resources.is_loaded("http_session"):
+        pools = resources.get("http_session").get_adapter("https://").poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                "requests": pool.num_requests,
+                "connections_opened": pool.num_connections,
+                # the pool queue is filled with None placeholders for connections not opened yet
+                "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                "pool_size": HTTP_POOL_SIZE,
+            }
+    if _async_pool_stats:
+        with _async_stats_lock:
+            stats["async"] = {**_async_pool_stats, "http2": ASYNC_HTTP2 and http2_available(),
+                              "pool_size": ASYNC_HTTP_MAX_CONNECTIONS}
+    return stats
+
+
+async def acall(backend, name, *args, **kwargs):
+    method = getattr(backend, "a" + name, None)
+    if method is not None:
+        return await method(*args, **kwargs)
+    return await asyncio.to_thread(getattr(backend, name), *args, **kwargs)
+
+
+class SiliconFlowEmbedder:
+    def __init__(self, url, api_key, model=EMBED_MODEL):
+        self.url = url
+        self.model = model
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def payload(self, texts, dim_size):
+        return {
+            "model": self.model,
+            "input": texts,
+            "encoding_format": "float",
+            "dimensions": dim_size
+        }
+
+    @staticmethod
+    def first_embedding(data):
+        # Validasi struktur response
+        if "data" not in data or not data["data"]:
+            raise ValueError("Response JSON tidak memiliki field 'data' atau kosong.")
+
+        if "embedding" not in data["data"][0]:
+            raise ValueError("Field 'embedding' tidak ditemukan di dalam 'data[0]'.")
+
+        return data["data"][0]["embedding"]
+
+    def embed(self, text, dim_size):
+        response = post(self.url, self.headers, json.dumps(self.payload(text, dim_size)))
+        response.raise_for_status()
+        return self.first_embedding(response.json())
+
+    async def aembed(self, text, dim_size):
+        response = await apost(self.url, self.headers, json.dumps(self.payload(text, dim_size)))
+        if response.status_code != 200:
+            raise requests.HTTPError(f"{response.status_code} - {response.text}")
+        return self.first_embedding(response.json())
+
+    def embed_batch(self, texts, dim_size):
+        # one request for a list of inputs, results come back with their input index
+        # (no retries here, embed_texts retries whole batches under its rate limit)
+        response = post(self.url, self.headers, json.dumps(self.payload(texts, dim_size)), max_retries=0)
+        response.raise_for_status()
+        data = response.json().get("data") or []
+        if len(data) != len(texts):
+            raise ValueError(f"Jumlah embedding ({len(data)}) tidak sama dengan jumlah input ({len(texts)}).")
+        return [item["embedding"] for item in sorted(data, key=lambda x: x.get("index", 0))]
+
+
+def build_rerank_payload(query, docs, top_n, model=RERANK_MODEL):
+    return {
+        "model": model,
+        "query": query,
+        "documents": docs,
+        "top_n": top_n,
+        "return_documents": False
+    }
+
+
+class SiliconFlowReranker:
+    def __init__(self, url, api_key, model=RERANK_MODEL):
+        self.url = url
+        self.model = model
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def rerank(self, query, docs, top_n):
+        payload = build_rerank_payload(query, docs, top_n, self.model)
+        # rerank is optional, it never eats into the time kept for generation
+        response = post(self.url, self.headers, json.dumps(payload), reserve=deadline.GENERATION_RESERVE)
+        if response.status_code != 200:
+            raise requests.HTTPError(f"{response.status_code} - {response.text}", response=response)
+        return response.json().get('results', [])
+
+    async def arerank(self, query, docs, top_n):
+        payload = build_rerank_payload(query, docs, top_n, self.model)
+        response = await apost(self.url, self.headers, json.dumps(payload), reserve=deadline.GENERATION_RESERVE)
+        if response.status_code != 200:
+            raise requests.HTTPError(f"{response.status_code} - {response.text}")
+        return response.json().get('results', [])
+
+
+class AsyncPineconeIndex:
+    # aquery() on a PineconeAsyncio index handle, one client and handle (aiohttp session) per event loop
+    def __init__(self, api_key, host):
+        self.api_key = api_key
+        self.host = host
+        # loop -> (client, index)
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _index(self):
+        loop = asyncio.get_running_loop()
+        entry = self._clients.get(loop)
+        if entry is None:
+            from pinecone import PineconeAsyncio
+            client = PineconeAsyncio(api_key=self.api_key)
+            entry = (client, client.IndexAsyncio(host=self.host))
+            self._clients[loop] = entry
+        return entry[1]
+
+    async def aquery(self, **kwargs):
+        return await self._index().query(**kwargs)
+
+    async def aclose(self):
+        # close the handle and client of the running loop (aclose_http_client)
+        entry = self._clients.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            client, index = entry
+            await index.close()
+            await client.close()
+
+
+class OpenAIChat:
+    def __init__(self, model_name=LLM_MODEL, max_retries=LLM_MAX_RETRIES, timeout=LLM_TIMEOUT):
+        self.model_name = model_name
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def chat_model(self, streaming=False):
+        # imported here, langchain_openai is the slowest import of the whole app
+        from langchain_openai import ChatOpenAI
+        # inside a request budget the one attempt gets all that is left of it, retries on top
+        # would let a single request take minutes
+        timeout = deadline.timeout(self.timeout)
+        max_retries = self.max_retries if timeout == self.timeout else 0
+        return ChatOpenAI(model_name=self.model_name, streaming=streaming, max_retries=max_retries, timeout=timeout)
+
+
+class Backends:
+    def __init__(self, kind, embedder, index_dense, index_sparse, reranker, llm, pc=None,
+                 aindex_dense=None, aindex_sparse=None):
+        self.kind = kind
+        self.embedder = embedder
+        self.index_dense = index_dense
+        self.index_sparse = index_sparse
+        # index handles for async queries, the sync ones unless the client needs a separate handle
+        self.aindex_dense = aindex_dense or index_dense
+        self.aindex_sparse = aindex_sparse or index_sparse
+        self.reranker = reranker
+        self.llm = llm
+        # Pinecone client (index management), None for the fake backend
+        self.pc = pc
+
+
+def create_backends(kind=None):
+    kind = kind or os.getenv('RAG_BACKEND', 'live')
+    if kind == 'fake':
+        from fake_backends import create_fake_backends
+        return create_fake_backends()
+    if kind in ('record', 'replay'):
+        from replay_backends import create_tape_backends
+        return create_tape_backends(kind)
+    if kind != 'live':
+        raise ValueError(f"Unknown RAG_BACKEND: {kind}")
+
+    from pinecone.grpc import PineconeGRPC as Pinecone
+    pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
+    return Backends(
+        kind,
+        embedder=SiliconFlowEmbedder(os.getenv('SILICONFLOW_URL_EMBEDDING'), os.getenv('SILICONFLOW_API_KEY')),
+        index_dense=pc.Index(host=os.getenv('HOST_PINECONE_DENSE')),
+        index_sparse=pc.Index(host=os.getenv('HOST_PINECONE_SPARSE')),
+        reranker=SiliconFlowReranker(os.getenv('SILICONFLOW_URL_RERANK'), os.getenv('SILICONFLOW_API_KEY')),
+        llm=OpenAIChat(),
+        pc=pc,
+        aindex_dense=AsyncPineconeIndex(os.getenv('PINECONE_API_KEY'), os.getenv('HOST_PINECONE_DENSE')),
+        aindex_sparse=AsyncPineconeIndex(os.getenv('PINECONE_API_KEY'), os.getenv('HOST_PINECONE_SPARSE'))
+    )
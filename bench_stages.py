@@ -0,0 +1,223 @@
+"""
+Stage-level benchmarks of the RAG pipeline, no network needed.
+
+Microbenchmarks of the CPU-bound stages (rrf_fusion, BM25 encode_queries, parse_matches,
+reranker payload building, prompt assembly) on fixed inputs from the corpus, plus the full
+RAG_pipeline replayed from recorded upstream responses (replay_backends.py).
+
+    python bench_stages.py --record --offline   # record the tape from the fake backends
+    python bench_stages.py --record             # ... or from the live services
+    python bench_stages.py --save-baseline      # store the current numbers as the baseline
+    python bench_stages.py                      # compare with the baseline, exit 1 on a regression
+"""
+import argparse, json, os, platform, statistics, sys, time
+from typing import Any, Callable, Dict, List
+
+from bench_streamlit_only import QUERIES
+
+BASELINE_PATH = "data/bench/baseline.json"
+HISTORY = [
+    {"role": "user", "content": "Apa saja fasilitas di Departemen Ilmu Komputer?"},
+    {"role": "assistant", "content": "Fasilitas di Departemen Ilmu Komputer antara lain laboratorium dan ruang kelas."},
+]
+
+
+def measure(fn: Callable[[], Any], min_time: float, batches: int = 30) -> Dict[str, float]:
+    # per-call time of fn, measured in batches long enough for the timer resolution
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time / batches or loops >= 1 << 20:
+            break
+        loops *= 2
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < batches or time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - t0) / loops)
+    samples.sort()
+    median = statistics.median(samples)
+    return {
+        "median_us": median * 1e6,
+        "p95_us": samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1e6,
+        "ops_per_s": 1.0 / median if median else float("inf"),
+        "calls": len(samples) * loops,
+    }
+
+
+def stage_inputs(search) -> Dict[str, Any]:
+    # fixed inputs: the first corpus records as dense results, an overlapping slice as sparse results
+    records = [r for r in search.read_corpus_records(search.CORPUS_PATH) if r.get("text")][:30]
+    if len(records) < 15:
+        sys.exit(f"corpus {search.CORPUS_PATH} terlalu kecil untuk benchmark")
+    matches = [{"id": r["_id"], "score": 1.0 - i / 100, "metadata": {"text": r["text"], "type": r.get("type", [])}}
+               for i, r in enumerate(records)]
+    dense = search.parse_matches({"matches": matches[:10]})
+    sparse = search.parse_matches({"matches": matches[5:15]})
+    fused = search.merge_fused_results(search.rrf_fusion(dense, sparse), search.rrf_fusion(dense[:5], sparse[:5]))
+    return {
+        "response": {"matches": matches[:search.TOP_K]},
+        "dense": dense,
+        "sparse": sparse,
+        "docs": [r["text"] for r in fused],
+        "contexts": fused[:search.TOP_K],
+    }
+
+
+def micro_stages(search, inputs) -> Dict[str, Callable[[], Any]]:
+    from backends import build_rerank_payload
+    bm25 = search.get_bm25()
+    query = QUERIES[0]
+    return {
+        "rrf_fusion": lambda: search.rrf_fusion(inputs["dense"], inputs["sparse"]),
+        "bm25_encode_queries": lambda: [bm25.encode_queries(q) for q in QUERIES],
+        "parse_matches": lambda: search.parse_matches(inputs["response"]),
+        "rerank_payload": lambda: json.dumps(build_rerank_payload(query, inputs["docs"], search.TOP_K)),
+        "prompt_assembly": lambda: search.build_generation_prompt(query, inputs["contexts"], HISTORY),
+    }
+
+
+def run_pipeline(search, query: str):
+    # streamed answer fully consumed, like the Streamlit app
+    return "".join(getattr(chunk, "content", "") or "" for chunk in search.RAG_pipeline(query, [], streaming=True))
+
+
+def pipeline_replay(search, min_time: float) -> Dict[str, float]:
+    # one sample per query run, so every recorded query is replayed equally often
+    for q in QUERIES:
+        run_pipeline(search, q)
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while time.perf_counter() < deadline or len(samples) < 3 * len(QUERIES):
+        for q in QUERIES:
+            t0 = time.perf_counter()
+            run_pipeline(search, q)
+            samples.append(time.perf_counter() - t0)
+    samples.sort()
+    median = statistics.median(samples)
+    return {
+        "median_us": median * 1e6,
+        "p95_us": samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1e6,
+        "ops_per_s": 1.0 / median,
+        "calls": len(samples),
+    }
+
+
+def record(replay_path: str):
+    os.environ["RAG_BACKEND"] = "record"
+    import search
+    for q in QUERIES:
+        run_pipeline(search, q)
+    tape = search.get_backends().tape
+    tape.save()
+    print(f"{len(tape.entries)} respons direkam ke {replay_path} dari backend {os.getenv('RECORD_BACKEND', 'live')}")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    # stages whose median got slower than the baseline by more than their threshold
+    thresholds = baseline.get("thresholds", {})
+    regressions = []
+    print(f"\n{'stage':<22}{'baseline':>12}{'now':>12}{'change':>9}")
+    for name, now in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            print(f"{name:<22}{'-':>12}{now['median_us']:>10.1f}us{'new':>9}")
+            continue
+        change = now["median_us"] / base["median_us"] - 1
+        limit = thresholds.get(name, threshold)
+        flag = " REGRESSION" if change > limit else ""
+        print(f"{name:<22}{base['median_us']:>10.1f}us{now['median_us']:>10.1f}us{change * 100:>+8.1f}%{flag}")
+        if flag:
+            regressions.append(f"{name}: {change * 100:+.1f}% (batas {limit * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--record", action="store_true", help="rekam respons upstream ke REPLAY_PATH lalu keluar")
+    ap.add_argument("--offline", action="store_true", help="rekam dari backend palsu (RECORD_BACKEND=fake), tanpa jaringan")
+    ap.add_argument("--replay-path", default=None, help="file rekaman (default REPLAY_PATH atau data/bench/replay.json)")
+    ap.add_argument("--stages", nargs="+", default=None, help="hanya jalankan stage ini")
+    ap.add_argument("--min-time", type=float, default=1.0, help="detik pengukuran per stage")
+    ap.add_argument("--output", default=None, help="tulis hasil (JSON) ke file ini")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--save-baseline", action="store_true", help="simpan hasil sebagai baseline baru")
+    ap.add_argument("--threshold", type=float, default=0.25, help="kenaikan median maksimum sebelum dianggap regresi")
+    args = ap.parse_args()
+
+    if args.replay_path:
+        os.environ["REPLAY_PATH"] = args.replay_path
+    replay_path = os.getenv("REPLAY_PATH", "data/bench/replay.json")
+    os.environ.setdefault("TRACE_LOG", "0")
+    if args.record:
+        if args.offline:
+            os.environ["RECORD_BACKEND"] = "fake"
+        record(replay_path)
+        return
+
+    os.environ["RAG_BACKEND"] = "replay"
+    # import after the backend is chosen, search reads its config at import time
+    import search
+
+    stages = micro_stages(search, stage_inputs(search))
+    selected = args.stages or list(stages) + ["pipeline_replay"]
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "replay_path": replay_path,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": {},
+    }
+    print(f"{'stage':<22}{'median':>12}{'p95':>12}{'ops/s':>12}")
+    for name in selected:
+        if name == "pipeline_replay":
+            if not os.path.isfile(replay_path):
+                print(f"WARN: {replay_path} tidak ada, pipeline_replay dilewati (rekam dengan --record)")
+                continue
+            stat = pipeline_replay(search, args.min_time)
+        elif name in stages:
+            stat = measure(stages[name], args.min_time)
+        else:
+            sys.exit(f"stage tidak dikenal: {name}")
+        results["stages"][name] = stat
+        print(f"{name:<22}{stat['median_us']:>10.1f}us{stat['p95_us']:>10.1f}us{stat['ops_per_s']:>12.0f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"hasil ditulis ke {args.output}")
+
+    if args.save_baseline:
+        # thresholds set by hand in the old baseline are kept
+        thresholds = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                thresholds = json.load(f).get("thresholds", {})
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({**results, "thresholds": thresholds}, f, indent=2)
+        print(f"baseline disimpan ke {args.baseline}")
+        return
+    if not os.path.isfile(args.baseline):
+        print(f"WARN: baseline {args.baseline} tidak ada, simpan dulu dengan --save-baseline")
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("\nRegresi performa:")
+        for r in regressions:
+            print(" -", r)
+        sys.exit(1)
+    print("\nTidak ada regresi")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
-import argparse, concurrent.futures, random, time, traceback
-from typing import List, Dict, Any
-from search import RAG_pipeline
+import argparse, asyncio, concurrent.futures, json, math, os, random, threading, time, traceback
+from typing import List, Dict, Any, Optional, Tuple
+
+RAG_pipeline = None
+arag_pipeline = None
+Trace = None
 
 QUERIES = [
     "Apa saja fasilitas di Departemen Ilmu Komputer?",
@@ -12,16 +15,23 @@ QUERIES = [
     "Informasi beasiswa untuk mahasiswa Ilkom",
     "Profil lulusan dan capaian pembelajaran",
 ]
+# same cut as web_chatbot.py
+MAX_TURNS = 10
 
 
-def bench_one(query: str, timeout: float) -> Dict[str, Any]:
+def bench_one(query: str, timeout: float, chat_history: Optional[list] = None,
+              scheduled: Optional[float] = None) -> Dict[str, Any]:
+    # scheduled: intended start (open loop), latencies are also measured from it
     t0 = time.perf_counter()
     ttft = None
     total_tokens = 0
     ok = True
     err = None
+    stage = None
+    trace = Trace("bench")
     try:
-        stream = RAG_pipeline(query=query, chat_history=[], streaming=True)
+        stream = RAG_pipeline(query=query, chat_history=chat_history or [], streaming=True, trace=trace)
+        stage = "generation"
         last_yield = t0
         for chunk in stream:
             delta = getattr(chunk, "content", None)
@@ -36,6 +46,8 @@ def bench_one(query: str, timeout: float) -> Dict[str, Any]:
                 ok = False
                 err = f"timeout>{timeout}s"
                 break
+        # finishes the trace when the loop stopped early
+        stream.close()
         t1 = time.perf_counter()
         total = t1 - t0
     except Exception as e:
@@ -43,13 +55,63 @@ def bench_one(query: str, timeout: float) -> Dict[str, Any]:
         err = f"{type(e).__name__}: {e}"
         total = time.perf_counter() - t0
         ttft = ttft
+        stage = trace.error_stage() or stage or "pipeline"
+    return result_row(query, chat_history, trace, ok, err, stage, ttft, total, total_tokens, t0, scheduled)
+
+
+async def abench_one(query: str, timeout: float, chat_history: Optional[list] = None,
+                     scheduled: Optional[float] = None) -> Dict[str, Any]:
+    # bench_one through arag_pipeline, on the event loop
+    t0 = time.perf_counter()
+    ttft = None
+    total_tokens = 0
+    ok = True
+    err = None
+    stage = None
+    trace = Trace("bench")
+    try:
+        stream = await arag_pipeline(query=query, chat_history=chat_history or [], streaming=True, trace=trace)
+        stage = "generation"
+        async for chunk in stream:
+            delta = getattr(chunk, "content", None)
+            if not delta:
+                continue
+            total_tokens += len(delta)
+            now = time.perf_counter()
+            if ttft is None:
+                ttft = now - t0
+            if timeout and (now - t0) > timeout:
+                ok = False
+                err = f"timeout>{timeout}s"
+                break
+        await stream.aclose()
+        total = time.perf_counter() - t0
+    except Exception as e:
+        ok = False
+        err = f"{type(e).__name__}: {e}"
+        total = time.perf_counter() - t0
+        stage = trace.error_stage() or stage or "pipeline"
+    return result_row(query, chat_history, trace, ok, err, stage, ttft, total, total_tokens, t0, scheduled)
+
+
+def result_row(query, chat_history, trace, ok, err, stage, ttft, total, tokens, t0, scheduled) -> Dict[str, Any]:
+    queue_delay = t0 - scheduled if scheduled is not None else 0.0
     return {
         "ok": ok,
         "ttft": ttft if ttft is not None else float("inf"),
         "total": total,
-        "tokens": total_tokens,
+        # coordinated-omission corrected: from the intended start, waiting for a worker included
+        "ttft_corrected": ttft + queue_delay if ttft is not None else float("inf"),
+        "total_corrected": total + queue_delay,
+        "queue_delay": queue_delay,
+        "finished": t0 + total,
+        "tokens": tokens,
         "error": err,
+        "error_stage": stage if not ok else None,
         "query": query,
+        "history_turns": len(chat_history or []),
+        "stages": trace.stage_durations(),
+        "fallbacks": trace.fallbacks(),
     }
 
 
@@ -61,27 +123,353 @@ def percentile(vals: List[float], p: float) -> float:
     return s[k]
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--concurrency", type=int, default=10)
-    ap.add_argument("--requests", type=int, default=100)
-    ap.add_argument("--timeout", type=float, default=90.0, help="timeout per request (detik)")
-    args = ap.parse_args()
+class LatencyHistogram:
+    """
+    HDR-style histogram in microseconds: values below 128 us are exact, above that every
+    power of two is split into 64 linear buckets, so percentiles are within 1.6%.
+    """
+    SUB_BUCKETS = 64
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.max = 0
+
+    def _index(self, value: int) -> int:
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 7
+        return shift * self.SUB_BUCKETS + (value >> shift)
+
+    def _upper(self, index: int) -> int:
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = (index - 2 * self.SUB_BUCKETS) // self.SUB_BUCKETS + 1
+        return ((index - shift * self.SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, seconds: float):
+        if seconds == float("inf"):
+            return
+        value = max(0, int(seconds * 1e6))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        # seconds
+        if not self.count:
+            return float("nan")
+        rank = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def summary(self) -> Dict[str, float]:
+        return {f"p{p:g}": self.percentile(p) for p in (50, 90, 99, 99.9)} | {"max": self.max / 1e6, "count": self.count}
+
+
+def histogram_of(results: List[Dict[str, Any]], key: str) -> LatencyHistogram:
+    h = LatencyHistogram()
+    for r in results:
+        h.record(r[key])
+    return h
+
+
+def print_stage_table(results: List[Dict[str, Any]]):
+    # per-stage latency from the request traces, slowest p95 first
+    stages: Dict[str, List[float]] = {}
+    for r in results:
+        for name, sec in r["stages"].items():
+            stages.setdefault(name, []).append(sec)
+    rows = sorted(stages.items(), key=lambda kv: percentile(kv[1], 95), reverse=True)
+    print(f"\n{'stage':<14}{'n':>6}{'p50':>10}{'p95':>10}{'max':>10}")
+    for name, vals in rows:
+        print(f"{name:<14}{len(vals):>6}{percentile(vals, 50)*1000:>8.0f}ms{percentile(vals, 95)*1000:>8.0f}ms{max(vals)*1000:>8.0f}ms")
 
-    print(f"Running bench: concurrency={args.concurrency} requests={args.requests}")
 
+def print_histograms(results: List[Dict[str, Any]], keys: List[str]) -> Dict[str, Dict[str, float]]:
+    summaries = {key: histogram_of(results, key).summary() for key in keys}
+    print(f"\n{'latency':<16}{'p50':>10}{'p90':>10}{'p99':>10}{'p99.9':>10}{'max':>10}")
+    for key, s in summaries.items():
+        cols = "".join(f"{s[p]*1000:>8.0f}ms" for p in ("p50", "p90", "p99", "p99.9", "max"))
+        print(f"{key:<16}{cols}")
+    return summaries
+
+
+def timeline(results: List[Dict[str, Any]], arrivals: List[float], start: float) -> List[Dict[str, Any]]:
+    # per second since start: arrivals, completions, errors and corrected latency of the completions
+    seconds: Dict[int, Dict[str, Any]] = {}
+    def row(sec):
+        return seconds.setdefault(sec, {"second": sec, "arrivals": 0, "completed": 0, "errors": 0, "latencies": []})
+    for offset in arrivals:
+        row(int(offset))["arrivals"] += 1
+    for r in results:
+        bucket = row(int(r["finished"] - start))
+        bucket["completed"] += 1
+        if r["ok"]:
+            bucket["latencies"].append(r["total_corrected"])
+        else:
+            bucket["errors"] += 1
+    rows = []
+    for sec in range(max(seconds) + 1 if seconds else 0):
+        bucket = row(sec)
+        latencies = bucket.pop("latencies")
+        bucket["p50"] = percentile(latencies, 50)
+        bucket["p99"] = percentile(latencies, 99)
+        rows.append(bucket)
+    return rows
+
+
+def print_timeline(rows: List[Dict[str, Any]]):
+    print(f"\n{'sec':>5}{'arrivals':>10}{'done':>8}{'errors':>8}{'p50':>10}{'p99':>10}")
+    for r in rows:
+        p50 = f"{r['p50']*1000:>8.0f}ms" if r["p50"] == r["p50"] else f"{'-':>10}"
+        p99 = f"{r['p99']*1000:>8.0f}ms" if r["p99"] == r["p99"] else f"{'-':>10}"
+        print(f"{r['second']:>5}{r['arrivals']:>10}{r['completed']:>8}{r['errors']:>8}{p50}{p99}")
+
+
+def error_breakdown(results: List[Dict[str, Any]]) -> Dict[str, int]:
+    # "<stage> <error type>" -> count
+    counts: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            key = f"{r['error_stage']} {r['error'].split(':')[0]}"
+            counts[key] = counts.get(key, 0) + 1
+    return dict(sorted(counts.items(), key=lambda kv: kv[1], reverse=True))
+
+
+def fallback_counts(results: List[Dict[str, Any]]) -> Dict[str, int]:
+    # skipped stage -> number of requests that answered without it
+    counts: Dict[str, int] = {}
+    for r in results:
+        for stage in set(r.get("fallbacks", [])):
+            counts[stage] = counts.get(stage, 0) + 1
+    return dict(sorted(counts.items(), key=lambda kv: kv[1], reverse=True))
+
+
+def load_conversations(path: str, turns: int) -> List[List[Tuple[str, str]]]:
+    """
+    Conversations of up to `turns` (question, answer) pairs from an eval file (data/eval/*.json),
+    consecutive questions of the same type form one conversation.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    conversations, current, current_type = [], [], None
+    for item in items:
+        if not item.get("query"):
+            continue
+        if current and (item.get("type") != current_type or len(current) >= turns):
+            conversations.append(current)
+            current = []
+        current_type = item.get("type")
+        current.append((item["query"], item.get("gold_answer") or ""))
+    if current:
+        conversations.append(current)
+    return conversations
+
+
+def sample_request(conversations: Optional[List[List[Tuple[str, str]]]], rng: random.Random):
+    # (query, chat_history): a random turn of a random conversation with the turns before it as history
+    if not conversations:
+        return rng.choice(QUERIES), []
+    from langchain_core.messages import AIMessage, HumanMessage
+    conversation = rng.choice(conversations)
+    turn = rng.randrange(len(conversation))
+    history = []
+    for question, answer in conversation[:turn]:
+        history += [HumanMessage(question), AIMessage(answer)]
+    return conversation[turn][0], history[-MAX_TURNS:]
+
+
+def parse_schedule(spec: str) -> List[Tuple[float, float]]:
+    # "2:30,5:30,10:60" -> [(2 req/s, 30 s), (5, 30), (10, 60)]
+    steps = []
+    for part in spec.split(","):
+        rate, seconds = part.split(":")
+        steps.append((float(rate), float(seconds)))
+    return steps
+
+
+def arrival_times(steps: List[Tuple[float, float]], ramp_up: float, arrival: str,
+                  rng: random.Random, dt: float = 0.001) -> List[float]:
+    """
+    Intended start offsets (seconds) for an open-loop run: the rate rises linearly from 0 to
+    the first step's rate over ramp_up seconds, then follows the steps. "constant" spaces
+    requests evenly, "poisson" draws exponential gaps (in expected requests) from the rate.
+    """
+    def rate_at(t):
+        if t < ramp_up:
+            return steps[0][0] * t / ramp_up
+        t -= ramp_up
+        for rate, seconds in steps:
+            if t < seconds:
+                return rate
+            t -= seconds
+        return 0.0
+
+    total = ramp_up + sum(seconds for _, seconds in steps)
+    next_gap = lambda: rng.expovariate(1.0) if arrival == "poisson" else 1.0
+    times, expected, target, t = [], 0.0, next_gap(), 0.0
+    while t < total:
+        # integrate the rate until the expected request count reaches the next arrival
+        expected += rate_at(t + dt / 2) * dt
+        t += dt
+        while expected >= target:
+            times.append(t)
+            target += next_gap()
+    return times
+
+
+def run_closed(args, conversations, rng) -> Tuple[List[Dict[str, Any]], List[float], float]:
     results = []
     start = time.perf_counter()
     with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as ex:
         futs = []
         for i in range(args.requests):
-            q = random.choice(QUERIES)
-            futs.append(ex.submit(bench_one, q, args.timeout))
+            q, history = sample_request(conversations, rng)
+            futs.append(ex.submit(bench_one, q, args.timeout, history))
         for fu in concurrent.futures.as_completed(futs):
             try:
                 results.append(fu.result())
             except Exception:
                 traceback.print_exc()
+    return results, [], start
+
+
+def run_open(args, conversations, rng) -> Tuple[List[Dict[str, Any]], List[float], float]:
+    """
+    Requests start at their scheduled time whether or not earlier ones finished. When all
+    --max-in-flight workers are busy a request waits for one, and that wait is part of its
+    corrected latency instead of silently lowering the offered rate.
+    """
+    steps = parse_schedule(args.schedule) if args.schedule else [(args.rate, args.duration)]
+    arrivals = arrival_times(steps, args.ramp_up, args.arrival, rng)
+    print(f"open loop: {len(arrivals)} requests over {args.ramp_up + sum(s for _, s in steps):.0f}s, "
+          f"arrival={args.arrival}, steps={steps}, ramp_up={args.ramp_up}s")
+    results = []
+    lock = threading.Lock()
+    def done(fu):
+        try:
+            r = fu.result()
+        except Exception:
+            traceback.print_exc()
+            return
+        with lock:
+            results.append(r)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_in_flight) as ex:
+        for offset in arrivals:
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            q, history = sample_request(conversations, rng)
+            ex.submit(bench_one, q, args.timeout, history, scheduled).add_done_callback(done)
+    return results, arrivals, start
+
+
+async def run_async(args, conversations, rng, open_loop) -> Tuple[List[Dict[str, Any]], List[float], float]:
+    """
+    run_closed / run_open with arag_pipeline: every request is a task on one event loop,
+    at most --concurrency (closed) or --max-in-flight (open) of them inside the pipeline.
+    """
+    arrivals = []
+    if open_loop:
+        steps = parse_schedule(args.schedule) if args.schedule else [(args.rate, args.duration)]
+        arrivals = arrival_times(steps, args.ramp_up, args.arrival, rng)
+        print(f"open loop: {len(arrivals)} requests over {args.ramp_up + sum(s for _, s in steps):.0f}s, "
+              f"arrival={args.arrival}, steps={steps}, ramp_up={args.ramp_up}s")
+    slots = asyncio.Semaphore(args.max_in_flight if open_loop else args.concurrency)
+
+    async def one(q, history, scheduled=None):
+        async with slots:
+            return await abench_one(q, args.timeout, history, scheduled)
+
+    tasks = []
+    start = time.perf_counter()
+    if open_loop:
+        for offset in arrivals:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            q, history = sample_request(conversations, rng)
+            tasks.append(asyncio.create_task(one(q, history, start + offset)))
+    else:
+        for _ in range(args.requests):
+            q, history = sample_request(conversations, rng)
+            tasks.append(asyncio.create_task(one(q, history)))
+    results = []
+    for r in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(r, BaseException):
+            traceback.print_exception(r)
+        else:
+            results.append(r)
+    # clients of this loop (httpx, PineconeAsyncio) are closed before asyncio.run closes it
+    from backends import aclose_http_client
+    await aclose_http_client()
+    return results, arrivals, start
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--requests", type=int, default=100)
+    ap.add_argument("--timeout", type=float, default=90.0, help="timeout per request (detik)")
+    ap.add_argument("--offline", action="store_true", help="pakai backend palsu in-process (RAG_BACKEND=fake), tanpa jaringan")
+    ap.add_argument("--fake-latency", default=None, help='latency backend palsu (detik), contoh: "embed=0.15,vector=0.04,rerank=0.3,llm_first=0.4,llm_token=0.01"')
+    ap.add_argument("--rate", type=float, default=None, help="open loop: request per detik (tanpa ini closed loop dengan --concurrency)")
+    ap.add_argument("--duration", type=float, default=60.0, help="open loop: lama run (detik) setelah ramp-up")
+    ap.add_argument("--ramp-up", type=float, default=0.0, help="open loop: detik untuk naik linear dari 0 ke rate pertama")
+    ap.add_argument("--schedule", default=None, help='open loop: tahapan "rate:detik,...", contoh "2:30,5:30,10:60" (menggantikan --rate/--duration)')
+    ap.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    ap.add_argument("--max-in-flight", type=int, default=512, help="open loop: worker maksimum, request berikutnya antre")
+    ap.add_argument("--conversations", default=None, help="file eval (data/eval/*.json): query dengan riwayat obrolan dari percakapan")
+    ap.add_argument("--turns", type=int, default=4, help="giliran maksimum per percakapan dari --conversations")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--api", default=None, help="kirim request ke API (api.py) di URL ini, contoh http://localhost:8000")
+    ap.add_argument("--async", dest="use_async", action="store_true", help="pakai arag_pipeline di satu event loop, bukan thread per request")
+    ap.add_argument("--output", default=None, help="tulis ringkasan, histogram, timeline dan error (JSON) ke file ini")
+    args = ap.parse_args()
+    open_loop = args.rate is not None or args.schedule is not None
+
+    if args.offline:
+        os.environ["RAG_BACKEND"] = "fake"
+    if args.fake_latency is not None:
+        os.environ["FAKE_LATENCY"] = args.fake_latency
+    # per-request trace lines would drown the summary
+    os.environ.setdefault("TRACE_LOG", "0")
+    # import after the backend is chosen, search creates its clients at import time
+    global RAG_pipeline, arag_pipeline, Trace
+    from tracing import Trace
+    if args.api:
+        # the serving path: HTTP + SSE, stage timings come from the server's trace
+        from api_client import stream_chat
+        RAG_pipeline = lambda **kwargs: stream_chat(api_url=args.api, **kwargs)
+        if args.use_async:
+            ap.error("--api tidak bisa dipakai bersama --async")
+    else:
+        from search import RAG_pipeline, arag_pipeline
+
+    rng = random.Random(args.seed)
+    conversations = load_conversations(args.conversations, args.turns) if args.conversations else None
+    if conversations:
+        print(f"{len(conversations)} percakapan dari {args.conversations}")
+
+    if open_loop:
+        print(f"Running bench: open loop max_in_flight={args.max_in_flight} backend={args.api or os.getenv('RAG_BACKEND', 'live')} async={args.use_async}")
+    else:
+        print(f"Running bench: concurrency={args.concurrency} requests={args.requests} backend={args.api or os.getenv('RAG_BACKEND', 'live')} async={args.use_async}")
+    if args.use_async:
+        results, arrivals, start = asyncio.run(run_async(args, conversations, rng, open_loop))
+    elif open_loop:
+        results, arrivals, start = run_open(args, conversations, rng)
+    else:
+        results, arrivals, start = run_closed(args, conversations, rng)
     duration = time.perf_counter() - start
 
     ok = [r for r in results if r["ok"]]
@@ -93,20 +481,53 @@ def main():
         return f"{x*1000:.0f} ms"
 
     print("\n==== Summary (Streamlit-only / RAG_pipeline) ====")
-    print({
+    summary = {
         "requests": len(results),
         "success": len(ok),
         "errors": len(errs),
         "duration_s": round(duration, 2),
         "rps": round(len(results)/duration, 2) if duration > 0 else None,
-    })
+    }
+    if open_loop:
+        summary["offered_rps"] = round(len(arrivals) / max(arrivals[-1], 1e-9), 2) if arrivals else None
+    print(summary)
+    report: Dict[str, Any] = {"mode": "open" if open_loop else "closed", "args": vars(args), "summary": summary}
     if ok:
         print("TTFT:", {"p50": fmt(percentile(ttfts,50)), "p95": fmt(percentile(ttfts,95)), "max": fmt(max(ttfts))})
         print("Total:", {"p50": fmt(percentile(totals,50)), "p95": fmt(percentile(totals,95)), "max": fmt(max(totals))})
+        keys = ["ttft", "total"] + (["ttft_corrected", "total_corrected", "queue_delay"] if open_loop else [])
+        report["histograms"] = print_histograms(ok, keys)
+    if ok:
+        print_stage_table(ok)
+        report["fallbacks"] = fallback_counts(ok)
+        if report["fallbacks"]:
+            print("\nFallbacks (skipped stages):")
+            for stage, n in report["fallbacks"].items():
+                print(f" - {stage}: {n}/{len(ok)}")
+    if open_loop:
+        report["timeline"] = timeline(results, arrivals, start)
+        print_timeline(report["timeline"])
+    if errs:
+        report["errors_by_stage"] = error_breakdown(errs)
+        print("\nErrors by stage:")
+        for key, n in report["errors_by_stage"].items():
+            print(f" - {key}: {n}")
     if errs[:5]:
         print("Sample errors:")
         for e in errs[:5]:
             print(" -", e["error"])
+    if not args.api:
+        # connections opened vs requests sent to SiliconFlow (live backend only)
+        from backends import http_pool_stats
+        report["http_pools"] = http_pool_stats()
+        if report["http_pools"]:
+            print("\nHTTP connection pools:")
+            for host, pool in report["http_pools"].items():
+                print(f" - {host}: {pool}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"hasil ditulis ke {args.output}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
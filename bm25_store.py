@@ -0,0 +1,114 @@
+"""
+Compact binary storage for BM25Encoder params.
+doc_freq is stored as two sorted .npy arrays (uint32 term hashes, uint32 counts) that are
+memory-mapped on load, so worker processes share them through the page cache instead of
+each parsing the JSON dump into a dict. Scalar params go to params.json next to them.
+"""
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+BM25_JSON_PATH = "model/bm25_params.json"
+BM25_BINARY_PATH = "model/bm25_params"
+
+
+class DocFreqView:
+    # read-only dict look-alike over the sorted arrays, enough for BM25Encoder (get / items)
+
+    def __init__(self, indices, values):
+        self.indices = indices
+        self.values = values
+
+    def get(self, key, default=None):
+        pos = int(np.searchsorted(self.indices, key))
+        if pos < len(self.indices) and self.indices[pos] == key:
+            return int(self.values[pos])
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def items(self):
+        return zip(self.indices.tolist(), self.values.tolist())
+
+
+class BM25Stats:
+    """
+    Incremental BM25Encoder.fit: add() tokenizes one document, updates the corpus statistics
+    and returns its (indices, tf), so the document vector can be computed with encode_tf()
+    once apply() has set the final avgdl, without tokenizing the text again.
+    """
+
+    def __init__(self, bm25):
+        self.bm25 = bm25
+        self.n_docs = 0
+        self.sum_doc_len = 0
+        self.doc_freq = Counter()
+
+    def add(self, text):
+        indices, tf = self.bm25._tf(text)
+        # BM25Encoder.fit skips documents without tokens as well
+        if indices:
+            self.n_docs += 1
+            self.sum_doc_len += sum(tf)
+            self.doc_freq.update(indices)
+        return indices, tf
+
+    def apply(self):
+        if self.n_docs == 0:
+            raise ValueError("BM25 tidak bisa di-fit: tidak ada dokumen dengan token di korpus")
+        self.bm25.doc_freq = dict(self.doc_freq)
+        self.bm25.n_docs = self.n_docs
+        self.bm25.avgdl = self.sum_doc_len / self.n_docs
+        return self.bm25
+
+
+def encode_tf(bm25, indices, tf):
+    # same vector as bm25.encode_documents(text) for the (indices, tf) of text
+    tf = np.array(tf)
+    tf_normed = tf / (bm25.k1 * (1.0 - bm25.b + bm25.b * (sum(tf) / bm25.avgdl)) + tf)
+    return {"indices": indices, "values": tf_normed.tolist()}
+
+
+def dump_bm25_binary(bm25, path=BM25_BINARY_PATH):
+    params = bm25.get_params()
+    doc_freq = params.pop("doc_freq")
+    indices = np.asarray(doc_freq["indices"], dtype=np.uint32)
+    values = np.asarray(doc_freq["values"], dtype=np.uint32)
+    order = np.argsort(indices)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "doc_freq_indices.npy"), indices[order])
+    np.save(os.path.join(path, "doc_freq_values.npy"), values[order])
+    with open(os.path.join(path, "params.json"), "w") as f:
+        json.dump(params, f)
+
+
+def load_bm25_binary(bm25, path=BM25_BINARY_PATH):
+    with open(os.path.join(path, "params.json"), "r") as f:
+        params = json.load(f)
+    # set_params needs a doc_freq, the real one is swapped in right after
+    bm25.set_params(doc_freq={"indices": [], "values": []}, **params)
+    bm25.doc_freq = DocFreqView(
+        np.load(os.path.join(path, "doc_freq_indices.npy"), mmap_mode="r"),
+        np.load(os.path.join(path, "doc_freq_values.npy"), mmap_mode="r")
+    )
+    return bm25
+
+
+def load_bm25_params(bm25, binary_path=BM25_BINARY_PATH, json_path=BM25_JSON_PATH):
+    # prefer the binary artifact, fall back to the JSON dump
+    if os.path.isfile(os.path.join(binary_path, "params.json")):
+        return load_bm25_binary(bm25, binary_path)
+    return bm25.load(json_path)
@@ -0,0 +1,156 @@
+"""
+Chunked, pipelined upserts into the dense and sparse indexes.
+Vectors are cut into batches of at most UPSERT_BATCH_SIZE vectors and UPSERT_MAX_BYTES
+(estimated request size, Pinecone rejects requests over 2 MB). Batches from every index
+share a pool of UPSERT_WORKERS threads; at most UPSERT_MAX_IN_FLIGHT batches are queued or
+running, add() blocks beyond that, so the producer (embedding) cannot run far ahead of the
+writes. Each batch is retried on its own; ids of batches that still fail are reported.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ingestion import with_retries
+
+UPSERT_BATCH_SIZE = int(os.getenv('UPSERT_BATCH_SIZE', '100'))
+UPSERT_MAX_BYTES = int(os.getenv('UPSERT_MAX_BYTES', '1800000'))
+UPSERT_WORKERS = int(os.getenv('UPSERT_WORKERS', '4'))
+UPSERT_MAX_IN_FLIGHT = int(os.getenv('UPSERT_MAX_IN_FLIGHT', '8'))
+UPSERT_MAX_RETRIES = int(os.getenv('UPSERT_MAX_RETRIES', '5'))
+
+
+def vector_size(vector):
+    # rough request size: 4 bytes per float, 8 per sparse (index, value) pair, metadata as json
+    size = len(vector["id"].encode("utf-8")) + 4 * len(vector.get("values") or [])
+    sparse = vector.get("sparse_values")
+    if sparse:
+        size += 8 * len(sparse.get("indices", []))
+    if vector.get("metadata"):
+        size += len(json.dumps(vector["metadata"], ensure_ascii=False).encode("utf-8"))
+    return size + 16
+
+
+def iter_batches(vectors, max_vectors=UPSERT_BATCH_SIZE, max_bytes=UPSERT_MAX_BYTES):
+    # yields (batch, estimated bytes); a vector larger than max_bytes goes alone in its batch
+    batch, batch_bytes = [], 0
+    for vector in vectors:
+        size = vector_size(vector)
+        if batch and (len(batch) >= max_vectors or batch_bytes + size > max_bytes):
+            yield batch, batch_bytes
+            batch, batch_bytes = [], 0
+        batch.append(vector)
+        batch_bytes += size
+    if batch:
+        yield batch, batch_bytes
+
+
+def is_upsert_retryable(error):
+    # malformed payloads (Pinecone raises ValueError subclasses for those) will not succeed on retry
+    return not isinstance(error, (ValueError, TypeError, KeyError))
+
+
+class BulkWriter:
+    """
+    Usage:
+        with BulkWriter(namespace) as writer:
+            writer.add("dense", index_dense, dense_vectors)
+            writer.add("sparse", index_sparse, sparse_vectors)
+        print(writer.format_report())
+    """
+
+    def __init__(self, namespace=None, max_vectors=UPSERT_BATCH_SIZE, max_bytes=UPSERT_MAX_BYTES,
+                 max_workers=UPSERT_WORKERS, max_in_flight=UPSERT_MAX_IN_FLIGHT,
+                 max_retries=UPSERT_MAX_RETRIES, base_delay=0.5):
+        self.namespace = namespace
+        self.max_vectors = max_vectors
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upsert")
+        self.window = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.futures = []
+        self.stats = {}
+        self.failed_ids = {}
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def _stats(self, name):
+        return self.stats.setdefault(name, {"vectors": 0, "bytes": 0, "batches": 0, "retries": 0, "failed": 0})
+
+    def add(self, name, index, vectors):
+        # queue vectors for index; blocks while max_in_flight batches are pending
+        for batch, size in iter_batches(vectors, self.max_vectors, self.max_bytes):
+            self.window.acquire()
+            try:
+                self.futures.append(self.pool.submit(self._upsert, name, index, batch, size))
+            except Exception:
+                self.window.release()
+                raise
+
+    def _upsert(self, name, index, batch, size):
+        attempts = 0
+
+        def call():
+            nonlocal attempts
+            attempts += 1
+            return index.upsert(vectors=batch, namespace=self.namespace)
+
+        try:
+            with_retries(call, max_retries=self.max_retries, base_delay=self.base_delay,
+                         retryable=is_upsert_retryable)
+            ok = True
+        except Exception as e:
+            print(f"Error upsert {name} batch of {len(batch)} ({size} bytes): {e}")
+            ok = False
+        finally:
+            self.window.release()
+
+        with self._lock:
+            stats = self._stats(name)
+            stats["batches"] += 1
+            stats["retries"] += attempts - 1
+            if ok:
+                stats["vectors"] += len(batch)
+                stats["bytes"] += size
+            else:
+                stats["failed"] += len(batch)
+                self.failed_ids.setdefault(name, set()).update(v["id"] for v in batch)
+
+    def close(self):
+        # wait for every queued batch, returns the report
+        for future in self.futures:
+            future.result()
+        self.pool.shutdown()
+        self.elapsed = time.perf_counter() - self.started
+        return self.report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def report(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        report = {"elapsed": elapsed, "indexes": {}}
+        for name, stats in self.stats.items():
+            report["indexes"][name] = dict(
+                stats,
+                vectors_per_s=stats["vectors"] / elapsed if elapsed else 0.0,
+                bytes_per_s=stats["bytes"] / elapsed if elapsed else 0.0
+            )
+        return report
+
+    def format_report(self):
+        report = self.report()
+        lines = [f"upsert done in {report['elapsed']:.2f}s"]
+        for name, s in report["indexes"].items():
+            lines.append(
+                f"  {name:<7} {s['vectors']} vectors in {s['batches']} batches, "
+                f"{s['vectors_per_s']:.1f} vectors/s, {s['bytes_per_s'] / 1e6:.2f} MB/s, "
+                f"retries={s['retries']}, failed={s['failed']}"
+            )
+        return "\n".join(lines)
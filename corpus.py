@@ -0,0 +1,123 @@
+"""
+Streaming reader for the knowledge base in data/final_id.
+Files are either a JSON array of records (*.json) or one record per line (*.jsonl). Arrays
+are decoded one element at a time from fixed-size reads, so a file is never fully loaded
+or parsed twice. Records must have a string "_id" and "text"; others are skipped.
+"""
+import json
+import os
+from itertools import islice
+
+READ_CHUNK_SIZE = 1 << 16
+CORPUS_EXTENSIONS = (".json", ".jsonl")
+
+
+def corpus_files(folder_path):
+    if not os.path.isdir(folder_path):
+        return []
+    return [
+        os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path))
+        if len(filename.split('.')) == 2 and os.path.splitext(filename)[1] in CORPUS_EXTENSIONS
+    ]
+
+
+def iter_json_array(file, chunk_size=READ_CHUNK_SIZE):
+    # yields the elements of a top-level JSON array while reading file in chunks
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    started = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = file.read(max(chunk_size, len(buf) - pos))
+        eof = not data
+        buf, pos = buf[pos:] + data, 0
+
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise json.JSONDecodeError("Unexpected end of array", buf, pos)
+            fill()
+            continue
+
+        if not started:
+            if buf[pos] != "[":
+                raise json.JSONDecodeError("Expected a JSON array", buf, pos)
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+        if buf[pos] == ",":
+            pos += 1
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        if end == len(buf) and not eof:
+            # a number may continue in the next chunk
+            fill()
+            continue
+        pos = end
+        yield value
+
+
+def iter_jsonl(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def is_valid_record(item):
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get('_id'), str)
+        and isinstance(item.get('text'), str)
+        and isinstance(item.get('type', []), list)
+    )
+
+
+def iter_file_records(file_path, strict=False):
+    # strict: missing or malformed files raise instead of ending the file early, for callers
+    # that must not mistake a partial read for the whole corpus (sync deletes what it does not see)
+    try:
+        with open(file_path, "r", encoding="utf-8") as file:
+            items = iter_jsonl(file) if file_path.endswith(".jsonl") else iter_json_array(file)
+            for item in items:
+                if is_valid_record(item):
+                    yield item
+                else:
+                    print(f"WARN: record tidak valid di {file_path} dilewati: {str(item)[:80]}")
+    except FileNotFoundError:
+        print(f"Error: {file_path} not found. Please ensure the file exists in the correct directory.")
+        if strict:
+            raise
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode JSON from {file_path}. The file might be malformed.")
+        if strict:
+            raise
+
+
+def iter_records(folder_path, strict=False):
+    # every record of every corpus file, in file name order
+    if strict and not os.path.isdir(folder_path):
+        raise FileNotFoundError(f"corpus folder {folder_path} not found")
+    for file_path in corpus_files(folder_path):
+        yield from iter_file_records(file_path, strict)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
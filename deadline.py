@@ -0,0 +1,76 @@
+"""
+Per-request latency budget, shared by every stage of the pipeline.
+
+RAG_pipeline starts a Deadline of REQUEST_BUDGET seconds (time to first token) and makes it
+current for the request, like tracing.use_trace; worker threads see it through
+tracing.in_context. Stages ask for the time they have left:
+
+- upstream calls use timeout(default) as their timeout, the remaining budget when that is shorter
+- optional stages (classification, rerank, unfiltered search) run only while allows(stage) is
+  true, i.e. more than GENERATION_RESERVE seconds are left for the answer, and are cut off at
+  left(GENERATION_RESERVE); skipped stages are recorded as "<stage>_skipped" trace events
+
+Without a current deadline (REQUEST_BUDGET=0, ingestion, scripts) every stage runs to its own timeout.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+import tracing
+
+REQUEST_BUDGET = float(os.getenv('REQUEST_BUDGET', '10'))
+# kept free for the LLM's first token when optional stages are cut
+GENERATION_RESERVE = float(os.getenv('GENERATION_RESERVE', '3'))
+# shortest timeout handed to an upstream call, even when the budget is spent
+MIN_STAGE_TIMEOUT = 0.5
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+class Deadline:
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    def left(self, reserve=0.0):
+        return max(0.0, self.expires - time.monotonic() - reserve)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def use_deadline(budget=None):
+    # budget in seconds (default REQUEST_BUDGET), 0 or less runs without a deadline
+    budget = REQUEST_BUDGET if budget is None else budget
+    token = _current.set(Deadline(budget) if budget > 0 else None)
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+def left(reserve=0.0):
+    # seconds left of the current budget minus reserve, None without a deadline
+    d = _current.get()
+    return d.left(reserve) if d is not None else None
+
+
+def timeout(default, reserve=0.0):
+    # timeout of an upstream call: default, cut to what is left of the budget
+    remaining = left(reserve)
+    if remaining is None:
+        return default
+    remaining = max(remaining, MIN_STAGE_TIMEOUT)
+    return remaining if default is None else min(default, remaining)
+
+
+def allows(stage, reserve=GENERATION_RESERVE):
+    # False (and a "<stage>_skipped" event) when an optional stage would eat into the reserve
+    remaining = left(reserve)
+    if remaining is None or remaining > 0:
+        return True
+    tracing.event(f"{stage}_skipped", reason="budget")
+    return False
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    # same question with different spacing / unicode forms maps to one entry
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache with TTL for query embeddings, keyed on (model, dimensions, normalized text).
+    If disk_path is set, entries are also stored as float32 blobs in SQLite so they survive restarts;
+    expired rows are deleted when the file is opened and then once per ttl on write.
+    """
+
+    def __init__(self, max_entries=1024, ttl=86400, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        self._pruned = time.time()
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)"
+            )
+            self._db.commit()
+            self._prune()
+
+    @staticmethod
+    def make_key(model, dimensions, text):
+        return f"{model}|{dimensions}|{normalize_text(text)}"
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _prune(self):
+        # drop expired rows from the SQLite tier
+        self._pruned = time.time()
+        if self._db is not None and self.ttl is not None:
+            self._db.execute("DELETE FROM embeddings WHERE created < ?", (self._pruned - self.ttl,))
+            self._db.commit()
+
+    def _prune_due(self):
+        return self.ttl is not None and time.time() - self._pruned > self.ttl
+
+    def get(self, model, dimensions, text):
+        key = self.make_key(model, dimensions, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, vector = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    vector = array("f", row[1]).tolist()
+                    self._store(key, row[0], vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, model, dimensions, text, vector):
+        key = self.make_key(model, dimensions, text)
+        created = time.time()
+        with self._lock:
+            self._store(key, created, vector)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+                    (key, created, array("f", vector).tobytes())
+                )
+                self._db.commit()
+                if self._prune_due():
+                    self._prune()
+
+    def put_many(self, model, dimensions, items):
+        # (text, vector) pairs written in one transaction
+        created = time.time()
+        rows = []
+        with self._lock:
+            for text, vector in items:
+                key = self.make_key(model, dimensions, text)
+                self._store(key, created, vector)
+                rows.append((key, created, array("f", vector).tobytes()))
+            if self._db is not None and rows:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)", rows
+                )
+                self._db.commit()
+                if self._prune_due():
+                    self._prune()
+
+    def _store(self, key, created, vector):
+        self._entries[key] = (created, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+def cache_from_env():
+    # EMBED_CACHE_SIZE=0 disables the cache
+    max_entries = int(os.getenv('EMBED_CACHE_SIZE', '1024'))
+    if max_entries <= 0:
+        return None
+    ttl = float(os.getenv('EMBED_CACHE_TTL', '86400'))
+    return EmbeddingCache(max_entries=max_entries, ttl=ttl, disk_path=os.getenv('EMBED_CACHE_PATH') or None)
+
+
+def document_cache_from_env():
+    # embeddings of chunks waiting for ingestion, apart from the query cache and without a TTL
+    # (text and model are in the key); None unless DOC_EMBED_CACHE_PATH is set
+    disk_path = os.getenv('DOC_EMBED_CACHE_PATH')
+    if not disk_path:
+        return None
+    return EmbeddingCache(ttl=None, disk_path=disk_path)
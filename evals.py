@@ -2,7 +2,8 @@ import json
 from collections import defaultdict
 from rouge import Rouge
 import math
-from search import classify_query, search_dense_index, search_sparse_index, rrf_fusion, reranking_results, context_generation
+from search import classify_query, search_dense_index, search_sparse_index, rrf_fusion, merge_fused_results, reranking_results, context_generation, load_type_classifier
+import resources
 
 def retrieval_pipeline(query, top_k=10):
     # # classify docs
@@ -10,13 +11,11 @@ def retrieval_pipeline(query, top_k=10):
     dense_results, dense_results2 = search_dense_index(query, filter_types=classified_type)
     sparse_results, sparse_results2 = search_sparse_index(query, filter_types=classified_type)
     fused_results = rrf_fusion(dense_results, sparse_results, top_n=top_k)
-    fused_docs = [r['text'] for r in fused_results]
     # non-classify docs
     fused_results2 = rrf_fusion(dense_results2, sparse_results2, top_n=top_k)
-    fused_docs2 = [r['text'] for r in fused_results2]
-    # combine from two docs
-    fused_results.extend(fused_results2)
-    fused_docs.extend(fused_docs2)
+    # combine unique docs from both lists
+    fused_results = merge_fused_results(fused_results, fused_results2)
+    fused_docs = [r['text'] for r in fused_results]
     rerank = reranking_results(query, fused_docs, fused_results, top_k)
     top_ids = [d['id'] for d in rerank]
     return top_ids, rerank
@@ -159,6 +158,8 @@ def evaluate_rag(eval_data, k=10, evaluating_generation=True, save_path=None):
 if __name__ == "__main__":
     with open("data/eval/rag_eval.json", "r", encoding="utf-8") as f:
         eval_data = json.load(f)
+    # the local type classifier also learns from eval queries, leave out the ones scored here
+    resources.override("type_classifier", load_type_classifier(exclude_queries={item["query"] for item in eval_data}))
 
     results = evaluate_rag(
         eval_data=eval_data,
@@ -0,0 +1,310 @@
+"""
+Deterministic in-process stand-ins for Pinecone, SiliconFlow and OpenAI (RAG_BACKEND=fake).
+They return stable vectors, scores and streamed tokens so the pipeline can be load-tested and
+profiled offline. Each call sleeps for a configurable latency, e.g.
+
+    FAKE_LATENCY="embed=0.15,vector=0.04,upsert=0.08,rerank=0.3,llm_first=0.4,llm_token=0.01"
+
+All values are seconds; FAKE_JITTER (fraction, default 0.1) adds uniform noise.
+The async methods (aembed, aquery, arerank, ainvoke / astream) wait with asyncio.sleep.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from backends import Backends
+from bulk_upsert import vector_size
+from local_index import LocalDenseIndex, LocalSparseIndex
+
+DEFAULT_LATENCY = {
+    "embed": 0.15,
+    "vector": 0.04,
+    "upsert": 0.08,
+    "rerank": 0.3,
+    "llm_first": 0.4,
+    "llm_token": 0.01,
+}
+FAKE_ANSWER = (
+    "Ini adalah jawaban simulasi dari backend offline. Jawaban disusun dari konteks yang "
+    "ditemukan oleh pencarian dense dan sparse lalu diurutkan ulang oleh reranker. "
+    "Gunakan mode ini hanya untuk mengukur overhead orkestrasi dan perilaku konkurensi."
+)
+
+
+def parse_latency(spec=None):
+    latency = dict(DEFAULT_LATENCY)
+    spec = spec if spec is not None else os.getenv('FAKE_LATENCY', '')
+    for part in spec.split(','):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            latency[key.strip()] = float(value)
+    return latency
+
+
+class Latency:
+    def __init__(self, spec=None, jitter=None):
+        self.values = parse_latency(spec)
+        self.jitter = jitter if jitter is not None else float(os.getenv('FAKE_JITTER', '0.1'))
+
+    def get(self, stage):
+        base = self.values.get(stage, 0.0)
+        return max(0.0, base * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def sleep(self, stage):
+        delay = self.get(stage)
+        if delay:
+            time.sleep(delay)
+
+    async def asleep(self, stage):
+        delay = self.get(stage)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+class FakeEmbedder:
+    """
+    Hashed bag-of-words embedding: every token maps to a fixed random vector, so texts that
+    share words end up close to each other and the same text always gets the same vector.
+    """
+
+    def __init__(self, latency, model="fake-embedding"):
+        self.latency = latency
+        self.model = model
+        self._token_vectors = {}
+        self._lock = threading.Lock()
+
+    def _token_vector(self, token, dim_size):
+        key = (token, dim_size)
+        vec = self._token_vectors.get(key)
+        if vec is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:8], "little")
+            vec = np.random.default_rng(seed).standard_normal(dim_size).astype(np.float32)
+            with self._lock:
+                self._token_vectors[key] = vec
+        return vec
+
+    def vector(self, text, dim_size):
+        dim_size = dim_size or 1024
+        vec = np.zeros(dim_size, dtype=np.float32)
+        for token in tokenize(text):
+            vec += self._token_vector(token, dim_size)
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).tolist()
+
+    def embed(self, text, dim_size):
+        self.latency.sleep("embed")
+        return self.vector(text, dim_size)
+
+    async def aembed(self, text, dim_size):
+        await self.latency.asleep("embed")
+        return self.vector(text, dim_size)
+
+    def embed_batch(self, texts, dim_size):
+        self.latency.sleep("embed")
+        return [self.vector(text, dim_size) for text in texts]
+
+
+class FakeVectorStore:
+    """
+    Pinecone Index look-alike backed by a local index over the corpus (built on first query).
+    Upserts and deletes are kept in memory and counted so ingestion can be exercised offline.
+    Upserts over Pinecone's request limits (vectors per request, request size) are rejected.
+    """
+
+    max_request_vectors = 1000
+    max_request_bytes = 2 * 1024 * 1024
+
+    def __init__(self, kind, latency, build_index):
+        self.kind = kind
+        self.latency = latency
+        self._build_index = build_index
+        self._index = None
+        self._lock = threading.Lock()
+        self.vectors = {}
+        self.upsert_calls = 0
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._build_index()
+        return self._index
+
+    def query(self, namespace=None, vector=None, sparse_vector=None, top_k=10,
+              include_metadata=True, include_values=False, filter=None, **kwargs):
+        self.latency.sleep("vector")
+        return self.search(vector, sparse_vector, top_k, filter)
+
+    async def aquery(self, namespace=None, vector=None, sparse_vector=None, top_k=10,
+                     include_metadata=True, include_values=False, filter=None, **kwargs):
+        await self.latency.asleep("vector")
+        return self.search(vector, sparse_vector, top_k, filter)
+
+    def search(self, vector, sparse_vector, top_k, filter):
+        query_vector = vector if self.kind == "dense" else sparse_vector
+        results = self.index.query(query_vector, top_k=top_k, filter=filter)
+        return {
+            "matches": [
+                {"id": r["id"], "score": r["similarity"], "metadata": {"text": r["text"]}}
+                for r in results
+            ]
+        }
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        size = sum(vector_size(v) for v in vectors)
+        if len(vectors) > self.max_request_vectors or size > self.max_request_bytes:
+            raise ValueError(f"upsert request too large: {len(vectors)} vectors, {size} bytes")
+        self.latency.sleep("upsert")
+        with self._lock:
+            self.upsert_calls += 1
+            for v in vectors:
+                self.vectors[v["id"]] = v
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, namespace=None, **kwargs):
+        self.latency.sleep("vector")
+        with self._lock:
+            for doc_id in ids or []:
+                self.vectors.pop(doc_id, None)
+        return {}
+
+
+class FakeReranker:
+    # relevance = share of query tokens found in the document
+    def __init__(self, latency):
+        self.latency = latency
+
+    def rerank(self, query, docs, top_n):
+        self.latency.sleep("rerank")
+        return self.scores(query, docs, top_n)
+
+    async def arerank(self, query, docs, top_n):
+        await self.latency.asleep("rerank")
+        return self.scores(query, docs, top_n)
+
+    def scores(self, query, docs, top_n):
+        query_tokens = set(tokenize(query))
+        scores = []
+        for i, doc in enumerate(docs):
+            doc_tokens = set(tokenize(doc))
+            overlap = len(query_tokens & doc_tokens) / len(query_tokens) if query_tokens else 0.0
+            scores.append({"index": i, "relevance_score": overlap})
+        scores.sort(key=lambda x: x["relevance_score"], reverse=True)
+        return scores[:top_n]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that answers classification prompts with ["Other"] and everything else with a
+    fixed answer, streamed word by word after llm_first seconds and llm_token seconds per token.
+    """
+
+    first_token_latency: float = 0.4
+    token_latency: float = 0.01
+    answer: str = FAKE_ANSWER
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _respond(self, messages) -> str:
+        prompt = " ".join(str(m.content) for m in messages)
+        if prompt.lstrip().startswith("Klasifikasikan"):
+            return json.dumps(["Other"])
+        return self.answer
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self._respond(messages)
+        time.sleep(self.first_token_latency + self.token_latency * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        words = self._respond(messages).split(" ")
+        time.sleep(self.first_token_latency)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            token = word if i == len(words) - 1 else word + " "
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self._respond(messages)
+        await asyncio.sleep(self.first_token_latency + self.token_latency * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        words = self._respond(messages).split(" ")
+        await asyncio.sleep(self.first_token_latency)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            token = word if i == len(words) - 1 else word + " "
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class FakeChat:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def chat_model(self, streaming=False):
+        return FakeChatModel(
+            first_token_latency=self.latency.get("llm_first"),
+            token_latency=self.latency.values.get("llm_token", 0.0)
+        )
+
+
+def create_fake_backends(corpus_path=None, latency=None):
+    latency = latency or Latency()
+    corpus_path = corpus_path or os.getenv('CORPUS_PATH', 'data/final_id')
+    embedder = FakeEmbedder(latency)
+    dim_size = int(os.getenv('EMBED_DIM')) if os.getenv('EMBED_DIM') else 1024
+
+    def corpus():
+        from setup_pinecone import read_corpus_records
+        return read_corpus_records(corpus_path)
+
+    def build_dense():
+        records = corpus()
+        vectors = [
+            {"id": r["_id"], "values": embedder.vector(r["text"], dim_size), "metadata": r}
+            for r in records
+        ]
+        return LocalDenseIndex.from_vectors(vectors)
+
+    def build_sparse():
+        from pinecone_text.sparse import BM25Encoder
+        from bm25_store import load_bm25_params
+        bm25 = BM25Encoder(stem=False)
+        load_bm25_params(bm25)
+        return LocalSparseIndex.build(corpus(), bm25)
+
+    return Backends(
+        "fake",
+        embedder=embedder,
+        index_dense=FakeVectorStore("dense", latency, build_dense),
+        index_sparse=FakeVectorStore("sparse", latency, build_sparse),
+        reranker=FakeReranker(latency),
+        llm=FakeChat(latency)
+    )
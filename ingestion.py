@@ -0,0 +1,141 @@
+"""
+Batched, concurrent embedding for ingestion.
+Texts are sent to the embedding API in batches of EMBED_BATCH_SIZE inputs through a pool of
+EMBED_WORKERS threads, limited to EMBED_RATE_LIMIT requests per second for the whole process
+(all embed_texts calls share one token bucket). Failed batches are
+retried with exponential backoff and jitter.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '32'))
+EMBED_WORKERS = int(os.getenv('EMBED_WORKERS', '4'))
+EMBED_RATE_LIMIT = float(os.getenv('EMBED_RATE_LIMIT', '10'))
+EMBED_MAX_RETRIES = int(os.getenv('EMBED_MAX_RETRIES', '5'))
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    # token bucket shared by all workers, rate in requests per second (<= 0 disables it)
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def reserve(self, max_wait):
+        # take the next token if it is free within max_wait, returns the seconds to wait (None: not taken)
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            # may go negative: later callers wait behind this reservation
+            self.tokens -= 1
+            return wait
+
+
+def is_retryable(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRYABLE_STATUS
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def with_retries(fn, max_retries=EMBED_MAX_RETRIES, base_delay=0.5, max_delay=30.0, limiter=None,
+                 retryable=is_retryable):
+    # call fn(), retrying errors accepted by retryable() with exponential backoff and full jitter
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return fn()
+        except Exception as e:
+            attempt += 1
+            if attempt > max_retries or not retryable(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"retry {attempt}/{max_retries} in {delay:.2f}s: {e}")
+            time.sleep(delay)
+
+
+async def awith_retries(fn, max_retries=EMBED_MAX_RETRIES, base_delay=0.5, max_delay=30.0, retryable=is_retryable):
+    # with_retries for a coroutine function
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            attempt += 1
+            if attempt > max_retries or not retryable(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"retry {attempt}/{max_retries} in {delay:.2f}s: {e}")
+            await asyncio.sleep(delay)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def shared_limiter(rate):
+    # one bucket per rate for the whole process, so the limit holds across embed_texts calls
+    with _limiters_lock:
+        if rate not in _limiters:
+            _limiters[rate] = RateLimiter(rate)
+        return _limiters[rate]
+
+
+def embed_texts(embedder, texts, dim_size, batch_size=EMBED_BATCH_SIZE, max_workers=EMBED_WORKERS,
+                rate_limit=EMBED_RATE_LIMIT, max_retries=EMBED_MAX_RETRIES, limiter=None):
+    """
+    Embed texts in batches, returns one embedding per text in input order
+    (None for texts whose batch still failed after all retries).
+    limiter: RateLimiter to use, by default the process-wide one for rate_limit.
+    """
+    limiter = limiter or shared_limiter(rate_limit)
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    def run(batch):
+        try:
+            return with_retries(lambda: embedder.embed_batch(batch, dim_size), max_retries=max_retries, limiter=limiter)
+        except Exception as e:
+            print(f"Error embedding batch of {len(batch)}: {e}")
+            return [None] * len(batch)
+
+    embeddings = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embed") as pool:
+        for result in pool.map(run, batches):
+            embeddings.extend(result)
+    return embeddings
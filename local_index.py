@@ -0,0 +1,198 @@
+import json
+import os
+import numpy as np
+
+
+def filter_types_from_query(filter_query):
+    # accept the same metadata filter shape used for Pinecone: {"type": {"$in": [...]}}
+    if not filter_query:
+        return None
+    if set(filter_query) != {"type"} or set(filter_query["type"]) != {"$in"}:
+        raise ValueError(f"Unsupported filter for local index: {filter_query}")
+    return filter_query["type"]["$in"]
+
+
+class LocalIndex:
+    """
+    Shared top-k and metadata filter logic for the in-process indexes.
+    Subclasses implement score(vector) returning one score per document.
+    """
+    # only documents scoring above this are returned (sparse: must share a term)
+    min_score = None
+
+    def __init__(self, ids, texts, types=None, type_masks=None):
+        self.ids = ids
+        self.texts = texts
+        self.n_docs = len(ids)
+        if type_masks is None:
+            # one boolean mask per type for $in filters
+            type_masks = {}
+            for i, doc_types in enumerate(types):
+                for t in doc_types:
+                    if t not in type_masks:
+                        type_masks[t] = np.zeros(self.n_docs, dtype=bool)
+                    type_masks[t][i] = True
+        self.type_masks = type_masks
+
+    def type_mask(self, filter_types):
+        mask = np.zeros(self.n_docs, dtype=bool)
+        for t in filter_types:
+            if t in self.type_masks:
+                mask |= self.type_masks[t]
+        return mask
+
+    def score(self, vector):
+        raise NotImplementedError
+
+    def top_k(self, scores, top_k, mask=None):
+        if self.min_score is None:
+            candidates = np.ones(self.n_docs, dtype=bool)
+        else:
+            candidates = scores > self.min_score
+        if mask is not None:
+            candidates &= mask
+        cand_idx = np.flatnonzero(candidates)
+        if cand_idx.size > top_k:
+            part = np.argpartition(-scores[cand_idx], top_k - 1)[:top_k]
+            cand_idx = cand_idx[part]
+        cand_idx = cand_idx[np.argsort(-scores[cand_idx], kind="stable")]
+        return [
+            {"id": self.ids[i], "similarity": float(scores[i]), "text": self.texts[i]}
+            for i in cand_idx
+        ]
+
+    def query(self, vector, top_k, filter=None):
+        filter_types = filter_types_from_query(filter)
+        mask = self.type_mask(filter_types) if filter_types else None
+        return self.top_k(self.score(vector), top_k, mask)
+
+    def query_both(self, vector, top_k, filter=None):
+        # filtered and unfiltered results from a single scoring pass
+        scores = self.score(vector)
+        unfiltered = self.top_k(scores, top_k)
+        filter_types = filter_types_from_query(filter)
+        if not filter_types:
+            return unfiltered, unfiltered
+        return self.top_k(scores, top_k, self.type_mask(filter_types)), unfiltered
+
+
+class LocalSparseIndex(LocalIndex):
+    """
+    In-process BM25 index over the corpus.
+    Document vectors come from the same BM25Encoder used for Pinecone and are stored as an
+    inverted index in CSR form: postings of term_ids[i] live in doc_idx/weights[indptr[i]:indptr[i+1]].
+    """
+
+    min_score = 0.0
+
+    def __init__(self, ids, texts, types, term_ids, indptr, doc_idx, weights):
+        super().__init__(ids, texts, types)
+        self.term_ids = term_ids
+        self.indptr = indptr
+        self.doc_idx = doc_idx
+        self.weights = weights
+
+    @classmethod
+    def build(cls, records, bm25_model):
+        ids = [item['_id'] for item in records]
+        texts = [item['text'] for item in records]
+        types = [item.get('type', []) for item in records]
+        sparse_docs = bm25_model.encode_documents(texts)
+
+        terms = []
+        docs = []
+        values = []
+        for i, vec in enumerate(sparse_docs):
+            terms.extend(vec["indices"])
+            docs.extend([i] * len(vec["indices"]))
+            values.extend(vec["values"])
+        terms = np.asarray(terms, dtype=np.uint32)
+        docs = np.asarray(docs, dtype=np.int32)
+        values = np.asarray(values, dtype=np.float32)
+
+        # group postings by term
+        order = np.argsort(terms, kind="stable")
+        terms, docs, values = terms[order], docs[order], values[order]
+        term_ids, starts = np.unique(terms, return_index=True)
+        indptr = np.append(starts, len(terms)).astype(np.int64)
+        return cls(ids, texts, types, term_ids, indptr, docs, values)
+
+    def score(self, sparse_vector):
+        # dot product between the query vector and every document
+        q_terms = np.asarray(sparse_vector["indices"], dtype=np.uint32)
+        q_values = np.asarray(sparse_vector["values"], dtype=np.float32)
+        pos = np.searchsorted(self.term_ids, q_terms)
+        pos = np.minimum(pos, len(self.term_ids) - 1)
+        found = self.term_ids[pos] == q_terms
+        pos, q_values = pos[found], q_values[found]
+        if pos.size == 0:
+            return np.zeros(self.n_docs, dtype=np.float32)
+
+        starts, ends = self.indptr[pos], self.indptr[pos + 1]
+        lengths = ends - starts
+        # flat positions of every posting touched by the query
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        contrib = self.weights[offsets] * np.repeat(q_values, lengths)
+        return np.bincount(self.doc_idx[offsets], weights=contrib, minlength=self.n_docs)
+
+
+class LocalDenseIndex(LocalIndex):
+    """
+    Brute-force cosine search over unit-normalized float32 embeddings.
+    On disk: embeddings.npy (memory-mapped on load), type_masks.npy (packed bits, one row per type)
+    and meta.json (ids, texts, type names).
+    """
+
+    def __init__(self, ids, texts, embeddings, types=None, type_masks=None):
+        super().__init__(ids, texts, types, type_masks)
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        # vectors in the same shape as the Pinecone dense upsert payload
+        ids = [v["id"] for v in vectors]
+        texts = [v["metadata"].get("text", "") for v in vectors]
+        types = [v["metadata"].get("type", []) for v in vectors]
+        embeddings = np.asarray([v["values"] for v in vectors], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1.0)
+        return cls(ids, texts, embeddings, types=types)
+
+    def doc_types(self, i):
+        return [t for t, mask in self.type_masks.items() if mask[i]]
+
+    def updated(self, vectors, delete_ids=()):
+        # new index with `vectors` upserted (same shape as from_vectors) and delete_ids removed
+        replaced = set(delete_ids) | {v["id"] for v in vectors}
+        kept = [
+            {"id": doc_id, "values": self.embeddings[i], "metadata": {"text": self.texts[i], "type": self.doc_types(i)}}
+            for i, doc_id in enumerate(self.ids) if doc_id not in replaced
+        ]
+        return self.from_vectors(kept + list(vectors))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        type_names = sorted(self.type_masks)
+        masks = np.array([self.type_masks[t] for t in type_names], dtype=bool).reshape(len(type_names), self.n_docs)
+        np.save(os.path.join(path, "embeddings.npy"), np.ascontiguousarray(self.embeddings, dtype=np.float32))
+        np.save(os.path.join(path, "type_masks.npy"), np.packbits(masks, axis=1))
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "types": type_names}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        packed = np.load(os.path.join(path, "type_masks.npy"))
+        n_docs = len(meta["ids"])
+        masks = np.unpackbits(packed, axis=1, count=n_docs).astype(bool) if len(packed) else packed
+        type_masks = {t: masks[i] for i, t in enumerate(meta["types"])}
+        return cls(meta["ids"], meta["texts"], embeddings, type_masks=type_masks)
+
+    def score(self, vector):
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        return self.embeddings @ query
@@ -0,0 +1,189 @@
+"""
+Record / replay of upstream responses, for deterministic benchmarks without a network.
+
+RAG_BACKEND=record wraps the backends named by RECORD_BACKEND (live by default) and stores every
+embedding, index query, rerank and LLM response in REPLAY_PATH, keyed by a hash of the request.
+RAG_BACKEND=replay answers the same requests from that file, instantly and in the recorded
+chunks; a request that was never recorded raises KeyError.
+"""
+import atexit
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Iterator
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from backends import Backends
+
+REPLAY_PATH = os.getenv('REPLAY_PATH', 'data/bench/replay.json')
+
+
+def request_key(kind, *parts):
+    payload = json.dumps([kind, parts], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Tape:
+    def __init__(self, path=REPLAY_PATH, replay=True):
+        self.path = path
+        self.replay = replay
+        self.meta = {}
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.meta, self.entries = data.get("meta", {}), data.get("entries", {})
+        elif replay:
+            raise FileNotFoundError(f"{path} tidak ada, rekam dulu dengan RAG_BACKEND=record")
+
+    def get(self, key):
+        if key not in self.entries:
+            raise KeyError(f"request {key[:12]} tidak ada di {self.path}, rekam ulang dengan RAG_BACKEND=record")
+        return self.entries[key]
+
+    def call(self, key, fn):
+        # recorded value in replay mode, otherwise fn() stored under key
+        if self.replay:
+            return self.get(key)
+        value = fn()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"meta": self.meta, "entries": self.entries}, f, ensure_ascii=False)
+
+
+class TapeEmbedder:
+    def __init__(self, tape, inner=None):
+        self.tape = tape
+        self.inner = inner
+        if inner is not None:
+            tape.meta["embed_model"] = inner.model
+        self.model = tape.meta.get("embed_model", "replay")
+
+    def embed(self, text, dim_size):
+        return self.tape.call(request_key("embed", text, dim_size), lambda: self.inner.embed(text, dim_size))
+
+    def embed_batch(self, texts, dim_size):
+        return [self.embed(text, dim_size) for text in texts]
+
+
+def plain_response(response):
+    # query response as plain json (the Pinecone gRPC response is an object)
+    return {
+        "matches": [
+            {"id": m["id"], "score": m["score"], "metadata": dict(m.get("metadata") or {})}
+            for m in (response.get("matches") or [])
+        ]
+    }
+
+
+class TapeIndex:
+    def __init__(self, tape, kind, inner=None):
+        self.tape = tape
+        self.kind = kind
+        self.inner = inner
+
+    def query(self, **kwargs):
+        key = request_key(f"query_{self.kind}", kwargs)
+        return self.tape.call(key, lambda: plain_response(self.inner.query(**kwargs)))
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        if self.inner is not None:
+            return self.inner.upsert(vectors=vectors, namespace=namespace, **kwargs)
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, namespace=None, **kwargs):
+        if self.inner is not None:
+            return self.inner.delete(ids=ids, namespace=namespace, **kwargs)
+        return {}
+
+
+class TapeReranker:
+    def __init__(self, tape, inner=None):
+        self.tape = tape
+        self.inner = inner
+
+    def rerank(self, query, docs, top_n):
+        key = request_key("rerank", query, docs, top_n)
+        return self.tape.call(key, lambda: self.inner.rerank(query, docs, top_n))
+
+
+class TapeChatModel(BaseChatModel):
+    # answers are stored as the list of streamed chunk contents
+    tape: Any = None
+    inner: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "tape-chat"
+
+    def _key(self, messages):
+        return request_key("llm", [(m.type, m.content) for m in messages])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        chunks = self.tape.call(self._key(messages), lambda: [self.inner.invoke(messages).content])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(chunks)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        key = self._key(messages)
+        if self.tape.replay:
+            chunks = self.tape.get(key)
+        else:
+            chunks = []
+            for chunk in self.inner.stream(messages):
+                chunks.append(chunk.content)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+            self.tape.put(key, chunks)
+            return
+        for content in chunks:
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=content))
+            if run_manager:
+                run_manager.on_llm_new_token(content, chunk=chunk)
+            yield chunk
+
+
+class TapeChat:
+    def __init__(self, tape, inner=None):
+        self.tape = tape
+        self.inner = inner
+
+    def chat_model(self, streaming=False):
+        inner = self.inner.chat_model(streaming=streaming) if self.inner is not None else None
+        return TapeChatModel(tape=self.tape, inner=inner)
+
+
+def create_tape_backends(kind, path=None):
+    path = path or REPLAY_PATH
+    if kind == "replay":
+        tape = Tape(path, replay=True)
+        inner = None
+    else:
+        from backends import create_backends
+        tape = Tape(path, replay=False)
+        inner = create_backends(os.getenv('RECORD_BACKEND', 'live'))
+        # written when the process ends, call tape.save() to write earlier
+        atexit.register(tape.save)
+    backends = Backends(
+        kind,
+        embedder=TapeEmbedder(tape, inner and inner.embedder),
+        index_dense=TapeIndex(tape, "dense", inner and inner.index_dense),
+        index_sparse=TapeIndex(tape, "sparse", inner and inner.index_sparse),
+        reranker=TapeReranker(tape, inner and inner.reranker),
+        llm=TapeChat(tape, inner and inner.llm),
+        pc=inner and inner.pc
+    )
+    backends.tape = tape
+    return backends
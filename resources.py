@@ -0,0 +1,58 @@
+"""
+Process-wide registry of lazily created resources (clients, index handles, models).
+A resource is built by its factory on first get() and reused afterwards; warm_up() builds
+them up front, e.g. before a server starts taking traffic.
+"""
+import threading
+import time
+
+_factories = {}
+_instances = {}
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+def register(name, factory):
+    with _registry_lock:
+        _factories[name] = factory
+        _locks.setdefault(name, threading.Lock())
+
+
+def get(name):
+    if name in _instances:
+        return _instances[name]
+    with _locks[name]:
+        # another thread may have built it while we waited
+        if name not in _instances:
+            _instances[name] = _factories[name]()
+    return _instances[name]
+
+
+def override(name, value):
+    # replace a resource, e.g. to inject a different implementation
+    with _registry_lock:
+        _locks.setdefault(name, threading.Lock())
+        _instances[name] = value
+
+
+def is_loaded(name):
+    return name in _instances
+
+
+def reset(name=None):
+    # drop built instances so the next get() creates them again
+    with _registry_lock:
+        if name is None:
+            _instances.clear()
+        else:
+            _instances.pop(name, None)
+
+
+def warm_up(names=None):
+    # build resources now, returns seconds spent per resource
+    timings = {}
+    for name in names or list(_factories):
+        start = time.perf_counter()
+        get(name)
+        timings[name] = time.perf_counter() - start
+    return timings
@@ -0,0 +1,292 @@
+"""
+Admission control for the RAG pipeline, so bursts queue here instead of piling up on the upstreams.
+
+- upstreams: every call to an upstream (embed, vector, rerank, llm) takes one of its
+  UPSTREAM_CONCURRENCY slots and, when UPSTREAM_RATE is set, a token of its per-second rate.
+  A call that gets neither within its UPSTREAM_MAX_WAIT raises Overloaded instead of adding to
+  the 429s and retries upstream; optional stages (classification, rerank) wait at most
+  OPTIONAL_STAGE_MAX_WAIT and are skipped by the caller.
+- requests: at most MAX_ACTIVE_REQUESTS pipelines run at once, up to MAX_QUEUED_REQUESTS wait
+  for a slot. A request that finds the queue full, or waits longer than QUEUE_TIMEOUT, is shed
+  with Overloaded before it does any work.
+
+Waits are also cut to the remaining request budget (deadline.py).
+
+Limits are per process. Sync (thread) and async (event loop) callers each get the full
+number of slots, a process normally serves only one of the two.
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+
+import deadline
+from ingestion import RateLimiter
+
+DEFAULT_CONCURRENCY = {"embed": 32, "vector": 64, "rerank": 16, "llm": 32}
+DEFAULT_MAX_WAIT = {"embed": 5.0, "vector": 5.0, "rerank": 1.0, "llm": 10.0}
+MAX_ACTIVE_REQUESTS = int(os.getenv('MAX_ACTIVE_REQUESTS', '64'))
+MAX_QUEUED_REQUESTS = int(os.getenv('MAX_QUEUED_REQUESTS', '256'))
+QUEUE_TIMEOUT = float(os.getenv('QUEUE_TIMEOUT', '10'))
+OPTIONAL_STAGE_MAX_WAIT = float(os.getenv('OPTIONAL_STAGE_MAX_WAIT', '0.5'))
+
+
+def parse_spec(spec, defaults=None):
+    # "embed=16,llm=8" -> {"embed": 16.0, "llm": 8.0} on top of defaults
+    values = dict(defaults or {})
+    for part in (spec or "").split(','):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            values[key.strip()] = float(value)
+    return values
+
+
+class Overloaded(Exception):
+    def __init__(self, name, reason):
+        super().__init__(f"{name} overloaded: {reason}")
+        self.name = name
+        self.reason = reason
+
+
+class Upstream:
+    def __init__(self, name, concurrency, rate=0.0, max_wait=5.0):
+        self.name = name
+        self.concurrency = int(concurrency)
+        self.max_wait = max_wait
+        self.limiter = RateLimiter(rate) if rate > 0 else None
+        self.stats = Counter()
+        self.in_flight = 0
+        self._sem = threading.BoundedSemaphore(self.concurrency)
+        self._async_sems = weakref.WeakKeyDictionary()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key, in_flight=0):
+        with self._stats_lock:
+            self.stats[key] += 1
+            self.in_flight += in_flight
+
+    def _shed(self, reason):
+        self._count("shed")
+        raise Overloaded(self.name, reason)
+
+    def _rate_wait(self, until):
+        # seconds to wait for a rate token, sheds when it would come after until
+        if self.limiter is None:
+            return 0.0
+        wait = self.limiter.reserve(max(0.0, until - time.monotonic()))
+        if wait is None:
+            self._shed("rate limit")
+        return wait
+
+    def acquire(self, max_wait=None):
+        until = time.monotonic() + deadline.timeout(self.max_wait if max_wait is None else max_wait)
+        if not self._sem.acquire(timeout=max(0.0, until - time.monotonic())):
+            self._shed(f"{self.concurrency} calls in flight")
+        try:
+            wait = self._rate_wait(until)
+        except Overloaded:
+            self._sem.release()
+            raise
+        if wait:
+            time.sleep(wait)
+        self._count("calls", 1)
+
+    def release(self):
+        self._count("released", -1)
+        self._sem.release()
+
+    @contextmanager
+    def slot(self, max_wait=None):
+        self.acquire(max_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _async_sem(self):
+        loop = asyncio.get_running_loop()
+        sem = self._async_sems.get(loop)
+        if sem is None:
+            sem = self._async_sems.setdefault(loop, asyncio.Semaphore(self.concurrency))
+        return sem
+
+    async def aacquire(self, max_wait=None):
+        until = time.monotonic() + deadline.timeout(self.max_wait if max_wait is None else max_wait)
+        sem = self._async_sem()
+        try:
+            await asyncio.wait_for(sem.acquire(), max(0.0, until - time.monotonic()))
+        except asyncio.TimeoutError:
+            self._shed(f"{self.concurrency} calls in flight")
+        try:
+            wait = self._rate_wait(until)
+        except Overloaded:
+            sem.release()
+            raise
+        if wait:
+            await asyncio.sleep(wait)
+        self._count("calls", 1)
+
+    def arelease(self):
+        self._count("released", -1)
+        self._async_sem().release()
+
+    @asynccontextmanager
+    async def aslot(self, max_wait=None):
+        await self.aacquire(max_wait)
+        try:
+            yield
+        finally:
+            self.arelease()
+
+
+class Admission:
+    # bounded queue in front of the pipeline: enter() before a request, leave() once it is done
+    def __init__(self, max_active=MAX_ACTIVE_REQUESTS, max_queued=MAX_QUEUED_REQUESTS, timeout=QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.queued = 0
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._sem = threading.Semaphore(max_active)
+        self._async_sems = weakref.WeakKeyDictionary()
+
+    def _queue(self):
+        with self._lock:
+            if self.queued >= self.max_queued:
+                self.stats["shed_queue_full"] += 1
+                raise Overloaded("pipeline", f"{self.max_queued} requests queued")
+            self.queued += 1
+
+    def _dequeue(self, admitted):
+        with self._lock:
+            self.queued -= 1
+            self.stats["admitted" if admitted else "shed_timeout"] += 1
+        if not admitted:
+            raise Overloaded("pipeline", "no slot in time")
+
+    def enter(self, timeout=None):
+        self._queue()
+        self._dequeue(self._sem.acquire(timeout=deadline.timeout(self.timeout if timeout is None else timeout)))
+
+    def leave(self):
+        self._sem.release()
+
+    def _async_sem(self):
+        loop = asyncio.get_running_loop()
+        sem = self._async_sems.get(loop)
+        if sem is None:
+            sem = self._async_sems.setdefault(loop, asyncio.Semaphore(self.max_active))
+        return sem
+
+    async def aenter(self, timeout=None):
+        self._queue()
+        try:
+            await asyncio.wait_for(self._async_sem().acquire(),
+                                   deadline.timeout(self.timeout if timeout is None else timeout))
+            admitted = True
+        except asyncio.TimeoutError:
+            admitted = False
+        self._dequeue(admitted)
+
+    def aleave(self):
+        self._async_sem().release()
+
+
+def create_upstreams():
+    concurrency = parse_spec(os.getenv('UPSTREAM_CONCURRENCY'), DEFAULT_CONCURRENCY)
+    rates = parse_spec(os.getenv('UPSTREAM_RATE'))
+    max_wait = parse_spec(os.getenv('UPSTREAM_MAX_WAIT'), DEFAULT_MAX_WAIT)
+    return {
+        name: Upstream(name, concurrency[name], rates.get(name, 0.0), max_wait[name])
+        for name in DEFAULT_CONCURRENCY
+    }
+
+
+upstreams = create_upstreams()
+admission = Admission()
+
+
+def upstream(name):
+    return upstreams[name]
+
+
+class released:
+    """
+    Pass a stream through and call release() exactly once: when it is consumed, fails, is
+    closed, or is dropped without ever being iterated (a generator's finally would not run then).
+    """
+    def __init__(self, stream, release):
+        self.stream = iter(stream)
+        self._release = release
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self.stream, "close"):
+                self.stream.close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        self.close()
+
+
+class areleased:
+    # released for an async stream, release() is a plain function bound to the current event loop
+    def __init__(self, stream, release):
+        self.stream = stream.__aiter__()
+        self._release = release
+        self._loop = asyncio.get_running_loop()
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self.stream, "aclose"):
+                await self.stream.aclose()
+        finally:
+            self._release()
+
+    def __del__(self):
+        # dropped unread: release on the stream's loop, the semaphores belong to it
+        if not self._closed:
+            self._closed = True
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._release)
+
+
+def stats():
+    return {
+        "queued": admission.queued,
+        "admission": dict(admission.stats),
+        "upstreams": {name: {"in_flight": u.in_flight, **u.stats} for name, u in upstreams.items()},
+    }
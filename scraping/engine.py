@@ -0,0 +1,193 @@
+"""
+Fetch engine for the scrapers.
+- one pooled requests.Session shared by a bounded thread pool (SCRAPE_WORKERS)
+- per-host spacing of SCRAPE_RATE requests per second instead of fixed sleeps
+- on-disk HTTP cache (SCRAPE_CACHE_DIR) revalidated with ETag / If-Modified-Since
+- JSON checkpoint of finished urls so an interrupted crawl resumes where it stopped
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SCRAPE_WORKERS = int(os.getenv('SCRAPE_WORKERS', '8'))
+SCRAPE_RATE = float(os.getenv('SCRAPE_RATE', '4'))
+SCRAPE_CACHE_DIR = os.getenv('SCRAPE_CACHE_DIR', '.scrape_cache')
+SCRAPE_TIMEOUT = float(os.getenv('SCRAPE_TIMEOUT', '20'))
+SCRAPE_MAX_RETRIES = int(os.getenv('SCRAPE_MAX_RETRIES', '3'))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+USER_AGENT = "cs-upi-rag-scraper/1.0"
+
+
+class HostRateLimiter:
+    # reserves the next free slot per host, callers sleep until their slot (rate <= 0 disables it)
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class HttpCache:
+    # one json file per url: validators and body of the last 200 response
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url):
+        try:
+            with open(self._file(url), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, url, response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        entry = {"url": url, "etag": etag, "last_modified": last_modified, "text": response.text}
+        tmp = self._file(url) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, self._file(url))
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+class Checkpoint:
+    # url -> result of a finished url, written every `every` updates and on save()
+
+    def __init__(self, path, every=20):
+        self.path = path
+        self.every = every
+        self.items = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.items = json.load(f)
+            print(f"checkpoint: {len(self.items)} url dari {path}")
+
+    def __contains__(self, url):
+        return url in self.items
+
+    def get(self, url):
+        return self.items.get(url)
+
+    def put(self, url, value):
+        with self._lock:
+            self.items[url] = value
+            self._pending += 1
+            if self._pending >= self.every:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._pending = 0
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.items, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+class Fetcher:
+    def __init__(self, workers=SCRAPE_WORKERS, rate=SCRAPE_RATE, cache_dir=SCRAPE_CACHE_DIR,
+                 timeout=SCRAPE_TIMEOUT, max_retries=SCRAPE_MAX_RETRIES):
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.limiter = HostRateLimiter(rate)
+        self.cache = HttpCache(cache_dir) if cache_dir else None
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scrape")
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def get(self, url, use_cache=True):
+        # response body of url, revalidating the cached copy when there is one
+        entry = self.cache.get(url) if self.cache is not None and use_cache else None
+        headers = HttpCache.conditional_headers(entry)
+        attempt = 0
+        while True:
+            self.limiter.wait(url)
+            self._count("requests")
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                response = None
+                if attempt >= self.max_retries:
+                    raise
+            if response is not None and response.status_code == 304 and entry:
+                self._count("not_modified")
+                return entry["text"]
+            if response is not None and (response.status_code not in RETRYABLE_STATUS or attempt >= self.max_retries):
+                response.raise_for_status()
+                if self.cache is not None and use_cache:
+                    self.cache.put(url, response)
+                return response.text
+
+            attempt += 1
+            self._count("retries")
+            retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+            delay = float(retry_after) if retry_after.isdigit() else random.uniform(0, 2 ** attempt)
+            time.sleep(delay)
+
+    def map(self, fn, items):
+        # fn(item) on the pool, yields (item, result, error) in input order
+        def run(item):
+            try:
+                return item, fn(item), None
+            except Exception as e:
+                self._count("errors")
+                return item, None, e
+
+        yield from self.pool.map(run, items)
+
+    def close(self):
+        self.pool.shutdown()
+        self.session.close()
@@ -1,13 +1,21 @@
-import requests
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
 from bs4 import BeautifulSoup
-import time, json, re
-from itertools import count
 
-BASE_URL = "https://cs.upi.edu/v2/news_list/{}"
-SWITCH_URL = "https://cs.upi.edu/v2/lang/set_language/ID"
-session = requests.Session()
-all_news = []
-id_counter = count(1)
+from engine import Fetcher, Checkpoint, SCRAPE_WORKERS, SCRAPE_RATE, SCRAPE_CACHE_DIR
+
+SITE_URL = os.getenv('SCRAPE_SITE_URL', "https://cs.upi.edu/v2")
+BASE_URL = SITE_URL + "/news_list/{}"
+SWITCH_URL = SITE_URL + "/lang/set_language/ID"
+KNOWN_NEWS_PATH = "data/final_id/CSE_News.json"
+_switch_lock = threading.Lock()
 
 def check_language(soup):
     lang_el = soup.select_one("li.row-end a i")
@@ -17,25 +25,25 @@ def check_language(soup):
     if "indonesia" in text:
         return "english"
     elif "english" in text:
-        return "indonesia" 
+        return "indonesia"
     return "unknown"
 
-def ensure_indonesian(url):
-    r = session.get(url)
-    soup = BeautifulSoup(r.text, "html.parser")
-    lang = check_language(soup)
+def set_indonesian(fetcher):
+    # the language lives in the session cookie, set once before crawling
+    fetcher.get(SWITCH_URL, use_cache=False)
 
-    if lang == "english":
-        session.get(SWITCH_URL)  # set ke Indonesia
-        # reload halaman
-        r = session.get(url)
-        soup = BeautifulSoup(r.text, "html.parser")
+def ensure_indonesian(fetcher, url):
+    soup = BeautifulSoup(fetcher.get(url), "html.parser")
 
-    return soup
+    if check_language(soup) == "english":
+        # cookie lost or expired: set it again and reload the page
+        with _switch_lock:
+            set_indonesian(fetcher)
+        soup = BeautifulSoup(fetcher.get(url, use_cache=False), "html.parser")
 
-def scrape_detail(url):
-    soup = ensure_indonesian(url)
+    return soup
 
+def parse_detail(soup):
     title = soup.find("h3").get_text(strip=True)
     meta = soup.find("h6").get_text(" ", strip=True)
 
@@ -52,12 +60,10 @@ def scrape_detail(url):
     ]
     content = "\n".join(paragraphs)
     images = [img["src"] for img in detail_div.find_all("img")]
-    idx = next(id_counter)
     return {
         # "url": url,
         # "author": author,
         # "images": images
-        "_id": f"cs_news_{idx}",
         "section": "Berita Ilmu Komputer",
         "title": title,
         "type": ["Berita"],
@@ -65,37 +71,139 @@ def scrape_detail(url):
         "text": f"Berita {title} tanggal : " + date + " " + content
     }
 
-def scrape_list(page=0):
-    url = BASE_URL.format(page if page else "")
-    soup = ensure_indonesian(url)
+def scrape_detail(fetcher, url):
+    return parse_detail(ensure_indonesian(fetcher, url))
 
+def parse_list(soup, page_url):
+    # (detail link, title) of a list page, in page order (newest first)
+    entries = []
     blocks = soup.select("div.col-sm-12.col-md-12.col-xs-12")
     for b in blocks:
         a = b.select_one("h4 a")
-        if not a: 
+        if not a:
             continue
-
-        link = a["href"]
-        thumb_style = b.select_one(".center-cropped-menejemen")["style"]
-        thumb_url = re.search(r"url\('(.*?)'\)", thumb_style).group(1)
-
-        short = b.select_one("div.col-sm-9 p").get_text(strip=True)
-
-        try:
-            detail = scrape_detail(link)
-            # detail.update({
-            #     "thumbnail": thumb_url,
-            #     "excerpt": short
-            # })
-            all_news.append(detail)
-            time.sleep(1)
-        except Exception as e:
-            print("Error detail:", link, e)
-
-
-for page in range(0, 240, 10):
-    print("Scraping page:", page)
-    scrape_list(page)
-
-with open("upi_news.json", "w", encoding="utf-8") as f:
-    json.dump(all_news, f, ensure_ascii=False, indent=2)
+        entries.append((urljoin(page_url, a["href"]), a.get_text(strip=True)))
+    return entries
+
+def article_id(url):
+    # stable id from the article path: independent of host, crawl order and newer articles
+    parts = urlsplit(url)
+    key = parts.path.rstrip("/") + ("?" + parts.query if parts.query else "")
+    return "cs_news_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+def normalize_title(title):
+    return " ".join(title.lower().split())
+
+def load_known(paths):
+    """
+    Ids and titles of the articles already in the knowledge base (json array or jsonl).
+    Titles catch records from before url-based ids (cs_news_<n>), chunk suffixes are stripped.
+    """
+    ids, titles = set(), set()
+    for path in paths:
+        if not os.path.isfile(path):
+            print(f"WARN: {path} tidak ada, semua berita dianggap baru")
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            items = [json.loads(line) for line in f if line.strip()] if path.endswith(".jsonl") else json.load(f)
+        for item in items:
+            ids.update({item["_id"], item["_id"].rsplit("_", 1)[0]})
+            for field in ("title", "section"):
+                if item.get(field):
+                    titles.add(normalize_title(re.sub(r" Group \d+/\d+$", "", item[field])))
+    return ids, titles
+
+def is_known(known, link, title):
+    ids, titles = known
+    return article_id(link) in ids or normalize_title(title) in titles
+
+def list_url(page=0):
+    return BASE_URL.format(page if page else "")
+
+def collect_links(fetcher, pages, known=None):
+    """
+    Detail links from the list pages, newest first. Without known, all pages are fetched at
+    once; with known (see load_known), paging stops at the first article that is already
+    known, pages are fetched in windows of 1, 2, 4, ... up to the pool size.
+    """
+    links = []
+    page_urls = [list_url(page) for page in pages]
+    start = 0
+    window = 1 if known is not None else len(page_urls)
+    while start < len(page_urls):
+        batch = page_urls[start:start + window]
+        start += len(batch)
+        window = min(window * 2, fetcher.workers)
+        for url, soup, error in fetcher.map(lambda u: ensure_indonesian(fetcher, u), batch):
+            if error is not None:
+                print("Error list:", url, error)
+                continue
+            for link, title in parse_list(soup, url):
+                if known is not None and is_known(known, link, title):
+                    print(f"berhenti di berita yang sudah ada: {title} ({url})")
+                    return list(dict.fromkeys(links))
+                links.append(link)
+    return list(dict.fromkeys(links))
+
+def iter_crawl(fetcher, pages, checkpoint, known=None):
+    """
+    Collect the detail links, then fetch every detail page not in the checkpoint on the
+    fetcher's pool. Yields (link, article) pairs in list order as soon as they are available.
+    """
+    links = collect_links(fetcher, pages, known)
+
+    todo = [link for link in links if link not in checkpoint]
+    print(f"{len(links)} berita, {len(links) - len(todo)} dari checkpoint, {len(todo)} diambil")
+    fetched = fetcher.map(lambda u: scrape_detail(fetcher, u), todo)
+    todo = set(todo)
+    for link in links:
+        if link not in todo:
+            yield link, checkpoint.get(link)
+            continue
+        link, detail, error = next(fetched)
+        if error is not None:
+            print("Error detail:", link, error)
+            continue
+        checkpoint.put(link, detail)
+        yield link, detail
+    checkpoint.save()
+
+def crawl(fetcher, pages, checkpoint, known=None):
+    return list(iter_crawl(fetcher, pages, checkpoint, known))
+
+def merge_news(path, records):
+    # newest first, like the list pages; existing records are kept unchanged
+    with open(path, "r", encoding="utf-8") as f:
+        existing = json.load(f)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records + existing, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=24, help="number of list pages (10 news per page)")
+    parser.add_argument("--workers", type=int, default=SCRAPE_WORKERS)
+    parser.add_argument("--rate", type=float, default=SCRAPE_RATE, help="requests per second per host")
+    parser.add_argument("--cache-dir", default=SCRAPE_CACHE_DIR, help="HTTP cache folder, empty to disable")
+    parser.add_argument("--checkpoint", default="upi_news.checkpoint.json")
+    parser.add_argument("--output", default="upi_news.json")
+    parser.add_argument("--incremental", action="store_true",
+                        help="stop paging at the first article already in --known and write only the new ones")
+    parser.add_argument("--known", nargs="+", default=[KNOWN_NEWS_PATH], help="news already in the knowledge base")
+    parser.add_argument("--merge", action="store_true", help="also prepend the new articles to the first --known file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    known = load_known(args.known) if args.incremental else None
+    fetcher = Fetcher(workers=args.workers, rate=args.rate, cache_dir=args.cache_dir)
+    set_indonesian(fetcher)
+    news = crawl(fetcher, range(0, args.pages * 10, 10), Checkpoint(args.checkpoint), known)
+    fetcher.close()
+
+    all_news = [{"_id": article_id(link), **item} for link, item in news]
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(all_news, f, ensure_ascii=False, indent=2)
+    print(f"{len(all_news)} berita ditulis ke {args.output} dalam {time.perf_counter() - start:.1f}s, {dict(fetcher.stats)}")
+    if args.incremental and args.merge and all_news:
+        merge_news(args.known[0], all_news)
+        print(f"{len(all_news)} berita baru ditambahkan ke {args.known[0]}")
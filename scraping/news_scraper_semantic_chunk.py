@@ -1,84 +1,96 @@
-import requests
-from bs4 import BeautifulSoup
-import time, json, re
-from itertools import count
+"""
+News scraper that splits every article into semantic chunks.
+Scraping and chunking run concurrently: the crawl thread puts articles on a bounded queue,
+the chunking stage takes up to CHUNK_BATCH_ARTICLES of them at a time, embeds all their
+(combined) sentences that are not cached yet in one embed_documents call, and then lets
+SemanticChunker split each article from the cache. Sentence embeddings are cached by text in
+SENTENCE_CACHE_PATH, so re-chunking unchanged articles costs no embedding calls.
+--cache-chunk-embeddings also embeds the resulting chunks with the ingestion embedder into the
+embedding cache (EMBED_CACHE_PATH), which setup_pinecone.py reuses instead of embedding again.
+"""
+import argparse
+import json
 import os
+import queue
+import re
+import sys
+import threading
+import time
 from dotenv import load_dotenv
 
-from langchain_experimental.text_splitter import SemanticChunker
+from langchain_core.embeddings import Embeddings
+from langchain_experimental.text_splitter import SemanticChunker, combine_sentences
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
-load_dotenv()
+from engine import Fetcher, Checkpoint, SCRAPE_WORKERS, SCRAPE_RATE, SCRAPE_CACHE_DIR
+from news_scraper import KNOWN_NEWS_PATH, article_id, iter_crawl, load_known, merge_news, set_indonesian
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+from embedding_cache import EmbeddingCache
 
-embeddings = GoogleGenerativeAIEmbeddings(
-    google_api_key=os.getenv('GOOGLE_API_KEY'),
-    model="gemini-embedding-001"
+load_dotenv()
+SENTENCE_EMBED_MODEL = "gemini-embedding-001"
+SENTENCE_CACHE_PATH = os.getenv('SENTENCE_CACHE_PATH', os.path.join(SCRAPE_CACHE_DIR, "sentence_embeddings.db"))
+CHUNK_BATCH_ARTICLES = int(os.getenv('CHUNK_BATCH_ARTICLES', '16'))
+# seconds the chunking stage waits for a batch to fill before embedding what it has
+CHUNK_BATCH_WAIT = float(os.getenv('CHUNK_BATCH_WAIT', '5'))
+
+
+class CachedEmbeddings(Embeddings):
+    # embeddings looked up by text first; prefetch() embeds every uncached text in one call
+
+    def __init__(self, embeddings, model, cache):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+        self.embedded = 0
+
+    def prefetch(self, texts):
+        missing = list(dict.fromkeys(t for t in texts if self.cache.get(self.model, None, t) is None))
+        if missing:
+            self.cache.put_many(self.model, None, zip(missing, self.embeddings.embed_documents(missing)))
+            self.embedded += len(missing)
+        return len(missing)
+
+    def embed_documents(self, texts):
+        self.prefetch(texts)
+        return [self.cache.get(self.model, None, t) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+embeddings = CachedEmbeddings(
+    GoogleGenerativeAIEmbeddings(
+        google_api_key=os.getenv('GOOGLE_API_KEY'),
+        model=SENTENCE_EMBED_MODEL
+    ),
+    SENTENCE_EMBED_MODEL,
+    EmbeddingCache(max_entries=100_000, ttl=None, disk_path=SENTENCE_CACHE_PATH or None)
 )
 text_splitter = SemanticChunker(
     embeddings, breakpoint_threshold_type="gradient"
 )
 
-BASE_URL = "https://cs.upi.edu/v2/news_list/{}"
-SWITCH_URL = "https://cs.upi.edu/v2/lang/set_language/ID"
-session = requests.Session()
-all_news = []
-id_counter = count(1)
-
-def check_language(soup):
-    lang_el = soup.select_one("li.row-end a i")
-    if not lang_el:
-        return "unknown"
-    text = lang_el.get_text(strip=True).lower()
-    if "indonesia" in text:
-        return "english"
-    elif "english" in text:
-        return "indonesia"
-    return "unknown"
-
-def ensure_indonesian(url):
-    r = session.get(url)
-    soup = BeautifulSoup(r.text, "html.parser")
-    lang = check_language(soup)
-
-    if lang == "english":
-        session.get(SWITCH_URL)  # switch to Indonesian
-        # reload halaman
-        r = session.get(url)
-        soup = BeautifulSoup(r.text, "html.parser")
-
-    return soup
-
-def scrape_detail(url):
-    soup = ensure_indonesian(url)
-
-    title = soup.find("h3").get_text(strip=True)
-    meta = soup.find("h6").get_text(" ", strip=True)
-
-    author = re.search(r"oleh:\s*(.*?)\s{2,}", meta)
-    author = author.group(1) if author else None
-
-    date = re.search(r"\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}", meta)
-    date = date.group(0) if date else None
-
-    detail_div = soup.find("div", class_="news-detail")
-    paragraphs = [
-        p.get_text(" ", strip=True)
-        for p in detail_div.find_all("p", recursive=False)
-    ]
-    content = "\n".join(paragraphs)
-
-    full_text = f"Berita {title} tanggal : {date}\n{content}"
-
-    docs = text_splitter.create_documents([full_text])
+def combined_sentences(text):
+    # the texts SemanticChunker.split_text embeds for text (none when it does not split)
+    sentences = re.split(text_splitter.sentence_split_regex, text)
+    if len(sentences) == 1 or (text_splitter.breakpoint_threshold_type == "gradient" and len(sentences) == 2):
+        return []
+    items = combine_sentences([{"sentence": s, "index": i} for i, s in enumerate(sentences)], text_splitter.buffer_size)
+    return [item["combined_sentence"] for item in items]
+
+def chunk_article(news_id, article):
+    # the article text split into semantic chunks, ids are <news_id>_<chunk>
+    docs = text_splitter.create_documents([article["text"]])
     chunks = [d.page_content for d in docs]
 
-    news_idx = next(id_counter)
     chunked_records = []
-
     for c_idx, chunk in enumerate(chunks, start=1):
         chunked_records.append({
-            "_id": f"cs_news_{news_idx}_{c_idx}",
-            "section": title + f" Group {c_idx}/{len(chunks)}",
+            "_id": f"{news_id}_{c_idx}",
+            "section": article["title"] + f" Group {c_idx}/{len(chunks)}",
             "title": "Berita Ilmu Komputer",
             "type": ["Berita"],
             "lang": "id",
@@ -87,28 +99,95 @@ def scrape_detail(url):
 
     return chunked_records
 
-def scrape_list(page=0):
-    url = BASE_URL.format(page if page else "")
-    soup = ensure_indonesian(url)
-
-    blocks = soup.select("div.col-sm-12.col-md-12.col-xs-12")
-    for b in blocks:
-        a = b.select_one("h4 a")
-        if not a:
-            continue
-
-        link = a["href"]
-
+def chunk_batch(batch):
+    # chunks of a batch of (link, article), sentence embeddings fetched together up front
+    try:
+        embeddings.prefetch([s for _, article in batch for s in combined_sentences(article["text"])])
+    except Exception as e:
+        print(f"Error embedding batch of {len(batch)} berita: {e}")
+    records = []
+    for link, article in batch:
         try:
-            detail = scrape_detail(link)
-            all_news.extend(detail)
-            time.sleep(1)
+            records.extend(chunk_article(article_id(link), article))
         except Exception as e:
-            print("Error detail:", link, e)
-
-for page in range(0, 10, 10):
-    print("Scraping page:", page)
-    scrape_list(page)
-
-with open("upi_news.json", "w", encoding="utf-8") as f:
-    json.dump(all_news, f, ensure_ascii=False, indent=2)
+            print("Error chunk:", link, e)
+    return records
+
+def iter_batches(articles, batch_size=CHUNK_BATCH_ARTICLES, wait=CHUNK_BATCH_WAIT):
+    # batches from a queue of (link, article) ended by None
+    batch = []
+    deadline = None
+    while True:
+        try:
+            item = articles.get(timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+        except queue.Empty:
+            item = False
+        if item:
+            batch.append(item)
+            deadline = deadline if len(batch) > 1 else time.monotonic() + wait
+        if batch and (item is None or item is False or len(batch) >= batch_size):
+            yield batch
+            batch = []
+        if item is None:
+            return
+
+def produce(articles, fetcher, pages, checkpoint, known):
+    try:
+        for pair in iter_crawl(fetcher, pages, checkpoint, known):
+            articles.put(pair)
+    finally:
+        articles.put(None)
+
+def cache_chunk_embeddings(records):
+    # ingestion embeddings for the chunks, stored in the document embedding cache for setup_pinecone.py
+    from setup_pinecone import cache_dense_embeddings
+    return cache_dense_embeddings([item["text"] for item in records])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1, help="number of list pages (10 news per page)")
+    parser.add_argument("--workers", type=int, default=SCRAPE_WORKERS)
+    parser.add_argument("--rate", type=float, default=SCRAPE_RATE, help="requests per second per host")
+    parser.add_argument("--cache-dir", default=SCRAPE_CACHE_DIR, help="HTTP cache folder, empty to disable")
+    parser.add_argument("--checkpoint", default="upi_news.checkpoint.json")
+    parser.add_argument("--output", default="upi_news.json")
+    parser.add_argument("--incremental", action="store_true",
+                        help="stop paging at the first article already in --known and write only the new ones")
+    parser.add_argument("--known", nargs="+", default=[KNOWN_NEWS_PATH], help="news already in the knowledge base")
+    parser.add_argument("--merge", action="store_true", help="also prepend the new chunks to the first --known file")
+    parser.add_argument("--cache-chunk-embeddings", action="store_true",
+                        help="embed the chunks for ingestion now and keep them in the document embedding cache (DOC_EMBED_CACHE_PATH)")
+    args = parser.parse_args()
+    if args.cache_chunk_embeddings and not os.getenv('DOC_EMBED_CACHE_PATH'):
+        print("WARN: DOC_EMBED_CACHE_PATH tidak di-set, embedding chunk tidak akan tersimpan untuk ingestion")
+
+    start = time.perf_counter()
+    known = load_known(args.known) if args.incremental else None
+    fetcher = Fetcher(workers=args.workers, rate=args.rate, cache_dir=args.cache_dir)
+    set_indonesian(fetcher)
+    articles = queue.Queue(maxsize=4 * CHUNK_BATCH_ARTICLES)
+    producer = threading.Thread(
+        target=produce, name="crawl", daemon=True,
+        args=(articles, fetcher, range(0, args.pages * 10, 10), Checkpoint(args.checkpoint), known)
+    )
+    producer.start()
+
+    all_news = []
+    n_articles = 0
+    for batch in iter_batches(articles):
+        records = chunk_batch(batch)
+        if args.cache_chunk_embeddings and records:
+            cache_chunk_embeddings(records)
+        all_news.extend(records)
+        n_articles += len(batch)
+        print(f"{n_articles} berita di-chunk, {embeddings.embedded} kalimat di-embed")
+    producer.join()
+    fetcher.close()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(all_news, f, ensure_ascii=False, indent=2)
+    print(f"{len(all_news)} chunk dari {n_articles} berita ditulis ke {args.output} dalam {time.perf_counter() - start:.1f}s")
+    if args.incremental and args.merge and all_news:
+        merge_news(args.known[0], all_news)
+        print(f"{len(all_news)} chunk baru ditambahkan ke {args.known[0]}")
@@ -1,15 +1,23 @@
-from pinecone.grpc import PineconeGRPC as Pinecone
-from pinecone_text.sparse import BM25Encoder
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from setup_pinecone import get_dense_embeddings, get_sparse_embeddings
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import AIMessageChunk
+from setup_pinecone import get_dense_embeddings, aget_dense_embeddings, get_sparse_embeddings, read_corpus_records, get_backends, index_version
+from backends import acall
+from local_index import LocalSparseIndex, LocalDenseIndex
+from answer_cache import AnswerCache
+from type_classifier import TypeClassifier, CLASSIFIER_MIN_CONFIDENCE, CLASSIFIER_EVAL_PATH
+import deadline
+import resources
+import scheduler
+import tracing
+from bm25_store import load_bm25_params
 import os
 from dotenv import load_dotenv
 from collections import defaultdict
+import asyncio
 import json
 import requests
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
 
 # Suppress logging warnings
 os.environ["GRPC_VERBOSITY"] = "ERROR"
@@ -26,19 +34,82 @@ SILICONFLOW_API_KEY = os.getenv('SILICONFLOW_API_KEY')
 NAMESPACE = os.getenv('NAMESPACE')
 EMBED_DIM = int(os.getenv('EMBED_DIM')) if os.getenv('EMBED_DIM') else None
 TOP_K = 10
+# run classification, embedding and index queries concurrently (set 0 to run them one by one)
+PARALLEL_RETRIEVAL = os.getenv('PARALLEL_RETRIEVAL', '1') != '0'
+RETRIEVAL_WORKERS = int(os.getenv('RETRIEVAL_WORKERS', '32'))
+# "pinecone" or "local" for both indexes, DENSE_BACKEND / SPARSE_BACKEND override per index
+RETRIEVAL_BACKEND = os.getenv('RETRIEVAL_BACKEND', 'pinecone')
+DENSE_BACKEND = os.getenv('DENSE_BACKEND', RETRIEVAL_BACKEND)
+SPARSE_BACKEND = os.getenv('SPARSE_BACKEND', RETRIEVAL_BACKEND)
+# local sparse index is built from the corpus, local dense index is written by setup_pinecone.py
+CORPUS_PATH = os.getenv('CORPUS_PATH', 'data/final_id')
+DENSE_INDEX_PATH = os.getenv('DENSE_INDEX_PATH', 'model/dense_index')
+# "local": TF-IDF type classifier, the LLM only for low-confidence queries; "llm": always the LLM
+CLASSIFIER = os.getenv('CLASSIFIER', 'local')
+# semantic answer cache (opt-in)
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '0') == '1'
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '512'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL')) if os.getenv('ANSWER_CACHE_TTL') else None
 
-# config
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index_dense = pc.Index(host=HOST_PINECONE_DENSE)
-index_sparse = pc.Index(host=HOST_PINECONE_SPARSE)
+# shared pool for network-bound retrieval calls
+executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
 
-# load bm25 model
-bm25 = BM25Encoder(stem=False)
-try:
-    bm25.load("model/bm25_params.json")
-    print("bm25 params loaded")
-except Exception as e:
-    print("WARN: gagal load bm25 params", e)
+answer_cache = AnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    max_entries=ANSWER_CACHE_SIZE,
+    ttl=ANSWER_CACHE_TTL
+) if ANSWER_CACHE else None
+
+# heavy resources are created on first use, once per process (see resources.py)
+def load_bm25():
+    from pinecone_text.sparse import BM25Encoder
+    bm25 = BM25Encoder(stem=False)
+    try:
+        load_bm25_params(bm25)
+        print("bm25 params loaded")
+    except Exception as e:
+        print("WARN: gagal load bm25 params", e)
+    return bm25
+
+def load_local_sparse():
+    if SPARSE_BACKEND != 'local':
+        return None
+    local_sparse = LocalSparseIndex.build(read_corpus_records(CORPUS_PATH), get_bm25())
+    print("local sparse index built:", local_sparse.n_docs, "docs")
+    return local_sparse
+
+def load_local_dense():
+    if DENSE_BACKEND != 'local':
+        return None
+    try:
+        local_dense = LocalDenseIndex.load(DENSE_INDEX_PATH)
+        print("local dense index loaded:", local_dense.n_docs, "docs")
+        return local_dense
+    except FileNotFoundError as e:
+        print("WARN: gagal load local dense index, pakai Pinecone", e)
+        return None
+
+def load_type_classifier(eval_path=CLASSIFIER_EVAL_PATH, exclude_queries=()):
+    if CLASSIFIER != 'local':
+        return None
+    classifier = TypeClassifier.from_corpus(CORPUS_PATH, eval_path, exclude_queries)
+    print("type classifier trained:", len(classifier.types), "types")
+    return classifier
+
+resources.register("bm25", load_bm25)
+resources.register("local_sparse", load_local_sparse)
+resources.register("local_dense", load_local_dense)
+resources.register("type_classifier", load_type_classifier)
+
+def get_bm25():
+    return resources.get("bm25")
+
+def warm_up():
+    # create clients and load models before the first request, returns seconds per resource
+    timings = resources.warm_up(["backends", "embedding_cache", "bm25", "local_sparse", "local_dense", "type_classifier"])
+    print("warm up:", {name: round(sec, 3) for name, sec in timings.items()})
+    return timings
 
 # List of types
 TYPES = ['Berita', 'Fasilitas', 'Fasilitas Departemen Ilmu Komputer', 'Fasilitas Fakultas/FPMIPA', 'Fasilitas Universitas/UPI', 'KBK/Penjurusan', 'Mata Kuliah', 'Metode Pengajaran', 
@@ -48,8 +119,7 @@ TYPES = ['Berita', 'Fasilitas', 'Fasilitas Departemen Ilmu Komputer', 'Fasilitas
          'mata kuliah pendidikan ilmu komputer', 'metode pengajaran pendidikan ilmu komputer', 'metode penilaian pendidikan ilmu komputer', 'pelayanan administrasi', 
          'pendaftaran', 'penjaminan mutu', 'pertukaran mahasiswa', 'prestasi', 'program info magister pendidikan ilmu komputer', 'program info pendidikan ilmu komputer']
 
-def classify_query(query, chat_history):
-    template = """Klasifikasikan query berikut dan, jika ada, riwayat obrolan ke dalam satu atau lebih kategori dari list ini: {types}.
+CLASSIFY_TEMPLATE = """Klasifikasikan query berikut dan, jika ada, riwayat obrolan ke dalam satu atau lebih kategori dari list ini: {types}.
     Kembalikan daftar kategori yang relevan dalam format list of string (misalnya, ["KBK/Penjurusan", "Mata Kuliah"]).
     Jika ada yang bertanya terkait profil kualifikasi lulusan, capaian pembelajaran masukkan ke kategori ["ProgramInfo"].
     Jika ada yang bertanya terkait tujuan masukkan ke kategori ["Visi dan Misi"]
@@ -62,115 +132,276 @@ def classify_query(query, chat_history):
     Riwayat obrolan:
     {chat_history}
     """
-    prompt = ChatPromptTemplate.from_template(template)
-    # gpt-4.1-mini / gpt-4.1-nano / o4-mini
-    model = ChatOpenAI(model_name="gpt-4.1-mini", max_retries=4, timeout=60)
-    chain = prompt | model
+classify_prompt = ChatPromptTemplate.from_template(CLASSIFY_TEMPLATE)
+
+def parse_classification(content):
     try:
-        response = chain.invoke({"types": TYPES, "query": query, "chat_history": chat_history})
-        classified_types = json.loads(response.content.strip())
+        classified_types = json.loads(content.strip())
         # Validate that all returned types are in TYPES
         classified_types = [t for t in classified_types if t in TYPES]
         # If no valid types or empty, return ["Other"]
         return classified_types if classified_types else ["Other"]
     except json.JSONDecodeError as e:
-        print(f"Failed to parse classify_query response: {response.content}, error: {str(e)}")
+        print(f"Failed to parse classify_query response: {content}, error: {str(e)}")
         return ["Other"]
 
-def search_dense_index(text: str, filter_types=None):
-    query_dense = get_dense_embeddings(text, EMBED_DIM)
-    # using filter
-    filter_query = {}
+def last_user_turn(chat_history, query):
+    # previous question of the conversation (the history may already end with the query itself)
+    for message in reversed(chat_history or []):
+        if getattr(message, "type", None) == "human" and message.content != query:
+            return message.content
+    return None
+
+def local_classification(query, chat_history=None):
+    # types from the local classifier, None when it is off or not confident enough for the query
+    classifier = resources.get("type_classifier")
+    if classifier is None:
+        return None
+    # a follow-up ("kalau yang S2?") gets its type from the question before it
+    previous = last_user_turn(chat_history, query)
+    with tracing.span("classify_local", history_turns=len(chat_history or [])) as span:
+        classified_types, confidence = classifier.classify(f"{previous}\n{query}" if previous else query)
+        classified_types = [t for t in classified_types if t in TYPES] or ["Other"]
+        span.set(types=",".join(classified_types), confidence=round(confidence, 3))
+    if confidence < CLASSIFIER_MIN_CONFIDENCE:
+        tracing.event("classify_llm_fallback", confidence=round(confidence, 3))
+        return None
+    return classified_types
+
+def classify_query(query, chat_history):
+    classified_types = local_classification(query, chat_history)
+    if classified_types is not None:
+        return classified_types
+    # gpt-4.1-mini / gpt-4.1-nano / o4-mini
+    if not deadline.allows("classify"):
+        return ["Other"]
+    model = get_backends().llm.chat_model()
+    chain = classify_prompt | model
+    try:
+        with scheduler.upstream("llm").slot(scheduler.OPTIONAL_STAGE_MAX_WAIT), \
+                tracing.span("classify", history_turns=len(chat_history)) as span:
+            response = chain.invoke({"types": TYPES, "query": query, "chat_history": chat_history})
+            classified_types = parse_classification(response.content)
+            span.set(types=",".join(classified_types))
+            return classified_types
+    except scheduler.Overloaded as e:
+        # classification only narrows the search, the unfiltered results are enough
+        print(f"Klasifikasi dilewati: {e}")
+        tracing.event("classify_skipped", reason=e.reason)
+        return ["Other"]
+
+def build_type_filter(filter_types):
+    # metadata filter for classified types, None means no filter
     if filter_types and filter_types != ["Other"]:
-        filter_query = {"type": {"$in": filter_types}}
-    
-    dense_response = index_dense.query(
-        namespace=NAMESPACE,
-        vector= query_dense,
-        top_k=TOP_K,
-        include_metadata=True,
-        include_values=False,
-        filter=filter_query if filter_query else None
-    )
-    
-    matches = dense_response.get("matches", []) or []
-    dense_results = []
+        return {"type": {"$in": filter_types}}
+    return None
+
+def parse_matches(response):
+    matches = response.get("matches", []) or []
+    results = []
     for item in matches:
         text = item['metadata'].get("text", '')
-        dense_results.append({
-            "id": item.get("id"),
-            "similarity": item.get('score', 0.0),
-            "text": text
-        })
-    
-    # non-filter
-    dense_response2 = index_dense.query(
-        namespace=NAMESPACE,
-        vector= query_dense,
-        top_k=TOP_K,
-        include_metadata=True,
-        include_values=False
-    )
-    
-    matches2 = dense_response2.get("matches", []) or []
-    dense_results2 = []
-    for item in matches2:
-        text = item['metadata'].get("text", '')
-        dense_results2.append({
+        results.append({
             "id": item.get("id"),
             "similarity": item.get('score', 0.0),
             "text": text
         })
-    
+    return results
+
+def result_chars(results):
+    return sum(len(r.get("text", "")) for r in results)
+
+def query_dense_index(query_dense, filter_query=None):
+    if query_dense is None:
+        return []
+    local_dense = resources.get("local_dense")
+    with tracing.span("dense_query", filtered=filter_query is not None,
+                      backend="local" if local_dense is not None else "pinecone") as span:
+        if local_dense is not None:
+            results = local_dense.query(query_dense, top_k=TOP_K, filter=filter_query)
+        else:
+            with scheduler.upstream("vector").slot():
+                dense_response = get_backends().index_dense.query(
+                    namespace=NAMESPACE,
+                    vector=query_dense,
+                    top_k=TOP_K,
+                    include_metadata=True,
+                    include_values=False,
+                    filter=filter_query
+                )
+            results = parse_matches(dense_response)
+        span.set(matches=len(results), result_chars=result_chars(results))
+        return results
+
+def query_sparse_index(query_sparse, filter_query=None):
+    local_sparse = resources.get("local_sparse")
+    with tracing.span("sparse_query", filtered=filter_query is not None, query_terms=len(query_sparse["indices"]),
+                      backend="local" if local_sparse is not None else "pinecone") as span:
+        if local_sparse is not None:
+            results = local_sparse.query(query_sparse, top_k=TOP_K, filter=filter_query)
+        else:
+            with scheduler.upstream("vector").slot():
+                sparse_response = get_backends().index_sparse.query(
+                    namespace=NAMESPACE,
+                    sparse_vector=query_sparse,
+                    top_k=TOP_K,
+                    include_metadata=True,
+                    include_values=False,
+                    filter=filter_query
+                )
+            results = parse_matches(sparse_response)
+        span.set(matches=len(results), result_chars=result_chars(results))
+        return results
+
+def local_query_both(index, span_name, query_vector, filter_query=None, **attrs):
+    # filtered and unfiltered results of a local index from a single scoring pass
+    if query_vector is None:
+        return [], []
+    with tracing.span(span_name, filtered=filter_query is not None, backend="local", **attrs) as span:
+        results_f, results_nf = index.query_both(query_vector, top_k=TOP_K, filter=filter_query)
+        span.set(matches=len(results_f), result_chars=result_chars(results_f))
+    return results_f, results_nf
+
+def search_dense_index(text: str, filter_types=None):
+    query_dense = get_dense_embeddings(text, EMBED_DIM)
+    filter_query = build_type_filter(filter_types)
+    local_dense = resources.get("local_dense")
+    if local_dense is not None:
+        return local_query_both(local_dense, "dense_query", query_dense, filter_query)
+    # using filter
+    dense_results = query_dense_index(query_dense, filter_query)
+    # non-filter, only adds to a filtered search and is skipped when the budget runs low
+    if filter_query is None or not deadline.allows("dense_unfiltered"):
+        return dense_results, dense_results
+    dense_results2 = query_dense_index(query_dense)
     return dense_results, dense_results2
 
 def search_sparse_index(text: str, filter_types=None):
-    query_sparse = get_sparse_embeddings(text=text, bm25_model=bm25, query_type='search')
+    query_sparse = get_sparse_embeddings(text=text, bm25_model=get_bm25(), query_type='search')
+    filter_query = build_type_filter(filter_types)
+    local_sparse = resources.get("local_sparse")
+    if local_sparse is not None:
+        return local_query_both(local_sparse, "sparse_query", query_sparse, filter_query,
+                                query_terms=len(query_sparse["indices"]))
     # filter
-    filter_query = {}
-    if filter_types and filter_types != ["Other"]:
-        filter_query = {"type": {"$in": filter_types}}
-    
-    sparse_response = index_sparse.query(
-        namespace=NAMESPACE,
-        sparse_vector=query_sparse,
-        top_k=TOP_K,
-        include_metadata=True,
-        include_values=False,
-        filter=filter_query if filter_query else None
-    )
-    
-    matches = sparse_response.get("matches", []) or []
-    sparse_results = []
-    for item in matches:
-        text = item['metadata'].get("text", '')
-        sparse_results.append({
-            "id": item.get("id"),
-            "similarity": item.get('score', 0.0),
-            "text": text
-        })
-
+    sparse_results = query_sparse_index(query_sparse, filter_query)
     # non filter
-    sparse_response2 = index_sparse.query(
-        namespace=NAMESPACE,
-        sparse_vector=query_sparse,
-        top_k=TOP_K,
-        include_metadata=True,
-        include_values=False
-    )
-    
-    matches2 = sparse_response2.get("matches", []) or []
-    sparse_results2 = []
-    for item in matches2:
-        text = item['metadata'].get("text", '')
-        sparse_results2.append({
-            "id": item.get("id"),
-            "similarity": item.get('score', 0.0),
-            "text": text
-        })
-    
+    if filter_query is None or not deadline.allows("sparse_unfiltered"):
+        return sparse_results, sparse_results
+    sparse_results2 = query_sparse_index(query_sparse)
     return sparse_results, sparse_results2
 
+def hybrid_search_parallel(query, chat_history, on_embedding=None):
+    """
+    Run classification, dense embedding and the unfiltered queries at the same time.
+    Filtered queries are submitted as soon as the classification (and for dense, the embedding) is ready.
+    Only the calling thread waits on futures, so pool workers never block on each other.
+    Once the request budget is down to the generation reserve, stages still running are dropped:
+    classification (no filter), and either filtered or unfiltered results as long as the other is in.
+    on_embedding(query_dense) is called once the embedding is in (answer cache lookup), when it
+    returns True the search stops and returns None.
+    A local index is queried once, for filtered and unfiltered results together (query_both),
+    as soon as the classification is known.
+    """
+    # every task is wrapped so its spans land in the caller's trace
+    submit = lambda fn, *args, **kwargs: executor.submit(tracing.in_context(fn), *args, **kwargs)
+    local_dense = resources.get("local_dense")
+    local_sparse = resources.get("local_sparse")
+    classify_future = submit(classify_query, query, chat_history)
+    embed_future = submit(get_dense_embeddings, query, EMBED_DIM)
+    # bm25 encoding is local, no need for a worker
+    query_sparse = get_sparse_embeddings(text=query, bm25_model=get_bm25(), query_type='search')
+    sparse_terms = len(query_sparse["indices"])
+    futures = {}
+    if local_sparse is None:
+        futures["sparse_nf"] = submit(query_sparse_index, query_sparse)
+
+    query_dense = None
+    filter_query = None
+    classified = embedded = False
+    pending = {classify_future, embed_future}
+    while pending:
+        done, pending = wait(pending, timeout=deadline.left(deadline.GENERATION_RESERVE), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future is embed_future:
+                query_dense = future.result()
+                embedded = True
+                if on_embedding is not None and on_embedding(query_dense):
+                    for f in (classify_future, *futures.values()):
+                        f.cancel()
+                    return None
+                if local_dense is None:
+                    futures["dense_nf"] = submit(query_dense_index, query_dense)
+            else:
+                filter_query = build_type_filter(future.result())
+                classified = True
+                if local_sparse is not None:
+                    futures["sparse_both"] = submit(local_query_both, local_sparse, "sparse_query", query_sparse,
+                                                    filter_query, query_terms=sparse_terms)
+                elif filter_query:
+                    futures["sparse_f"] = submit(query_sparse_index, query_sparse, filter_query)
+            if classified and embedded and "dense_f" not in futures and "dense_both" not in futures:
+                if local_dense is not None:
+                    futures["dense_both"] = submit(local_query_both, local_dense, "dense_query", query_dense, filter_query)
+                elif filter_query:
+                    futures["dense_f"] = submit(query_dense_index, query_dense, filter_query)
+
+    if not classified:
+        tracing.event("classify_skipped", reason="budget")
+        if local_sparse is not None:
+            futures["sparse_both"] = submit(local_query_both, local_sparse, "sparse_query", query_sparse,
+                                            query_terms=sparse_terms)
+    if "dense_nf" not in futures and "dense_both" not in futures:
+        # the embedding (for a local index, or the classification) is still running
+        query_dense = finished(embed_future, "embed") or None
+        if local_dense is not None:
+            futures["dense_both"] = submit(local_query_both, local_dense, "dense_query", query_dense, filter_query)
+        else:
+            futures["dense_nf"] = submit(query_dense_index, query_dense)
+
+    return finished_pair(futures, "dense") + finished_pair(futures, "sparse")
+
+def finished_pair(futures, kind):
+    # (filtered, unfiltered) results of one index, from its "<kind>_both" or "<kind>_f" / "<kind>_nf" futures
+    if f"{kind}_both" in futures:
+        return finished(futures[f"{kind}_both"], kind) or ([], [])
+    # without a usable filter the filtered query is identical to the unfiltered one
+    results_f = finished(futures.get(f"{kind}_f"), f"{kind}_filtered", optional=True)
+    results_nf = finished(futures[f"{kind}_nf"], f"{kind}_unfiltered", optional=results_f is not None)
+    return fallback_results(results_f, results_nf)
+
+def fallback_results(results_f, results_nf):
+    # (filtered, unfiltered) where a dropped list (None) is replaced by the other one
+    results_f = results_f if results_f is not None else results_nf
+    return results_f, results_nf if results_nf is not None else results_f
+
+def finished(future, stage, optional=False):
+    """
+    Result of a retrieval future. An optional one is dropped (None) when it is not done before
+    the generation reserve, a required one gets the rest of the budget and is an empty result
+    when that runs out.
+    """
+    if future is None:
+        return None
+    try:
+        return future.result(timeout=deadline.left(deadline.GENERATION_RESERVE if optional else 0.0))
+    except FutureTimeout:
+        tracing.event(f"{stage}_skipped", reason="budget")
+        return None if optional else []
+
+def hybrid_search(query, chat_history, on_embedding=None):
+    if PARALLEL_RETRIEVAL:
+        return hybrid_search_parallel(query, chat_history, on_embedding)
+    # the embedding is cached, so search_dense_index reuses it on a miss
+    if on_embedding is not None and on_embedding(get_dense_embeddings(query, EMBED_DIM)):
+        return None
+    classified_type = classify_query(query, chat_history)
+    dense_results_f, dense_results_nf = search_dense_index(query, filter_types=classified_type)
+    sparse_results_f, sparse_results_nf = search_sparse_index(query, filter_types=classified_type)
+    return dense_results_f, dense_results_nf, sparse_results_f, sparse_results_nf
+
 """
 RRF score(d) = Σ 1/(k+rank(d)) where k is between 1-60 where d is document
 """
@@ -190,57 +421,83 @@ def rrf_fusion(dense_results, sparse_results, k=60, top_n=TOP_K):
     # sort by rrf score desc
     fused = sorted(scores.items(), key=lambda x: x[1], reverse=True)
     all_results = {r['id']: r for r in dense_results + sparse_results}
-    fused_results = [all_results[doc_id] for doc_id, _ in fused[:top_n]]
+    fused_results = [{**all_results[doc_id], "rrf_score": score} for doc_id, score in fused[:top_n]]
 
     return fused_results
 
-def reranking_results(query, docs, fused_results, top_k=10):
+def merge_fused_results(fused_results_f, fused_results_nf):
+    """
+    Combine filtered and unfiltered fused lists by document id so every document is reranked once.
+    Each merged result keeps its provenance ("filtered", "unfiltered" or "both"),
+    the RRF score from each list and the best of the two as "rrf_score".
+    """
+    merged = {}
+    for source, results in (("filtered", fused_results_f), ("unfiltered", fused_results_nf)):
+        for res in results:
+            doc = merged.get(res['id'])
+            if doc is None:
+                merged[res['id']] = {**res, "source": source, "rrf_scores": {source: res['rrf_score']}}
+            else:
+                doc["source"] = "both"
+                doc["rrf_scores"][source] = res['rrf_score']
+                doc["rrf_score"] = max(doc["rrf_score"], res['rrf_score'])
+
+    return sorted(merged.values(), key=lambda x: x["rrf_score"], reverse=True)
+
+def valid_rerank_input(query, docs):
     # Validate inputs
     if not query or not isinstance(query, str):
         print("Invalid query: Query must be a non-empty string")
-        return fused_results
+        return False
     if not docs or not all(isinstance(doc, str) and doc.strip() for doc in docs):
         print("Invalid documents: All documents must be non-empty strings")
+        return False
+    return True
+
+def map_reranked(reranked_results, fused_results):
+    # map original data after reranking
+    final_results = []
+    for res in reranked_results:
+        index = res['index']
+        relevance_score = res['relevance_score']
+        original_result = fused_results[index]
+        final_results.append({**original_result, "similarity": relevance_score})
+
+    return final_results
+
+def fuse_results(dense_results_f, dense_results_nf, sparse_results_f, sparse_results_nf):
+    with tracing.span("fusion") as span:
+        # filter
+        fused_results_f = rrf_fusion(dense_results_f, sparse_results_f)
+        # non filter
+        fused_results_nf = rrf_fusion(dense_results_nf, sparse_results_nf)
+        # rerank unique documents from filter and non filter
+        fused_results = merge_fused_results(fused_results_f, fused_results_nf)
+        span.set(candidates=len(fused_results))
+    return fused_results
+
+def reranking_results(query, docs, fused_results, top_k=10):
+    if not valid_rerank_input(query, docs) or not deadline.allows("rerank"):
         return fused_results
-    
-    payload = {
-        "model": "Qwen/Qwen3-Reranker-8B",
-        "query": query,
-        "documents": docs,
-        "top_n": top_k,
-        "return_documents": False
-    }
-
-    headers = {
-        "Authorization": f"Bearer {SILICONFLOW_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(SILICONFLOW_URL_RERANK, headers=headers, data=json.dumps(payload))
-    if response.status_code == 200:
-        reranked_data = response.json()
-        reranked_results = reranked_data.get('results', [])
-        
-        # map original data after reranking
-        final_results = []
-        for res in reranked_results:
-            index = res['index']
-            relevance_score = res['relevance_score']
-            original_result = fused_results[index]
-            final_results.append({
-                "id": original_result['id'],
-                "similarity": relevance_score,
-                "text": original_result['text']
-            })
-        
-        return final_results
-    else:
-        print(f"Error in reranking: {response.status_code} - {response.text}")
+
+    try:
+        with scheduler.upstream("rerank").slot(scheduler.OPTIONAL_STAGE_MAX_WAIT), \
+                tracing.span("rerank", docs=len(docs), payload_chars=sum(len(doc) for doc in docs)) as span:
+            reranked_results = get_backends().reranker.rerank(query, docs, top_k)
+            span.set(results=len(reranked_results))
+    except scheduler.Overloaded as e:
+        # answer from the RRF order instead of waiting for the reranker
+        print(f"Reranking dilewati: {e}")
+        tracing.event("rerank_skipped", reason=e.reason)
+        return fused_results
+    except requests.exceptions.RequestException as e:
+        print(f"Error in reranking: {e}")
+        tracing.event("rerank_skipped", reason=type(e).__name__)
         return fused_results
 
-def context_generation(query, contexts, chat_history, streaming=True):
-    context = "\n\n".join([data.get("text", "") for data in contexts])
-    template = """Anda adalah asisten AI yang menjawab pertanyaan berdasarkan konteks yang diberikan dan, jika ada, riwayat obrolan.
+    return map_reranked(reranked_results, fused_results)
+
+GENERATION_TEMPLATE = """Anda adalah asisten AI yang menjawab pertanyaan berdasarkan konteks yang diberikan dan, jika ada, riwayat obrolan.
     Gunakan hanya informasi yang relevan dengan pertanyaan. Abaikan konteks yang tidak relevan atau ambigu.
     Jika ada yang bertanya terkait Ilkom maka merujuk pada Ilmu Komputer dan pendilkom pada Pendidikan Ilmu Komputer.
     Jika memang tidak ada di konteks suruh user berikan pertanyaan yang lebih detail. Prioritaskan ini dibandingkan "Saya tidak tahu." 
@@ -256,30 +513,363 @@ def context_generation(query, contexts, chat_history, streaming=True):
     Riwayat obrolan:
     {chat_history}
     """
+generation_prompt = ChatPromptTemplate.from_template(GENERATION_TEMPLATE)
 
-    prompt = ChatPromptTemplate.from_template(template)
-    model = ChatOpenAI(model_name="gpt-4.1-mini", streaming=streaming, max_retries=4, timeout=60)
-    chain = prompt | model
+def build_generation_prompt(query, contexts, chat_history):
+    # prompt messages for the answer, built once and passed to the model
+    context = "\n\n".join([data.get("text", "") for data in contexts])
+    return generation_prompt.format_messages(context=context, query=query, chat_history=chat_history)
+
+def generation_model(streaming):
+    # the budget only covers the time until the answer starts: a stream gets what is left of it,
+    # a complete (non-streaming) answer the full LLM_TIMEOUT and its retries
+    if streaming:
+        return get_backends().llm.chat_model(streaming=True)
+    with deadline.use_deadline(0):
+        return get_backends().llm.chat_model(streaming=False)
+
+def context_generation(query, contexts, chat_history, streaming=True):
+    with tracing.span("prompt", contexts=len(contexts)) as span:
+        messages = build_generation_prompt(query, contexts, chat_history)
+        span.set(prompt_chars=sum(len(m.content) for m in messages))
+        model = generation_model(streaming)
+    llm = scheduler.upstream("llm")
     if not streaming:
-        response = chain.invoke({"context": context, "query": query, "chat_history": chat_history})
+        with llm.slot(), tracing.span("generation") as span:
+            response = model.invoke(messages)
+            span.set(chars=len(response.content))
+            if getattr(response, "usage_metadata", None):
+                span.set(output_tokens=response.usage_metadata.get("output_tokens", 0))
         return response.content
     else:
-        return chain.stream({"context": context, "query": query, "chat_history": chat_history})
+        # ttft / generation are recorded while the stream is consumed (tracing.traced_stream),
+        # the llm slot is held until then
+        with tracing.span("llm_wait"):
+            llm.acquire()
+        return scheduler.released(model.stream(messages), llm.release)
 
-def RAG_pipeline(query, chat_history, streaming=True):
-    print("start : ", datetime.now())
-    classified_type = classify_query(query, chat_history)
-    dense_results_f, dense_results_nf = search_dense_index(query, filter_types=classified_type)
-    sparse_results_f, sparse_results_nf = search_sparse_index(query, filter_types=classified_type)
-    # filter
-    fused_results_f = rrf_fusion(dense_results_f, sparse_results_f)
-    docs_f = [result['text'] for result in fused_results_f]
-    # non filter
-    fused_results_nf = rrf_fusion(dense_results_nf, sparse_results_nf)
-    docs_nf = [result['text'] for result in fused_results_nf]
-    # rerank from filter and non filter
-    fused_results_f.extend(fused_results_nf)
-    docs_f.extend(docs_nf)
-    contexts = reranking_results(query, docs_f, fused_results_f)
-    
-    return context_generation(query, contexts, chat_history, streaming=streaming)
\ No newline at end of file
+def cached_answer_stream(answer):
+    # same chunk type as ChatOpenAI.stream so callers don't need to know about the cache
+    yield AIMessageChunk(content=answer)
+
+def caching_stream(stream, cache, query):
+    # pass chunks through and store the full answer once the stream is consumed
+    answer = ""
+    for chunk in stream:
+        answer += getattr(chunk, "content", "") or ""
+        yield chunk
+    cache.add(query, answer)
+
+def RAG_pipeline(query, chat_history, streaming=True, trace=None, budget=None):
+    """
+    Answer query, streamed as message chunks unless streaming=False.
+    Per-stage timings go to trace (a new tracing.Trace unless given), which is finished once
+    the answer is complete, for a stream when it has been consumed.
+    budget: seconds until the answer starts (default REQUEST_BUDGET), optional stages are
+    skipped to keep it (deadline.py).
+    """
+    trace = trace or tracing.Trace("rag_pipeline")
+    budget = deadline.REQUEST_BUDGET if budget is None else budget
+    trace.set(query_chars=len(query), history_turns=len(chat_history), streaming=streaming, budget=budget)
+    admission = scheduler.admission
+    with tracing.use_trace(trace), deadline.use_deadline(budget):
+        # queued here when MAX_ACTIVE_REQUESTS are running, Overloaded when the queue is full
+        with tracing.span("admission"):
+            admission.enter()
+        try:
+            response, cache = pipeline_response(query, chat_history, streaming)
+        except BaseException:
+            admission.leave()
+            raise
+    if streaming:
+        if cache is not None:
+            response = caching_stream(response, cache, query)
+        # outermost, so closing the returned stream frees the slot even when it was never read
+        return scheduler.released(tracing.traced_stream(response, trace), admission.leave)
+    admission.leave()
+    if cache is not None:
+        cache.add(query, response)
+    trace.finish()
+    return response
+
+class AnswerLookup:
+    # answer cache lookup, run by the retrieval as soon as the query embedding is in
+    def __init__(self):
+        self.vector = None
+        self.answer = None
+        # answers are tied to the index they were generated from
+        self.version = (NAMESPACE, index_version())
+
+    def __call__(self, query_vector):
+        # True on a hit, the retrieval still running is then dropped
+        self.vector = query_vector
+        with tracing.span("answer_cache") as span:
+            cached = answer_cache.lookup(query_vector, self.version)
+            span.set(hit=cached is not None)
+        if cached is not None:
+            self.answer, _ = cached
+        return cached is not None
+
+    def add(self, query, answer):
+        answer_cache.add(self.vector, query, answer, self.version)
+
+def pipeline_response(query, chat_history, streaming):
+    # (response, AnswerLookup to cache the answer with, None when it should not be cached)
+    lookup = AnswerLookup() if answer_cache is not None and not chat_history else None
+    with tracing.span("retrieval"):
+        results = hybrid_search(query, chat_history, on_embedding=lookup)
+    if results is None:
+        return (cached_answer_stream(lookup.answer) if streaming else lookup.answer), None
+    dense_results_f, dense_results_nf, sparse_results_f, sparse_results_nf = results
+    fused_results = fuse_results(dense_results_f, dense_results_nf, sparse_results_f, sparse_results_nf)
+    docs = [result['text'] for result in fused_results]
+    contexts = reranking_results(query, docs, fused_results)
+    cache = lookup if lookup is not None and cacheable(contexts) else None
+
+    return context_generation(query, contexts, chat_history, streaming=streaming), cache
+
+def cacheable(contexts):
+    # answers of a degraded request (a stage skipped, nothing retrieved) are not cached
+    trace = tracing.current_trace()
+    return bool(contexts) and not (trace is not None and trace.fallbacks())
+
+
+# async pipeline: same stages and spans as above, for callers that serve many conversations
+# from one event loop (no thread per request is blocked on I/O)
+
+async def aclassify_query(query, chat_history):
+    classified_types = local_classification(query, chat_history)
+    if classified_types is not None:
+        return classified_types
+    if not deadline.allows("classify"):
+        return ["Other"]
+    model = get_backends().llm.chat_model()
+    chain = classify_prompt | model
+    try:
+        async with scheduler.upstream("llm").aslot(scheduler.OPTIONAL_STAGE_MAX_WAIT):
+            with tracing.span("classify", history_turns=len(chat_history)) as span:
+                response = await chain.ainvoke({"types": TYPES, "query": query, "chat_history": chat_history})
+                classified_types = parse_classification(response.content)
+                span.set(types=",".join(classified_types))
+                return classified_types
+    except scheduler.Overloaded as e:
+        print(f"Klasifikasi dilewati: {e}")
+        tracing.event("classify_skipped", reason=e.reason)
+        return ["Other"]
+
+async def aquery_dense_index(query_dense, filter_query=None):
+    if query_dense is None:
+        return []
+    local_dense = resources.get("local_dense")
+    if local_dense is not None:
+        return query_dense_index(query_dense, filter_query)
+    with tracing.span("dense_query", filtered=filter_query is not None, backend="pinecone") as span:
+        async with scheduler.upstream("vector").aslot():
+            dense_response = await acall(
+                get_backends().aindex_dense, "query",
+                namespace=NAMESPACE,
+                vector=query_dense,
+                top_k=TOP_K,
+                include_metadata=True,
+                include_values=False,
+                filter=filter_query
+            )
+        results = parse_matches(dense_response)
+        span.set(matches=len(results), result_chars=result_chars(results))
+        return results
+
+async def aquery_sparse_index(query_sparse, filter_query=None):
+    local_sparse = resources.get("local_sparse")
+    if local_sparse is not None:
+        return query_sparse_index(query_sparse, filter_query)
+    with tracing.span("sparse_query", filtered=filter_query is not None, query_terms=len(query_sparse["indices"]),
+                      backend="pinecone") as span:
+        async with scheduler.upstream("vector").aslot():
+            sparse_response = await acall(
+                get_backends().aindex_sparse, "query",
+                namespace=NAMESPACE,
+                sparse_vector=query_sparse,
+                top_k=TOP_K,
+                include_metadata=True,
+                include_values=False,
+                filter=filter_query
+            )
+        results = parse_matches(sparse_response)
+        span.set(matches=len(results), result_chars=result_chars(results))
+        return results
+
+async def ahybrid_search(query, chat_history, embed_task=None):
+    """
+    hybrid_search_parallel on the event loop: classification, embedding and the unfiltered
+    queries start at once, the filtered queries as soon as the classification is ready.
+    Stages are dropped on the request budget the same way, and a local index is queried once
+    with query_both after the classification. embed_task: the query embedding, when the
+    caller already started it.
+    """
+    local_dense = resources.get("local_dense")
+    local_sparse = resources.get("local_sparse")
+    classify_task = asyncio.create_task(aclassify_query(query, chat_history))
+    embed_task = embed_task or asyncio.create_task(aget_dense_embeddings(query, EMBED_DIM))
+    query_sparse = get_sparse_embeddings(text=query, bm25_model=get_bm25(), query_type='search')
+    tasks = [classify_task, embed_task]
+
+    async def dense_query(filter_query=None):
+        # shielded: a dropped dense query must not cancel the embedding the other one waits for
+        return await aquery_dense_index(await asyncio.shield(embed_task), filter_query)
+
+    def start(coro):
+        task = asyncio.create_task(coro)
+        tasks.append(task)
+        return task
+
+    dense_nf_task = start(dense_query()) if local_dense is None else None
+    sparse_nf_task = start(aquery_sparse_index(query_sparse)) if local_sparse is None else None
+    try:
+        try:
+            filter_query = build_type_filter(
+                await asyncio.wait_for(classify_task, deadline.left(deadline.GENERATION_RESERVE)))
+        except asyncio.TimeoutError:
+            tracing.event("classify_skipped", reason="budget")
+            filter_query = None
+        dense_f_task = sparse_f_task = None
+        if filter_query and local_dense is None:
+            dense_f_task = start(dense_query(filter_query))
+        if filter_query and local_sparse is None:
+            sparse_f_task = start(aquery_sparse_index(query_sparse, filter_query))
+
+        if local_dense is not None:
+            query_dense = await afinished(embed_task, "embed") or None
+            dense_results = local_query_both(local_dense, "dense_query", query_dense, filter_query)
+        else:
+            dense_results = await afinished_pair(dense_f_task, dense_nf_task, "dense")
+        if local_sparse is not None:
+            sparse_results = local_query_both(local_sparse, "sparse_query", query_sparse, filter_query,
+                                              query_terms=len(query_sparse["indices"]))
+        else:
+            sparse_results = await afinished_pair(sparse_f_task, sparse_nf_task, "sparse")
+    finally:
+        # a failed stage must not leave the others running in the background
+        for task in tasks:
+            task.cancel()
+    return dense_results + sparse_results
+
+async def afinished_pair(task_f, task_nf, kind):
+    # without a usable filter the filtered query is identical to the unfiltered one
+    results_f = await afinished(task_f, f"{kind}_filtered", optional=True)
+    results_nf = await afinished(task_nf, f"{kind}_unfiltered", optional=results_f is not None)
+    return fallback_results(results_f, results_nf)
+
+async def afinished(task, stage, optional=False):
+    # finished() for a task on the event loop, a task that runs out of time is cancelled
+    if task is None:
+        return None
+    try:
+        return await asyncio.wait_for(task, deadline.left(deadline.GENERATION_RESERVE if optional else 0.0))
+    except asyncio.TimeoutError:
+        tracing.event(f"{stage}_skipped", reason="budget")
+        return None if optional else []
+
+async def areranking_results(query, docs, fused_results, top_k=10):
+    if not valid_rerank_input(query, docs) or not deadline.allows("rerank"):
+        return fused_results
+
+    try:
+        async with scheduler.upstream("rerank").aslot(scheduler.OPTIONAL_STAGE_MAX_WAIT):
+            with tracing.span("rerank", docs=len(docs), payload_chars=sum(len(doc) for doc in docs)) as span:
+                reranked_results = await asyncio.wait_for(
+                    acall(get_backends().reranker, "rerank", query, docs, top_k),
+                    deadline.timeout(None, deadline.GENERATION_RESERVE)
+                )
+                span.set(results=len(reranked_results))
+    except scheduler.Overloaded as e:
+        print(f"Reranking dilewati: {e}")
+        tracing.event("rerank_skipped", reason=e.reason)
+        return fused_results
+    except (requests.exceptions.RequestException, asyncio.TimeoutError) as e:
+        print(f"Error in reranking: {type(e).__name__} {e}")
+        tracing.event("rerank_skipped", reason=type(e).__name__)
+        return fused_results
+
+    return map_reranked(reranked_results, fused_results)
+
+async def acontext_generation(query, contexts, chat_history, streaming=True):
+    with tracing.span("prompt", contexts=len(contexts)) as span:
+        messages = build_generation_prompt(query, contexts, chat_history)
+        span.set(prompt_chars=sum(len(m.content) for m in messages))
+        model = generation_model(streaming)
+    llm = scheduler.upstream("llm")
+    if not streaming:
+        async with llm.aslot():
+            with tracing.span("generation") as span:
+                response = await model.ainvoke(messages)
+                span.set(chars=len(response.content))
+                if getattr(response, "usage_metadata", None):
+                    span.set(output_tokens=response.usage_metadata.get("output_tokens", 0))
+        return response.content
+    else:
+        with tracing.span("llm_wait"):
+            await llm.aacquire()
+        return scheduler.areleased(model.astream(messages), llm.arelease)
+
+async def acached_answer_stream(answer):
+    yield AIMessageChunk(content=answer)
+
+async def acaching_stream(stream, cache, query):
+    answer = ""
+    async for chunk in stream:
+        answer += getattr(chunk, "content", "") or ""
+        yield chunk
+    cache.add(query, answer)
+
+async def arag_pipeline(query, chat_history, streaming=True, trace=None, budget=None):
+    """
+    Async RAG_pipeline. With streaming, returns an async generator of message chunks:
+
+        stream = await arag_pipeline(query, chat_history)
+        async for chunk in stream:
+            ...
+
+    otherwise the answer text. Failures before generation are raised by the await.
+    """
+    trace = trace or tracing.Trace("rag_pipeline")
+    budget = deadline.REQUEST_BUDGET if budget is None else budget
+    trace.set(query_chars=len(query), history_turns=len(chat_history), streaming=streaming, mode="async", budget=budget)
+    admission = scheduler.admission
+    with tracing.use_trace(trace), deadline.use_deadline(budget):
+        with tracing.span("admission"):
+            await admission.aenter()
+        try:
+            response, cache = await apipeline_response(query, chat_history, streaming)
+        except BaseException:
+            admission.aleave()
+            raise
+    if streaming:
+        if cache is not None:
+            response = acaching_stream(response, cache, query)
+        return scheduler.areleased(tracing.atraced_stream(response, trace), admission.aleave)
+    admission.aleave()
+    if cache is not None:
+        cache.add(query, response)
+    trace.finish()
+    return response
+
+async def apipeline_response(query, chat_history, streaming):
+    lookup = AnswerLookup() if answer_cache is not None and not chat_history else None
+    with tracing.span("retrieval"):
+        embed_task = asyncio.create_task(aget_dense_embeddings(query, EMBED_DIM)) if lookup is not None else None
+        search_task = asyncio.create_task(ahybrid_search(query, chat_history, embed_task))
+        try:
+            if lookup is not None:
+                # the cache lookup waits for the embedding only, the search keeps running meanwhile
+                await asyncio.wait({embed_task, search_task}, return_when=asyncio.FIRST_COMPLETED)
+                if embed_task.done() and not embed_task.cancelled() and lookup(embed_task.result()):
+                    return (acached_answer_stream(lookup.answer) if streaming else lookup.answer), None
+            dense_results_f, dense_results_nf, sparse_results_f, sparse_results_nf = await search_task
+        finally:
+            search_task.cancel()
+    fused_results = fuse_results(dense_results_f, dense_results_nf, sparse_results_f, sparse_results_nf)
+    docs = [result['text'] for result in fused_results]
+    contexts = await areranking_results(query, docs, fused_results)
+    cache = lookup if lookup is not None and cacheable(contexts) else None
+
+    return await acontext_generation(query, contexts, chat_history, streaming=streaming), cache
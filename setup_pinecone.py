@@ -1,10 +1,22 @@
 import requests
 import json
 import os
-from pinecone.grpc import PineconeGRPC as Pinecone
+import argparse
+import sys
+import hashlib
+import time
+import numpy as np
 from dotenv import load_dotenv
-from pinecone_text.sparse import BM25Encoder
-from pinecone import ServerlessSpec
+from embedding_cache import cache_from_env, document_cache_from_env
+from local_index import LocalDenseIndex
+from backends import create_backends, acall
+import resources
+import scheduler
+import tracing
+from bm25_store import dump_bm25_binary, BM25Stats, encode_tf
+from ingestion import embed_texts
+from bulk_upsert import BulkWriter
+from corpus import iter_records, iter_file_records, chunked
 
 # load env
 load_dotenv()
@@ -15,18 +27,34 @@ SILICONFLOW_URL_EMBEDDING = os.getenv('SILICONFLOW_URL_EMBEDDING')
 SILICONFLOW_API_KEY = os.getenv('SILICONFLOW_API_KEY')
 NAMESPACE = os.getenv('NAMESPACE')
 EMBED_DIM = int(os.getenv('EMBED_DIM')) if os.getenv('EMBED_DIM') else None
+DENSE_INDEX_PATH = os.getenv('DENSE_INDEX_PATH', 'model/dense_index')
+# incremental sync: _id -> content hash of what is in the indexes
+MANIFEST_PATH = os.getenv('MANIFEST_PATH', 'model/index_manifest.json')
+# relative avgdl change that triggers re-encoding every sparse document vector
+BM25_AVGDL_TOLERANCE = float(os.getenv('BM25_AVGDL_TOLERANCE', '0.01'))
+# records read, tokenized and embedded together during a full ingestion run
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '256'))
 
-# config
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index_dense = pc.Index(host=HOST_PINECONE_DENSE)
-index_sparse = pc.Index(host=HOST_PINECONE_SPARSE)
-headers = {
-    "Authorization": f"Bearer {SILICONFLOW_API_KEY}",
-    "Content-Type": "application/json"
-}
+# config: clients are created on first use (RAG_BACKEND=fake swaps every upstream for an in-process stand-in)
+resources.register("backends", create_backends)
+# query embedding cache (None when disabled)
+resources.register("embedding_cache", cache_from_env)
+# embeddings of chunks embedded ahead of ingestion (None when DOC_EMBED_CACHE_PATH is not set)
+resources.register("document_embedding_cache", document_cache_from_env)
+
+def get_backends():
+    return resources.get("backends")
+
+def set_embedding_cache(cache):
+    # swap the cache implementation (any object with get/put), None disables caching
+    resources.override("embedding_cache", cache)
 
 def create_index():
     # create index or vector database for dense and sparse vector
+    pc = get_backends().pc
+    if pc is None:
+        return
+    from pinecone import ServerlessSpec
     dense_index_name = "dense-cs-upi"
     sparse_index_name = "sparse-cs-upi"
 
@@ -57,52 +85,64 @@ def create_index():
         )
 
 def create_corpus(corpus, folder_path):
-    if os.path.isdir(folder_path):
-        for filename in os.listdir(folder_path):
-            if len(filename.split('.')) == 2 and filename.split('.')[1] == 'json':
-                file_path=folder_path+'/'+filename
-                try:
-                    with open(file_path, "r", encoding="utf-8") as file:
-                        data = json.load(file)
-                        for item in data:
-                            corpus.append(item['text'])
-                        
-                except FileNotFoundError:
-                    print(f"Error: {file_path} not found. Please ensure the file exists in the correct directory.")
-                except json.JSONDecodeError:
-                    print(f"Error: Could not decode JSON from {file_path}. The file might be malformed.")
-                except Exception as e:
-                    print(f"An unexpected error occurred: {e}")
-    
+    for item in iter_records(folder_path):
+        corpus.append(item['text'])
     print("corpus created successfully")
 
-def get_dense_embeddings(text, dim_size=1024):
-    payload = {
-        "model": "Qwen/Qwen3-Embedding-8B",
-        "input": text,
-        "encoding_format": "float",
-        "dimensions": dim_size
-    }
+def read_corpus_records(folder_path, strict=False):
+    # all records from the corpus files in folder_path, strict: unreadable files raise
+    return list(iter_records(folder_path, strict))
+
+def get_dense_embeddings(text, dim_size=1024, use_cache=True):
+    embedder = get_backends().embedder
+    cache = resources.get("embedding_cache") if use_cache and isinstance(text, str) else None
+    if cache is not None:
+        cached = cache.get(embedder.model, dim_size, text)
+        if cached is not None:
+            tracing.record("embed", time.perf_counter(), 0.0, cache="hit")
+            return cached
 
     try:
-        response = requests.post(
-            SILICONFLOW_URL_EMBEDDING,
-            json=payload,
-            headers=headers
-        )
-        response.raise_for_status()
+        with scheduler.upstream("embed").slot(), \
+                tracing.span("embed", cache="miss" if cache is not None else "off", chars=len(text)):
+            embedding = embedder.embed(text, dim_size)
+        if cache is not None:
+            cache.put(embedder.model, dim_size, text, embedding)
+        return embedding
 
-        data = response.json()
+    except scheduler.Overloaded as e:
+        print(f"Embedding dilewati: {e}")
+        tracing.event("embed_skipped", reason=e.reason)
+    except requests.exceptions.RequestException as e:
+        print(f"Error HTTP: {e}")
+    except ValueError as e:
+        print(f"Error data: {e}")
+    except Exception as e:
+        print(f"Error tidak terduga: {e}")
 
-        # Validasi struktur response
-        if "data" not in data or not data["data"]:
-            raise ValueError("Response JSON tidak memiliki field 'data' atau kosong.")
+    return None
 
-        if "embedding" not in data["data"][0]:
-            raise ValueError("Field 'embedding' tidak ditemukan di dalam 'data[0]'.")
+async def aget_dense_embeddings(text, dim_size=1024, use_cache=True):
+    # get_dense_embeddings for the async pipeline
+    embedder = get_backends().embedder
+    cache = resources.get("embedding_cache") if use_cache and isinstance(text, str) else None
+    if cache is not None:
+        cached = cache.get(embedder.model, dim_size, text)
+        if cached is not None:
+            tracing.record("embed", time.perf_counter(), 0.0, cache="hit")
+            return cached
 
-        return data["data"][0]["embedding"]
+    try:
+        async with scheduler.upstream("embed").aslot():
+            with tracing.span("embed", cache="miss" if cache is not None else "off", chars=len(text)):
+                embedding = await acall(embedder, "embed", text, dim_size)
+        if cache is not None:
+            cache.put(embedder.model, dim_size, text, embedding)
+        return embedding
 
+    except scheduler.Overloaded as e:
+        print(f"Embedding dilewati: {e}")
+        tracing.event("embed_skipped", reason=e.reason)
     except requests.exceptions.RequestException as e:
         print(f"Error HTTP: {e}")
     except ValueError as e:
@@ -116,41 +156,76 @@ def get_sparse_embeddings(text, bm25_model, query_type):
     if query_type == 'upsert':
         return bm25_model.encode_documents(text)
     else:
-        return bm25_model.encode_queries(text)
+        with tracing.span("bm25_encode") as span:
+            query_sparse = bm25_model.encode_queries(text)
+            span.set(terms=len(query_sparse["indices"]))
+        return query_sparse
+
+def cached_dense_embeddings(texts):
+    # embeddings already in the document embedding cache (see cache_dense_embeddings), None for the others
+    cache = resources.get("document_embedding_cache")
+    if cache is None:
+        return [None] * len(texts)
+    model = get_backends().embedder.model
+    return [cache.get(model, EMBED_DIM, text) for text in texts]
+
+def cache_dense_embeddings(texts):
+    """
+    Embed texts in batches and store them in the document embedding cache, so a later ingestion
+    run (build_dense_vectors) reuses them. Needs DOC_EMBED_CACHE_PATH.
+    """
+    cache = resources.get("document_embedding_cache")
+    if cache is None:
+        return 0
+    embedder = get_backends().embedder
+    cached = cached_dense_embeddings(texts)
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+    vectors = embed_texts(embedder, missing, EMBED_DIM)
+    cache.put_many(embedder.model, EMBED_DIM, [(t, v) for t, v in zip(missing, vectors) if v is not None])
+    return len(missing)
+
+def build_dense_vectors(data):
+    # dense embeddings in batches, texts found in the document embedding cache are not embedded again
+    texts = [item['text'] for item in data]
+    dense_values = cached_dense_embeddings(texts)
+    missing = [i for i, values in enumerate(dense_values) if values is None]
+    if missing:
+        embedded = embed_texts(get_backends().embedder, [texts[i] for i in missing], EMBED_DIM)
+        for i, values in zip(missing, embedded):
+            dense_values[i] = values
+    dense_vectors = []
+    for item, values in zip(data, dense_values):
+        if values is not None:
+            dense_vectors.append({
+                "id": item['_id'],
+                "values": values,
+                "metadata": {key: value for key, value in item.items() if key not in {'_id'}}
+            })
+    return dense_vectors
+
+def sparse_vector(item, sparse_vals):
+    # None for documents without any token
+    if sparse_vals and sparse_vals.get("indices") and sparse_vals.get("values"):
+        return {
+            "id": item["_id"],
+            "values": [],
+            "sparse_values": sparse_vals,
+            "metadata": {k: v for k, v in item.items() if k not in {"_id"}}
+        }
+    return None
+
+def build_sparse_vectors(data, bm25_model):
+    # sparse vectors for all records at once
+    sparse_values = bm25_model.encode_documents([item['text'] for item in data])
+    sparse_vectors = [sparse_vector(item, sparse_vals) for item, sparse_vals in zip(data, sparse_values)]
+    return [v for v in sparse_vectors if v is not None]
+
+def build_vectors(data, bm25_model):
+    return build_dense_vectors(data), build_sparse_vectors(data, bm25_model)
 
 def generate_embedding(path_files, bm25_model):
     try:
-        with open(path_files, "r", encoding="utf-8") as file: 
-            data = json.load(file)
-            dense_vectors = []
-            sparse_vectors = []
-            for item in data:
-                # get dense embedding
-                dense_item = {
-                    "id": item['_id'], 
-                    "values": get_dense_embeddings(item['text'], EMBED_DIM), 
-                    "metadata": {key: value for key, value in item.items() if key not in {'_id'}}
-                }
-                if dense_item["values"] is not None:
-                    dense_vectors.append(dense_item)
-
-                # get sparse embedding
-                sparse_vals = bm25_model.encode_documents([item["text"]])[0]
-                if sparse_vals and sparse_vals.get("indices") and sparse_vals.get("values"):
-                    sparse_item = {
-                        "id": item["_id"],
-                        "values": [],
-                        "sparse_values": sparse_vals,
-                        "metadata": {k: v for k, v in item.items() if k not in {"_id"}}
-                    }
-                    sparse_vectors.append(sparse_item)
-            
-            return dense_vectors, sparse_vectors
-
-    except FileNotFoundError:
-        print(f"Error: {path_files} not found. Please ensure the file exists in the correct directory.")
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {path_files}. The file might be malformed.")
+        return build_vectors(list(iter_file_records(path_files)), bm25_model)
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
@@ -159,42 +234,188 @@ def generate_embedding(path_files, bm25_model):
 folder_path = 'data/final_id'
 
 # define bm25 model
-def create_corpus_train_bm25_model(bm25):
-    # create bm25 corpus for sparse vector
-    bm25_corpus = []
-    create_corpus(bm25_corpus, folder_path)
+def create_corpus_train_bm25_model(bm25, corpus=None):
+    # create bm25 corpus for sparse vector (texts from the corpus files unless given)
+    if corpus is None:
+        corpus = []
+        create_corpus(corpus, folder_path)
 
+    if not corpus:
+        sys.exit(f"korpus {folder_path} kosong, bm25 tidak di-fit dan index tidak diubah")
     # fit corpus to bm25 model
-    bm25.fit(bm25_corpus)
+    bm25.fit(corpus)
+    save_bm25_model(bm25)
 
+def save_bm25_model(bm25):
     # store BM25 params as json
     bm25.dump("model/bm25_params.json")
+    # compact memory-mappable copy, loaded in preference to the json by search.py
+    dump_bm25_binary(bm25)
     print("bm25 model successfully loaded")
 
+def record_hash(item):
+    # any change in text or metadata changes the hash
+    return hashlib.sha256(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def embedding_config():
+    return {"model": get_backends().embedder.model, "dim": EMBED_DIM, "namespace": NAMESPACE}
+
+def bm25_doc_params(bm25):
+    # document vectors only depend on these (doc_freq / n_docs are only used for queries)
+    params = bm25.get_params()
+    params.pop("doc_freq")
+    params.pop("n_docs")
+    return params
+
+def bm25_shifted(old, new, tolerance=BM25_AVGDL_TOLERANCE):
+    if not old:
+        return True
+    if {k: v for k, v in old.items() if k != "avgdl"} != {k: v for k, v in new.items() if k != "avgdl"}:
+        return True
+    return abs(new["avgdl"] - old["avgdl"]) > tolerance * old["avgdl"]
+
+def load_manifest(path=MANIFEST_PATH):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def index_version(path=MANIFEST_PATH):
+    # changes whenever full_index / sync_index rewrite the manifest, None without one
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def save_manifest(records, indexed_ids, bm25_params, path=MANIFEST_PATH):
+    # bm25_params: document params the sparse vectors in the index were built with
+    manifest = {
+        "embedding": embedding_config(),
+        "bm25": bm25_params,
+        "docs": {item['_id']: record_hash(item) for item in records if item['_id'] in indexed_ids}
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+def sync_index(bm25, records=None, manifest_path=MANIFEST_PATH):
+    """
+    Incremental sync against the manifest: embed and upsert only new or changed records,
+    delete ids that disappeared, and re-encode every sparse vector only when the BM25
+    document params shift. Falls back to a full rebuild when there is no manifest or the
+    embedding model / dimension / namespace changed. records must be the whole corpus
+    (read_corpus_records(..., strict=True)), ids missing from it are deleted.
+    """
+    if records is None:
+        records = read_corpus_records(folder_path, strict=True)
+    current = {item['_id']: record_hash(item) for item in records}
+    manifest = load_manifest(manifest_path)
+    full = manifest is None or manifest.get("embedding") != embedding_config()
+    indexed = {} if full else manifest["docs"]
+
+    changed = [item for item in records if indexed.get(item['_id']) != current[item['_id']]]
+    removed = [doc_id for doc_id in indexed if doc_id not in current]
+    rebuild_sparse = full or bm25_shifted(manifest.get("bm25"), bm25_doc_params(bm25))
+    print(f"sync: {len(changed)} new/changed, {len(removed)} removed, "
+          f"full={full}, rebuild sparse={rebuild_sparse}")
+
+    index_dense = get_backends().index_dense
+    index_sparse = get_backends().index_sparse
+    dense_vectors = build_dense_vectors(changed)
+    sparse_vectors = build_sparse_vectors(records if rebuild_sparse else changed, bm25)
+    with BulkWriter(NAMESPACE) as writer:
+        writer.add("dense", index_dense, dense_vectors)
+        writer.add("sparse", index_sparse, sparse_vectors)
+    print(writer.format_report())
+    if removed:
+        index_dense.delete(ids=removed, namespace=NAMESPACE)
+        index_sparse.delete(ids=removed, namespace=NAMESPACE)
+    print(f"sync: upserted {len(dense_vectors)} dense, {len(sparse_vectors)} sparse, deleted {len(removed)}")
+
+    # local dense index follows the same delta
+    if full:
+        local_dense = LocalDenseIndex.from_vectors(dense_vectors) if dense_vectors else None
+    elif os.path.isdir(DENSE_INDEX_PATH):
+        local_dense = LocalDenseIndex.load(DENSE_INDEX_PATH).updated(dense_vectors, removed)
+    else:
+        local_dense = None
+        print("WARN: local dense index tidak ada, jalankan tanpa --incremental untuk membuatnya")
+    if local_dense is not None:
+        local_dense.save(DENSE_INDEX_PATH)
+
+    # records whose embedding or upsert failed stay out of the manifest so the next sync retries them
+    embedded = {v["id"] for v in dense_vectors}
+    failed = set().union(*writer.failed_ids.values())
+    indexed_ids = {doc_id for doc_id in current if doc_id not in failed
+                   and (doc_id in embedded or indexed.get(doc_id) == current[doc_id])}
+    # without a sparse rebuild the index still holds vectors of the old params, so keep those
+    # as the baseline and let small avgdl drifts add up until they cross the tolerance
+    bm25_params = bm25_doc_params(bm25) if rebuild_sparse else manifest["bm25"]
+    save_manifest(records, indexed_ids, bm25_params, manifest_path)
+
+def full_index(bm25):
+    """
+    Single pass over the corpus stream: each chunk of records is tokenized once for BM25 and
+    embedded, and its dense vectors are upserted in the background while the next chunk is
+    read. Sparse document vectors need the final avgdl, so they are built from the kept term
+    frequencies after the pass. Fits and saves bm25.
+    """
+    index_dense = get_backends().index_dense
+    index_sparse = get_backends().index_sparse
+    stats = BM25Stats(bm25)
+    # (record, indices, tf) per record, for the sparse vectors and the manifest
+    tokenized = []
+    local_vectors = []
+    writer = BulkWriter(NAMESPACE)
+    for chunk in chunked(iter_records(folder_path), INGEST_CHUNK_SIZE):
+        for item in chunk:
+            tokenized.append((item, *stats.add(item['text'])))
+        dense_vectors = build_dense_vectors(chunk)
+        writer.add("dense", index_dense, dense_vectors)
+        # float32 copy for the local dense index instead of keeping the float lists
+        local_vectors.extend(
+            {"id": v["id"], "values": np.asarray(v["values"], dtype=np.float32), "metadata": v["metadata"]}
+            for v in dense_vectors
+        )
+        print(f"generate dense vector done for {len(tokenized)} records")
+
+    if stats.n_docs == 0:
+        writer.close()
+        sys.exit(f"korpus {folder_path} kosong (atau tidak ada record valid), bm25 tidak di-fit dan tidak disimpan")
+    stats.apply()
+    save_bm25_model(bm25)
+    sparse_vectors = (sparse_vector(item, encode_tf(bm25, indices, tf)) for item, indices, tf in tokenized)
+    writer.add("sparse", index_sparse, (v for v in sparse_vectors if v is not None))
+    writer.close()
+    print(writer.format_report())
+
+    # local dense index (RETRIEVAL_BACKEND=local / DENSE_BACKEND=local)
+    if local_vectors:
+        LocalDenseIndex.from_vectors(local_vectors).save(DENSE_INDEX_PATH)
+        print("local dense index saved to: ", DENSE_INDEX_PATH)
+
+    # baseline for the next --incremental run, failed upserts are retried by it
+    failed = set().union(*writer.failed_ids.values())
+    save_manifest([item for item, _, _ in tokenized], {v["id"] for v in local_vectors} - failed,
+                  bm25_doc_params(bm25))
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="only embed/upsert new or changed records and delete removed ids (see MANIFEST_PATH)")
+    args = parser.parse_args()
+
+    from pinecone_text.sparse import BM25Encoder
     # create index (if not available)
     create_index()
-    # create corpus and train bm25 model
     bm25 = BM25Encoder(stem=False)
-    create_corpus_train_bm25_model(bm25)
-    print("load bm25 model done")
-
-    # generate dense and sparse vector
-    if os.path.isdir(folder_path):
-        for filename in os.listdir(folder_path):
-            if len(filename.split('.')) == 2 and filename.split('.')[1] == 'json':
-                file_path=folder_path+'/'+filename
-                # insert data dense
-                dense_vectors, sparse_vectors = generate_embedding(file_path, bm25_model=bm25)
-                print("generate dense and sparse vector done for: ", filename)
-                index_dense.upsert(
-                    vectors=dense_vectors,
-                    namespace=NAMESPACE
-                )
-                print("upsert dense vector successfully for: ", filename)
-                # insert data sparse
-                index_sparse.upsert(
-                    namespace=NAMESPACE,
-                    vectors=sparse_vectors
-                )
-                print("upsert sparse vector successfully for: ", filename)
+    if args.incremental:
+        # one read of the corpus for both the bm25 fit and the diff; a file that fails to parse
+        # stops the sync, its records would otherwise be deleted from the index
+        records = read_corpus_records(folder_path, strict=True)
+        create_corpus_train_bm25_model(bm25, [item['text'] for item in records])
+        print("load bm25 model done")
+        sync_index(bm25, records)
+    else:
+        # bm25 is fitted during the same pass that embeds the corpus
+        full_index(bm25)
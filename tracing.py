@@ -0,0 +1,339 @@
+"""
+Per-request traces and per-stage latency histograms for the RAG pipeline.
+
+    trace = Trace("rag_pipeline")
+    with use_trace(trace):
+        with span("rerank", docs=20) as s:
+            ...
+            s.set(results=10)
+    trace.finish()
+
+Every span is added to the current trace (if any) and observed in a process-wide histogram
+per span name (stats()). Work submitted to a thread pool keeps the trace when the function is
+wrapped with in_context(). Optional exports:
+- TRACE_OTEL=1: every span is also an OpenTelemetry span (OTLP exporter configured from the
+  standard OTEL_* variables when opentelemetry-sdk is installed)
+- PROMETHEUS_PORT=9464: rag_stage_seconds{stage} histogram served on that port
+TRACE_LOG=1 (default) prints a one-line summary of every finished trace.
+"""
+import contextvars
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_LOG = os.getenv('TRACE_LOG', '1') == '1'
+TRACE_OTEL = os.getenv('TRACE_OTEL', '0') == '1'
+PROMETHEUS_PORT = int(os.getenv('PROMETHEUS_PORT')) if os.getenv('PROMETHEUS_PORT') else None
+# finished traces kept for inspection
+RECENT_TRACES = int(os.getenv('RECENT_TRACES', '100'))
+
+_current = contextvars.ContextVar("trace", default=None)
+recent = deque(maxlen=RECENT_TRACES)
+
+
+class Histogram:
+    # log-spaced buckets (20 per decade, 100 us .. 100 s): percentiles without keeping samples
+    BOUNDS = [1e-4 * 10 ** (i / 20) for i in range(121)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.BOUNDS, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile (at most 12% above the true value)
+        if not self.count:
+            return float("nan")
+        rank = max(1, round(p / 100.0 * self.count))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "mean": self.sum / self.count if self.count else float("nan"),
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "max": self.max,
+            }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def observe(name, seconds):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    histogram.observe(seconds)
+    if PROMETHEUS_PORT:
+        _prometheus().labels(stage=name).observe(seconds)
+
+
+def stats():
+    # {stage: {count, mean, p50, p95, p99, max}} in seconds
+    return {name: h.snapshot() for name, h in list(_histograms.items())}
+
+
+def reset_stats():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+class Trace:
+    def __init__(self, name="rag_pipeline", **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = dict(attrs)
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.events = []
+        self._lock = threading.Lock()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add_span(self, name, start, duration, attrs=None):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "offset": start - self.start,
+                "duration": duration,
+                "thread": threading.current_thread().name,
+                "attrs": attrs or {},
+            })
+
+    def event(self, name, **attrs):
+        with self._lock:
+            self.events.append({"name": name, "offset": time.perf_counter() - self.start, "attrs": attrs})
+
+    def stage_durations(self):
+        # seconds per span name, summed when a stage ran more than once
+        durations = {}
+        for s in list(self.spans):
+            durations[s["name"]] = durations.get(s["name"], 0.0) + s["duration"]
+        return durations
+
+    def fallbacks(self):
+        # stages skipped by the pipeline ("<stage>_skipped" events), in order
+        return [e["name"][:-len("_skipped")] for e in list(self.events) if e["name"].endswith("_skipped")]
+
+    def error_stage(self):
+        # innermost failed span: spans are added when they end, so inner ones come first
+        for s in list(self.spans):
+            if "error" in s["attrs"]:
+                return s["name"]
+        return None
+
+    def finish(self):
+        if self.duration is not None:
+            return self
+        self.duration = time.perf_counter() - self.start
+        observe("total", self.duration)
+        recent.append(self)
+        if TRACE_LOG:
+            print(self.summary())
+        return self
+
+    def summary(self):
+        stages = " ".join(f"{name}={sec * 1000:.0f}ms" for name, sec in self.stage_durations().items())
+        total = f"{self.duration * 1000:.0f}ms" if self.duration is not None else "running"
+        return f"trace {self.id} {self.name} total={total} {stages}"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "attrs": self.attrs,
+            "spans": list(self.spans),
+            "events": list(self.events),
+        }
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def use_trace(trace):
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def in_context(fn):
+    # fn bound to a copy of the caller's context, for executor.submit
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+@contextmanager
+def span(name, **attrs):
+    current = Span(name, attrs)
+    otel = _otel_tracer().start_as_current_span(name) if TRACE_OTEL else None
+    otel_span = otel.__enter__() if otel is not None else None
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        observe(name, duration)
+        trace = _current.get()
+        if trace is not None:
+            trace.add_span(name, start, duration, current.attrs)
+        if otel is not None:
+            for key, value in current.attrs.items():
+                if isinstance(value, (str, bool, int, float)):
+                    otel_span.set_attribute(key, value)
+            otel.__exit__(None, None, None)
+
+
+def event(name, **attrs):
+    # event on the current trace (if any), e.g. a skipped stage
+    trace = _current.get()
+    if trace is not None:
+        trace.event(name, **attrs)
+
+
+def record(name, start, duration, trace=None, **attrs):
+    # span measured by the caller, e.g. across the chunks of a stream
+    observe(name, duration)
+    trace = trace or _current.get()
+    if trace is not None:
+        trace.add_span(name, start, duration, attrs)
+
+
+def traced_stream(stream, trace):
+    """
+    Pass the chunks of an LLM stream through, recording "ttft" (trace start to first content)
+    and "generation" (stream start to last chunk, with chunk / char / token counts), then
+    finish the trace.
+    """
+    gen_start = time.perf_counter()
+    first = None
+    chunks = chars = 0
+    output_tokens = None
+    try:
+        for chunk in stream:
+            content = getattr(chunk, "content", "") or ""
+            if content and first is None:
+                first = time.perf_counter()
+                record("ttft", trace.start, first - trace.start, trace)
+            chunks += 1
+            chars += len(content)
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage:
+                output_tokens = (output_tokens or 0) + usage.get("output_tokens", 0)
+            yield chunk
+    finally:
+        attrs = {"chunks": chunks, "chars": chars}
+        if output_tokens is not None:
+            attrs["output_tokens"] = output_tokens
+        record("generation", gen_start, time.perf_counter() - gen_start, trace, **attrs)
+        trace.finish()
+        # a stream closed early closes the wrapped one now, so it releases what it holds
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+async def atraced_stream(stream, trace):
+    # traced_stream for an async iterator of chunks
+    gen_start = time.perf_counter()
+    first = None
+    chunks = chars = 0
+    output_tokens = None
+    try:
+        async for chunk in stream:
+            content = getattr(chunk, "content", "") or ""
+            if content and first is None:
+                first = time.perf_counter()
+                record("ttft", trace.start, first - trace.start, trace)
+            chunks += 1
+            chars += len(content)
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage:
+                output_tokens = (output_tokens or 0) + usage.get("output_tokens", 0)
+            yield chunk
+    finally:
+        attrs = {"chunks": chunks, "chars": chars}
+        if output_tokens is not None:
+            attrs["output_tokens"] = output_tokens
+        record("generation", gen_start, time.perf_counter() - gen_start, trace, **attrs)
+        trace.finish()
+        if hasattr(stream, "aclose"):
+            await stream.aclose()
+
+
+_otel = None
+_prom = None
+_export_lock = threading.Lock()
+
+
+def _otel_tracer():
+    global _otel
+    if _otel is None:
+        with _export_lock:
+            if _otel is None:
+                from opentelemetry import trace as otel_trace
+                try:
+                    from opentelemetry.sdk.trace import TracerProvider
+                    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+                    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+                    provider = TracerProvider()
+                    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                    otel_trace.set_tracer_provider(provider)
+                except ImportError:
+                    print("WARN: opentelemetry-sdk tidak ada, span dikirim ke tracer provider yang sudah di-set")
+                _otel = otel_trace.get_tracer("rag_pipeline")
+    return _otel
+
+
+def _prometheus():
+    global _prom
+    if _prom is None:
+        with _export_lock:
+            if _prom is None:
+                from prometheus_client import Histogram as PromHistogram, start_http_server
+                start_http_server(PROMETHEUS_PORT)
+                _prom = PromHistogram("rag_stage_seconds", "RAG pipeline stage latency", ["stage"],
+                                      buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
+    return _prom
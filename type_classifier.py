@@ -0,0 +1,162 @@
+"""
+Local query classifier for the metadata type filter, in place of an LLM round trip.
+
+TF-IDF nearest centroid: every type in the corpus gets the centroid of the TF-IDF vectors of
+its documents (data/final_id) and of the eval queries whose gold documents have that type
+(data/eval). A query is scored against all centroids through an inverted index (cosine
+similarity, microseconds) and gets every type scoring within RELATIVE_SCORE of the best one.
+Confidence is the margin to the best type left out, (best - next) / best: on the eval queries
+it separates right from wrong answers much better than the raw score. Below
+CLASSIFIER_MIN_CONFIDENCE search.classify_query asks the LLM.
+
+    python type_classifier.py            # accuracy on the eval queries (cross-validated) and timing
+"""
+import argparse
+import json
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+
+from corpus import iter_records
+
+CLASSIFIER_EVAL_PATH = os.getenv('CLASSIFIER_EVAL_PATH', 'data/eval/rag_eval.json')
+CLASSIFIER_MIN_CONFIDENCE = float(os.getenv('CLASSIFIER_MIN_CONFIDENCE', '0.4'))
+# types scoring at least this fraction of the best score are returned too
+RELATIVE_SCORE = 0.8
+
+_token = re.compile(r"\w+")
+
+
+def tokenize(text):
+    words = _token.findall(text.lower())
+    # word bigrams help with names like "ilmu komputer" vs "pendidikan ilmu komputer"
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def eval_examples(path, records):
+    # (query, types) from an eval file, types are those of the query's gold documents
+    types_by_id = {r["_id"]: r.get("type") or [] for r in records if r.get("_id")}
+    with open(path, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    examples = []
+    for item in items:
+        types = sorted({t for doc_id in item.get("gold_doc_ids", []) for t in types_by_id.get(doc_id, [])})
+        if item.get("query") and types:
+            examples.append((item["query"], types))
+    return examples
+
+
+class TypeClassifier:
+    def __init__(self, idf, postings, types):
+        self.idf = idf
+        # term -> [(type, centroid weight)]
+        self.postings = postings
+        self.types = types
+
+    @classmethod
+    def train(cls, examples):
+        # examples: (text, types) pairs, one L2-normalised TF-IDF centroid per type
+        examples = [(Counter(tokenize(text)), types) for text, types in examples]
+        df = Counter()
+        for tf, _ in examples:
+            df.update(tf.keys())
+        n = len(examples)
+        idf = {term: math.log((n + 1) / (count + 1)) + 1 for term, count in df.items()}
+
+        centroids = defaultdict(Counter)
+        for tf, types in examples:
+            vector = cls._unit({term: (1 + math.log(count)) * idf[term] for term, count in tf.items()})
+            for t in types:
+                for term, value in vector.items():
+                    centroids[t][term] += value
+
+        postings = defaultdict(list)
+        for t, centroid in centroids.items():
+            for term, value in cls._unit(centroid).items():
+                postings[term].append((t, value))
+        return cls(idf, dict(postings), sorted(centroids))
+
+    @classmethod
+    def from_corpus(cls, corpus_path, eval_path=CLASSIFIER_EVAL_PATH, exclude_queries=()):
+        # exclude_queries: eval queries left out of training, e.g. the ones evals.py scores
+        records = [r for r in iter_records(corpus_path) if r.get("text") and r.get("type")]
+        examples = [(r["text"], r["type"]) for r in records]
+        if eval_path and os.path.isfile(eval_path):
+            exclude_queries = set(exclude_queries)
+            examples += [e for e in eval_examples(eval_path, records) if e[0] not in exclude_queries]
+        elif eval_path:
+            print(f"WARN: {eval_path} tidak ada, classifier hanya dilatih dari korpus")
+        return cls.train(examples)
+
+    @staticmethod
+    def _unit(vector):
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        return {k: v / norm for k, v in vector.items()} if norm else {}
+
+    def scores(self, text):
+        # cosine similarity of text with every type centroid that shares a term
+        tf = Counter(tokenize(text))
+        query = self._unit({term: (1 + math.log(count)) * self.idf[term] for term, count in tf.items() if term in self.idf})
+        scores = defaultdict(float)
+        for term, value in query.items():
+            for t, weight in self.postings[term]:
+                scores[t] += value * weight
+        return scores
+
+    def classify(self, text):
+        # ([types], confidence), ["Other"] with confidence 0.0 when no term is known
+        scores = self.scores(text)
+        if not scores:
+            return ["Other"], 0.0
+        best = max(scores.values())
+        types = sorted((t for t, s in scores.items() if s >= RELATIVE_SCORE * best), key=lambda t: -scores[t])
+        rest = max((s for t, s in scores.items() if t not in types), default=0.0)
+        return types, (best - rest) / best
+
+
+def cross_validate(records, examples, folds=5):
+    # eval queries of one fold are left out of the centroids they are scored against
+    docs = [(r["text"], r["type"]) for r in records]
+    hits = exact = 0
+    confidences = []
+    for k in range(folds):
+        held_out = examples[k::folds]
+        train = [example for i, example in enumerate(examples) if i % folds != k]
+        classifier = TypeClassifier.train(docs + train)
+        for query, gold in held_out:
+            predicted, confidence = classifier.classify(query)
+            confidences.append((confidence, bool(set(predicted) & set(gold))))
+            hits += bool(set(predicted) & set(gold))
+            exact += set(predicted) == set(gold)
+    return hits, exact, confidences
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--corpus", default=os.getenv('CORPUS_PATH', 'data/final_id'))
+    ap.add_argument("--eval", default=CLASSIFIER_EVAL_PATH)
+    ap.add_argument("--folds", type=int, default=5)
+    args = ap.parse_args()
+
+    records = [r for r in iter_records(args.corpus) if r.get("text") and r.get("type")]
+    examples = eval_examples(args.eval, records)
+    hits, exact, confidences = cross_validate(records, examples, args.folds)
+    n = len(examples)
+    print(f"{n} query eval, {args.folds}-fold: tipe benar {hits / n:.1%}, persis sama {exact / n:.1%}")
+    confident = [ok for c, ok in confidences if c >= CLASSIFIER_MIN_CONFIDENCE]
+    if confident:
+        print(f"confidence >= {CLASSIFIER_MIN_CONFIDENCE}: {len(confident)}/{n} query lokal, "
+              f"tipe benar {sum(confident) / len(confident):.1%} (sisanya ke LLM)")
+
+    classifier = TypeClassifier.from_corpus(args.corpus, args.eval)
+    queries = [q for q, _ in examples]
+    start = time.perf_counter()
+    for q in queries:
+        classifier.classify(q)
+    print(f"{(time.perf_counter() - start) / len(queries) * 1e6:.1f} us per query")
+
+
+if __name__ == "__main__":
+    main()
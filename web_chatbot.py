@@ -1,8 +1,23 @@
+import os
 import streamlit as st
+from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, HumanMessage
-from search import RAG_pipeline
 from PIL import Image
-from datetime import datetime
+
+load_dotenv()
+# with API_URL the app is a thin client of api.py, otherwise the pipeline runs in this process
+API_URL = os.getenv('API_URL')
+if API_URL:
+    from api_client import stream_chat as RAG_pipeline
+else:
+    from search import RAG_pipeline, warm_up
+
+    @st.cache_resource
+    def warm_up_once():
+        # create clients / load bm25 once per process instead of on the first question
+        return warm_up()
+
+    warm_up_once()
 
 # max history chat (5 bot, 5 human)
 MAX_TURNS = 10
@@ -62,7 +77,6 @@ if user_question:
             full_response += delta
             response_container.markdown(full_response)
 
-        print("finish : ", datetime.now())
         st.session_state.messages.append(AIMessage(full_response))
         # cut history chat
         if len(st.session_state.messages) > MAX_TURNS: